@@ -3,9 +3,23 @@ from authorize import aim
 from authorize import arb
 import datetime
 from django.conf import settings as django_settings
+import errno
+import logging
+import socket
+import threading
+import time
 
+from . import breakers
 from . import forms
+from . import metrics
+from . import pools
 from . import signals
+from . import timing
+from . import workers
+
+DEFAULT_RECURRING_WORKERS = 2
+
+logger = logging.getLogger(__name__)
 
 
 class Backend(object):
@@ -44,6 +58,16 @@ class Backend(object):
         """
         raise NotImplementedError
 
+    def is_available(self):
+        """
+        Returns ``False`` if ``purchase`` would be refused without trying
+
+        Backends with a circuit breaker return ``False`` while it is open so
+        the donation isn't saved for a purchase that can't be made.  This
+        method is optional.
+        """
+        return True
+
     def send_successful_purchase(self, donation, form, result):
         """
         Called by ``purchase`` after a donation has been succesfully
@@ -54,13 +78,47 @@ class Backend(object):
         an action based on the successful donation prior to the signal
         being sent.
         """
-        signals.successful_purchase.send(sender=self, donation=donation,
-                form=form, result=result)
+        with timing.stage("receivers"):
+            signals.successful_purchase.send(sender=self, donation=donation,
+                    form=form, result=result)
+
+    def record_gateway_call(self, call, started, outcome, result_code=None,
+            reason_code=None):
+        """
+        Records the wall time and outcome of a call to the gateway
+
+        ``started`` is the ``time.time()`` the call was made at, ``outcome``
+        is a short label such as ``approved``, ``declined`` or ``error``.
+        Backends should call this once for every request they make so the
+        sinks configured in ``ARMSTRONG_DONATIONS_METRICS_SINKS`` see it.
+        """
+        metrics.record(call, time.time() - started, outcome,
+                result_code=result_code, reason_code=reason_code)
 
 
 class AuthorizeNetBackend(Backend):
+    """
+    Processes donations through Authorize.net's AIM and ARB APIs
+
+    Repeating donations are charged once through AIM and then have an ARB
+    subscription created for the remaining payments.  If ``defer_recurring``
+    is ``True`` (or ``ARMSTRONG_DONATIONS_DEFER_RECURRING`` is set) the
+    subscription is created on a background thread once the first charge
+    has gone through.  The donation is marked as processed as soon as that
+    charge succeeds, and ``successful_purchase`` is sent once the
+    subscription call finishes so receivers still see its response.  A
+    subscription that can't be created leaves the charge in place: its
+    ``recurring_response`` is a failed one with the error as its
+    ``reason``.
+
+    Every gateway call goes through a circuit breaker shared by all backends
+    using the same Authorize.net login (see ``breakers``).  Gateway errors,
+    exceptions and calls slower than the ``TIMEOUT`` budget count as
+    failures; while the circuit is open ``purchase`` raises
+    ``breakers.CircuitOpen`` without contacting the gateway.
+    """
     def __init__(self, api_class=None, recurring_api_class=None,
-            settings=None, testing=None):
+            settings=None, testing=None, defer_recurring=None):
         if api_class is None:
             api_class = aim.Api
         self.api_class = api_class
@@ -74,6 +132,11 @@ class AuthorizeNetBackend(Backend):
             testing = getattr(self.settings, "ARMSTRONG_DONATIONS_TESTING",
                     False)
         self.testing = testing
+        if defer_recurring is None:
+            defer_recurring = getattr(self.settings,
+                    "ARMSTRONG_DONATIONS_DEFER_RECURRING", False)
+        self.defer_recurring = defer_recurring
+        self.timeout = breakers.get_breaker_settings(self.settings)["TIMEOUT"]
 
     def get_form_class(self):
         return forms.AuthorizeDonationForm
@@ -82,29 +145,148 @@ class AuthorizeNetBackend(Backend):
         result = self.onetime_purchase(donation, form)
         if not result["status"]:
             return result
+        if donation.is_repeating and self.defer_recurring:
+            result["recurring_response"] = None
+            donation.processed = True
+            donation.save()
+            self.get_recurring_workers().submit(
+                    self.complete_recurring_purchase, donation, form,
+                    dict(result))
+            return result
         if donation.is_repeating:
-            response = self.recurring_purchase(donation, form)
-            result["recurring_response"] = response
+            result["recurring_response"] = self.get_recurring_response(
+                    donation, form)
         if result["status"]:
             donation.processed = True
             donation.save()
             self.send_successful_purchase(donation, form, result)
         return result
 
-    def get_api(self):
+    def get_recurring_response(self, donation, form):
+        """
+        Creates the subscription for ``donation`` and returns the response
+
+        The card has already been charged by then, so an error is logged
+        and returned as a failed response instead of being raised.
+        """
+        try:
+            return self.recurring_purchase(donation, form)
+        except Exception as e:
+            logger.exception("Unable to create the subscription for "
+                    "donation %s", donation.pk)
+            return {"status": False, "reason": u"%s" % e}
+
+    def get_recurring_workers(self):
+        return workers.get_pool("recurring", getattr(self.settings,
+                "ARMSTRONG_DONATIONS_RECURRING_WORKERS",
+                DEFAULT_RECURRING_WORKERS))
+
+    def complete_recurring_purchase(self, donation, form, result):
+        """
+        Creates the subscription for a deferred recurring purchase
+
+        ``successful_purchase`` is sent even if that fails, with the failed
+        ``recurring_response``, since the first charge went through.
+        """
+        result["recurring_response"] = self.get_recurring_response(donation,
+                form)
+        self.send_successful_purchase(donation, form, result)
+        return result
+
+    def build_api(self):
         return self.api_class(self.settings.AUTHORIZE["LOGIN"],
                 self.settings.AUTHORIZE["KEY"], delimiter=u"|",
                 is_test=self.testing)
 
-    def get_recurring_api(self):
+    def build_recurring_api(self):
         return self.recurring_api_class(self.settings.AUTHORIZE["LOGIN"],
                 self.settings.AUTHORIZE["KEY"], is_test=self.testing)
 
+    def get_pool_key(self, api_class):
+        return (api_class, self.settings.AUTHORIZE["LOGIN"],
+                self.settings.AUTHORIZE["KEY"], self.testing)
+
+    def get_api_pool(self):
+        return pools.get_pool(self.get_pool_key(self.api_class),
+                self.build_api, settings=self.settings, timeout=self.timeout)
+
+    def get_recurring_api_pool(self):
+        return pools.get_pool(self.get_pool_key(self.recurring_api_class),
+                self.build_recurring_api, settings=self.settings,
+                timeout=self.timeout)
+
+    def get_api(self):
+        pool = self.get_api_pool()
+        if pool:
+            return pool.acquire()
+        return pools.keep_alive(self.build_api(), timeout=self.timeout)
+
+    def get_recurring_api(self):
+        pool = self.get_recurring_api_pool()
+        if pool:
+            return pool.acquire()
+        return pools.keep_alive(self.build_recurring_api(),
+                timeout=self.timeout)
+
+    def release_api(self, api, recurring=False):
+        """
+        Hands a client from ``get_api`` or ``get_recurring_api`` back
+
+        Without a pool the client's connection is closed instead.
+        """
+        pool = (self.get_recurring_api_pool() if recurring
+                else self.get_api_pool())
+        if pool is not None:
+            pool.release(api)
+        else:
+            pools.close(api)
+
+    def get_circuit_breaker(self):
+        return breakers.get_breaker(
+                "authorize:%s" % self.settings.AUTHORIZE["LOGIN"],
+                settings=self.settings)
+
+    def is_available(self):
+        return self.get_circuit_breaker().allows_calls
+
+    def call_gateway(self, call, data, classify, recurring=False):
+        """
+        Sends ``data`` to the ``call`` method of a gateway client
+
+        ``classify`` turns the response into an ``(outcome, result_code,
+        reason_code)`` tuple, which is recorded with ``record_gateway_call``
+        and decides whether the call counts against the circuit breaker.
+        """
+        breaker = self.get_circuit_breaker()
+        breaker.before_call()
+        started = time.time()
+        api = None
+        try:
+            # Getting the client counts as part of the call, so a failure
+            # here doesn't hold on to a half-open probe
+            api = self.get_recurring_api() if recurring else self.get_api()
+            with timing.stage("gateway"):
+                response = getattr(api, call)(**data)
+        except Exception:
+            breaker.record_failure()
+            self.record_gateway_call(call, started, "error")
+            raise
+        finally:
+            if api is not None:
+                self.release_api(api, recurring=recurring)
+        outcome, result_code, reason_code = classify(response)
+        if outcome == "error" or time.time() - started > self.timeout:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        self.record_gateway_call(call, started, outcome,
+                result_code=result_code, reason_code=reason_code)
+        return response
+
     def recurring_purchase(self, donation, form):
         today = datetime.date.today()
         start_date = u"%s" % ((today + datetime.timedelta(days=30))
                 .strftime("%Y-%m-%d"))
-        api = self.get_recurring_api()
         data = form.get_data_for_charge(donation, recurring=True)
         data.update({
             "amount": donation.amount,
@@ -117,14 +299,13 @@ class AuthorizeNetBackend(Backend):
         })
         if self.testing:
             data["test_request"] = u"TRUE"
-        response = api.create_subscription(**data)
-        status = response["messages"]["result_code"]["text_"] == u"Ok"
+        response = self.call_gateway("create_subscription", data,
+                classify_subscription, recurring=True)
         return {
-            "status": status,
+            "status": response["messages"]["result_code"]["text_"] == u"Ok",
         }
 
     def onetime_purchase(self, donation, form):
-        api = self.get_api()
         data = form.get_data_for_charge(donation)
         donor = donation.donor
         if donation.donation_type:
@@ -150,17 +331,150 @@ class AuthorizeNetBackend(Backend):
         })
         if self.testing:
             data["test_request"] = u"TRUE"
-        response = api.transaction(**data)
-        status = response["reason_code"] == u"1"
+        response = self.call_gateway("transaction", data,
+                classify_transaction)
         return {
-            "status": status,
+            "status": response["reason_code"] == u"1",
             "reason": response["reason_text"],
             "response": response,
         }
 
 
+# AIM response code and ARB message code for "the gateway failed to process
+# this", as opposed to the card being declined.
+AIM_ERROR_CODE = u"3"
+ARB_ERROR_CODE = u"E00001"
+
+
+def classify_transaction(response):
+    """Returns ``(outcome, result_code, reason_code)`` for an AIM response"""
+    code = response.get("code", None)
+    if response["reason_code"] == u"1":
+        outcome = "approved"
+    elif code == AIM_ERROR_CODE:
+        outcome = "error"
+    else:
+        outcome = "declined"
+    return outcome, code, response["reason_code"]
+
+
+def classify_subscription(response):
+    """Returns ``(outcome, result_code, reason_code)`` for an ARB response"""
+    result_code = response["messages"]["result_code"]["text_"]
+    reason_code = get_message_code(response)
+    if result_code == u"Ok":
+        outcome = "approved"
+    elif reason_code == ARB_ERROR_CODE:
+        outcome = "error"
+    else:
+        outcome = "declined"
+    return outcome, result_code, reason_code
+
+
+# AIM reason codes sent with ``AIM_ERROR_CODE`` when the gateway or the
+# processor had a temporary problem ("please try again in 5 minutes").
+AIM_TRANSIENT_REASON_CODES = (u"19", u"20", u"21", u"22", u"23", u"25",
+        u"26", u"57", u"58", u"59", u"60", u"61", u"62", u"63", )
+
+# Socket errors raised before a request reaches the gateway
+UNREACHABLE_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+        errno.ENETUNREACH, )
+
+# HTTP statuses from a proxy or server that didn't pass the request on.  A
+# 500 or 504 may come after the gateway has processed it.
+TRANSIENT_HTTP_STATUSES = (502, 503, )
+
+TRANSIENT = "transient"
+HARD = "hard"
+
+
+def classify_failure(result):
+    """
+    Returns ``TRANSIENT`` or ``HARD`` for a failed ``purchase`` result
+
+    Only gateway errors that Authorize.net asks to be tried again later are
+    transient.  Declines and everything else are hard failures.
+    """
+    response = result.get("response", None) or {}
+    if (response.get("code", None) == AIM_ERROR_CODE and
+            response.get("reason_code", None) in AIM_TRANSIENT_REASON_CODES):
+        return TRANSIENT
+    return HARD
+
+
+def is_transient_error(e):
+    """
+    Returns ``True`` if the purchase that raised ``e`` is safe to retry
+
+    That is when the gateway was never reached (an open circuit, a failed
+    connection) or answered with one of ``TRANSIENT_HTTP_STATUSES``.
+    Timeouts, other server errors and other errors part way through a
+    request are not: the charge may have gone through.
+    """
+    if isinstance(e, (breakers.CircuitOpen, pools.GatewayUnreachable,
+            socket.gaierror)):
+        return True
+    if isinstance(e, pools.GatewayHTTPError):
+        return e.status in TRANSIENT_HTTP_STATUSES
+    return isinstance(e, socket.error) and e.errno in UNREACHABLE_ERRNOS
+
+
+def get_message_code(response):
+    """Returns the first message code from an ARB response, if there is one"""
+    try:
+        message = response["messages"]["message"]
+        if isinstance(message, list):
+            message = message[0]
+        return message["code"]["text_"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
 raw_backend = GenericBackend("ARMSTRONG_DONATIONS_BACKEND", defaults=[
     "armstrong.apps.donations.backends.AuthorizeNetBackend",
 ])
 
-get_backend = raw_backend.get_backend
+# Settings that change which backend gets built or how it is configured.  The
+# cached backend is rebuilt whenever any of them change.
+BACKEND_SETTINGS = (
+    "ARMSTRONG_DONATIONS_BACKEND",
+    "AUTHORIZE",
+    "ARMSTRONG_DONATIONS_TESTING",
+    "ARMSTRONG_DONATIONS_DEFER_RECURRING",
+    "ARMSTRONG_DONATIONS_CIRCUIT_BREAKER",
+    "ARMSTRONG_DONATIONS_ROUTING",
+)
+
+_backend_cache = {}
+_backend_cache_lock = threading.Lock()
+
+
+def get_backend_cache_key():
+    return tuple(repr(getattr(django_settings, a, None))
+            for a in BACKEND_SETTINGS)
+
+
+def get_backend(*args, **kwargs):
+    """
+    Returns the configured backend, reusing it across calls
+
+    Resolving ``ARMSTRONG_DONATIONS_BACKEND`` and building the backend
+    happens once per process for each distinct configuration.  Any
+    arguments are passed on to the backend's constructor, in which case a
+    new, uncached backend is returned.
+    """
+    if args or kwargs:
+        return raw_backend.get_backend(*args, **kwargs)
+    key = get_backend_cache_key()
+    backend = _backend_cache.get(key, None)
+    if backend is None:
+        with _backend_cache_lock:
+            _backend_cache.clear()
+            backend = _backend_cache[key] = raw_backend.get_backend()
+    return backend
+
+
+def clear_backend_cache():
+    """Forgets the cached backend so the next ``get_backend`` rebuilds it"""
+    with _backend_cache_lock:
+        _backend_cache.clear()
@@ -0,0 +1,316 @@
+"""
+Benchmarks for the donation pipeline
+
+Each benchmark times one stage on its own:
+
+* ``form_construction``: building an ``AuthorizeDonationForm`` from POST data
+* ``form_validation``: building and validating it
+* ``form_save``: ``BaseDonationForm.save()`` of a validated form
+* ``backend_purchase``: ``AuthorizeNetBackend.purchase`` against a gateway
+  stub that answers in-process
+* ``view_get`` and ``view_post``: ``DonationFormView`` end to end, including
+  rendering its template
+
+Every iteration does the same work, and the gateway never leaves the
+process.  That way runs on the same machine can be compared.  Besides
+timings, each result records the queries and the net number of
+garbage-collected objects allocated by one iteration.
+
+Run them with the ``benchmark_donations`` command, which uses a throwaway
+test database.  Use ``--output`` to save the results as JSON, and
+``--baseline`` to compare them against an earlier run::
+
+    manage.py benchmark_donations --output baseline.json
+    manage.py benchmark_donations --baseline baseline.json
+"""
+from contextlib import contextmanager
+import datetime
+import django
+from django.conf import settings
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.db import reset_queries
+from django.test.client import RequestFactory
+import gc
+import math
+import platform
+from timeit import default_timer
+
+from . import backends
+from . import queries
+from . import simulator
+from . import views
+
+DEFAULT_ITERATIONS = 100
+DEFAULT_WARMUP = 5
+DEFAULT_TOLERANCE = 0.25
+STUB_BACKEND = "armstrong.apps.donations.benchmarks.StubAuthorizeNetBackend"
+
+
+class StubAuthorizeNetBackend(backends.AuthorizeNetBackend):
+    """``AuthorizeNetBackend`` whose gateway approves everything in-process"""
+    def __init__(self, api_class=None, recurring_api_class=None, **kwargs):
+        super(StubAuthorizeNetBackend, self).__init__(
+                api_class=api_class or simulator.StubAimApi,
+                recurring_api_class=recurring_api_class or
+                        simulator.StubArbApi,
+                **kwargs)
+
+
+def get_form_data():
+    """Returns the POST data of a valid one-time donation"""
+    next_year = datetime.date.today().year + 1
+    return {
+        "first_name": u"Benchmark",
+        "last_name": u"Donor",
+        "amount": u"25.00",
+        "card_number": u"4222222222222222",
+        "ccv_code": u"123",
+        "expiration_month": u"01",
+        "expiration_year": u"%04d" % next_year,
+        "billing-address": u"123 Some St",
+        "billing-city": u"Anytown",
+        "billing-state": u"TX",
+        "billing-zipcode": u"78701",
+        "mailing_same_as_billing": u"1",
+    }
+
+
+@contextmanager
+def stub_backend():
+    """Makes ``backends.get_backend`` return a ``StubAuthorizeNetBackend``"""
+    missing = object()
+    previous = getattr(settings, "ARMSTRONG_DONATIONS_BACKEND", missing)
+    settings.ARMSTRONG_DONATIONS_BACKEND = STUB_BACKEND
+    try:
+        yield
+    finally:
+        if previous is missing:
+            del settings.ARMSTRONG_DONATIONS_BACKEND
+        else:
+            settings.ARMSTRONG_DONATIONS_BACKEND = previous
+        backends.clear_backend_cache()
+
+
+class Benchmark(object):
+    """
+    One stage of the pipeline to time
+
+    ``setup`` runs once.  ``prepare`` runs before every iteration without
+    being timed, and whatever it returns is passed to the timed ``run``.
+    """
+    name = None
+
+    def setup(self):
+        self.data = get_form_data()
+        self.backend = backends.get_backend()
+        self.factory = RequestFactory()
+
+    def prepare(self):
+        return None
+
+    def run(self, prepared):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+    def build_form(self):
+        return self.backend.get_form_class()(data=self.data)
+
+    def build_valid_form(self):
+        form = self.build_form()
+        if not form.is_valid():
+            raise ValueError("Benchmark form is invalid: %s" % form.errors)
+        return form
+
+
+class FormConstruction(Benchmark):
+    name = "form_construction"
+
+    def run(self, prepared):
+        self.build_form()
+
+
+class FormValidation(Benchmark):
+    name = "form_validation"
+
+    def run(self, prepared):
+        self.build_form().is_valid()
+
+
+class FormSave(Benchmark):
+    name = "form_save"
+
+    def prepare(self):
+        return self.build_valid_form()
+
+    def run(self, form):
+        form.save()
+
+
+class BackendPurchase(Benchmark):
+    name = "backend_purchase"
+
+    def prepare(self):
+        form = self.build_valid_form()
+        return form.save(), form
+
+    def run(self, prepared):
+        result = self.backend.purchase(*prepared)
+        if not result["status"]:
+            raise ValueError("Benchmark purchase failed: %s" %
+                    result["reason"])
+
+
+class ViewGet(Benchmark):
+    name = "view_get"
+
+    def setup(self):
+        super(ViewGet, self).setup()
+        self.view = views.DonationFormView.as_view()
+
+    def run(self, prepared):
+        self.view(self.factory.get("/")).render()
+
+
+class ViewPost(ViewGet):
+    name = "view_post"
+
+    def run(self, prepared):
+        response = self.view(self.factory.post("/", self.data))
+        if response.status_code != 302:
+            raise ValueError("Benchmark POST was not redirected")
+
+
+BENCHMARKS = (FormConstruction, FormValidation, FormSave, BackendPurchase,
+        ViewGet, ViewPost, )
+
+
+def get_benchmarks(names=None):
+    if not names:
+        return list(BENCHMARKS)
+    by_name = dict((a.name, a) for a in BENCHMARKS)
+    unknown = [a for a in names if a not in by_name]
+    if unknown:
+        raise ValueError("Unknown benchmark(s): %s" % ", ".join(unknown))
+    return [by_name[a] for a in names]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    count = len(timings)
+    mean = sum(timings) / count
+    middle = count // 2
+    median = timings[middle] if count % 2 else \
+            (timings[middle - 1] + timings[middle]) / 2
+    variance = sum((a - mean) ** 2 for a in timings) / count
+    return {
+        "iterations": count,
+        "mean": mean,
+        "median": median,
+        "min": timings[0],
+        "max": timings[-1],
+        "stdev": math.sqrt(variance),
+        "per_second": 1 / median if median else 0.0,
+    }
+
+
+def measure(benchmark, iterations=DEFAULT_ITERATIONS, warmup=DEFAULT_WARMUP,
+        using=DEFAULT_DB_ALIAS):
+    """
+    Times ``iterations`` runs of ``benchmark`` after ``warmup`` untimed ones
+
+    One more run counts the queries and the objects allocated, with the
+    garbage collector paused so the count isn't reset part way.
+    """
+    benchmark.setup()
+    try:
+        for i in range(warmup):
+            benchmark.run(benchmark.prepare())
+        timings = []
+        for i in range(iterations):
+            reset_queries()
+            prepared = benchmark.prepare()
+            started = default_timer()
+            benchmark.run(prepared)
+            timings.append(default_timer() - started)
+        prepared = benchmark.prepare()
+        enabled = gc.isenabled()
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.get_count()[0]
+            with queries.QueryCounter(using) as counter:
+                benchmark.run(prepared)
+            objects = gc.get_count()[0] - before
+        finally:
+            if enabled:
+                gc.enable()
+    finally:
+        benchmark.teardown()
+    result = summarize(timings)
+    result.update({
+        "queries": counter.count,
+        "objects": objects,
+    })
+    return result
+
+
+def get_environment(using=DEFAULT_DB_ALIAS):
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connections[using].vendor,
+        "platform": platform.platform(),
+        "created": datetime.datetime.now().isoformat(),
+    }
+
+
+def run(names=None, iterations=DEFAULT_ITERATIONS, warmup=DEFAULT_WARMUP,
+        using=DEFAULT_DB_ALIAS):
+    """
+    Runs the benchmarks called ``names`` (or all of them)
+
+    Returns a dictionary that can be saved as JSON, with the ``environment``
+    and a ``results`` dictionary keyed by benchmark name.
+    """
+    results = {}
+    with stub_backend():
+        for benchmark_class in get_benchmarks(names):
+            results[benchmark_class.name] = measure(benchmark_class(),
+                    iterations=iterations, warmup=warmup, using=using)
+    return {
+        "environment": get_environment(using),
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares two ``run`` results, benchmark by benchmark
+
+    Returns a list of dictionaries, one for each metric of each benchmark
+    found in both.  ``regressed`` is set when the median time or the
+    objects grew by more than ``tolerance`` (a fraction), or when any more
+    queries were run.
+    """
+    comparisons = []
+    for name in sorted(current["results"]):
+        if name not in baseline["results"]:
+            continue
+        now = current["results"][name]
+        then = baseline["results"][name]
+        for metric, allowed in (("median", tolerance), ("queries", 0),
+                ("objects", tolerance)):
+            change = ((now[metric] - then[metric]) / float(then[metric])
+                    if then[metric] else 0.0)
+            comparisons.append({
+                "benchmark": name,
+                "metric": metric,
+                "baseline": then[metric],
+                "current": now[metric],
+                "change": change,
+                "regressed": now[metric] > then[metric] * (1 + allowed),
+            })
+    return comparisons
@@ -0,0 +1,127 @@
+"""
+Circuit breakers for payment gateways
+
+When a gateway degrades, every purchase waits for it to time out and web
+workers pile up behind it.  A ``CircuitBreaker`` counts failed (or too slow)
+gateway calls.  Once ``failure_threshold`` of them happen in a row it opens,
+and calls fail straight away with ``CircuitOpen``.  After ``reset_timeout``
+seconds it lets ``half_open_calls`` probe calls through.  A successful probe
+closes the circuit again, a failed one re-opens it.
+
+Configured with::
+
+    ARMSTRONG_DONATIONS_CIRCUIT_BREAKER = {
+        "FAILURE_THRESHOLD": 5,
+        "RESET_TIMEOUT": 30,    # seconds
+        "HALF_OPEN_CALLS": 1,
+        "TIMEOUT": 20,          # seconds each gateway call may take
+    }
+"""
+from django.conf import settings as django_settings
+import threading
+import time
+
+DEFAULTS = {
+    "FAILURE_THRESHOLD": 5,
+    "RESET_TIMEOUT": 30,
+    "HALF_OPEN_CALLS": 1,
+    "TIMEOUT": 20,
+}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a gateway whose circuit is open"""
+    pass
+
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=DEFAULTS["FAILURE_THRESHOLD"],
+            reset_timeout=DEFAULTS["RESET_TIMEOUT"],
+            half_open_calls=DEFAULTS["HALF_OPEN_CALLS"], clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probes = 0
+        self.opened_at = None
+
+    def before_call(self):
+        """Raises ``CircuitOpen`` if the call should not be attempted"""
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpen("Circuit opened %.0f seconds ago" % (
+                            self.clock() - self.opened_at))
+                self.state = self.HALF_OPEN
+                self.probes = 0
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    raise CircuitOpen("Waiting on probe call")
+                self.probes += 1
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probes = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN
+
+    @property
+    def allows_calls(self):
+        """``False`` while ``before_call`` would raise ``CircuitOpen``"""
+        with self.lock:
+            if self.state == self.OPEN:
+                return self.clock() - self.opened_at >= self.reset_timeout
+            if self.state == self.HALF_OPEN:
+                return self.probes < self.half_open_calls
+            return True
+
+
+def get_breaker_settings(settings=None):
+    if settings is None:
+        settings = django_settings
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, "ARMSTRONG_DONATIONS_CIRCUIT_BREAKER",
+            {}))
+    return config
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, settings=None):
+    """Returns the process-wide ``CircuitBreaker`` called ``name``"""
+    config = get_breaker_settings(settings)
+    key = (name, config["FAILURE_THRESHOLD"], config["RESET_TIMEOUT"],
+            config["HALF_OPEN_CALLS"])
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(
+                    failure_threshold=config["FAILURE_THRESHOLD"],
+                    reset_timeout=config["RESET_TIMEOUT"],
+                    half_open_calls=config["HALF_OPEN_CALLS"])
+        return _breakers[key]
+
+
+def clear_breakers():
+    with _breakers_lock:
+        _breakers.clear()
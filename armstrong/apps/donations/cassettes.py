@@ -0,0 +1,276 @@
+"""
+Recorded gateway exchanges for tests that run without network access
+
+A ``Cassette`` sits between an ``authorize`` API class and the network.  While
+recording, each request is sent to the gateway as usual and saved with its
+response to a JSON file.  While replaying, nothing leaves the process: each
+request is answered with the next response recorded for the same path.  The
+request has to match the recorded one once scrubbed, so a change to what is
+sent to the gateway fails the test instead of replaying a stale answer.
+Values that change from run to run, such as an ARB subscription's
+``startDate``, can be left out of the comparison with ``ignore``.
+``wrap`` turns an API class into one that goes through the cassette, so it can
+be handed to ``AuthorizeNetBackend`` as its ``api_class`` or
+``recurring_api_class``::
+
+    with Cassette("cassettes/aim_transaction.json") as cassette:
+        backend = AuthorizeNetBackend(api_class=cassette.wrap(aim.Api))
+        backend.purchase(donation, form)
+
+The mode is ``"replay"``, ``"record"`` or ``"once"``.  ``"once"`` replays the
+file if it exists and records it otherwise.  If no mode is passed, the
+``ARMSTRONG_DONATIONS_CASSETTES`` environment variable is used, and
+``"replay"`` if it isn't set, so a missing cassette fails the test instead of
+quietly reaching the network.  Run the tests with
+``ARMSTRONG_DONATIONS_CASSETTES=once`` to record new cassettes, or with
+``ARMSTRONG_DONATIONS_CASSETTES=record`` to record every cassette again
+against the gateway.
+
+Card numbers, card codes, expiration dates and the merchant's credentials
+are scrubbed from requests before they are saved.  Responses are saved as
+they were received: the gateway only sends back the last four digits of the
+card.
+"""
+import httplib
+import json
+import os
+import re
+import threading
+import urllib
+import urlparse
+
+MODES = ("replay", "record", "once", )
+DEFAULT_MODE = "replay"
+MASK = u"XXXX"
+
+# AIM fields and ARB elements that are never saved
+SCRUBBED_FIELDS = ("x_login", "x_tran_key", "x_card_num", "x_card_code",
+        "x_exp_date", )
+SCRUBBED_ELEMENTS = ("name", "transactionKey", "cardNumber", "cardCode",
+        "expirationDate", )
+
+
+class CassetteError(Exception):
+    """Raised when a recording is missing or a request doesn't match it"""
+    pass
+
+
+def get_mode():
+    return os.environ.get("ARMSTRONG_DONATIONS_CASSETTES", DEFAULT_MODE)
+
+
+def mask_card_number(value):
+    return MASK + value[-4:]
+
+
+def scrub_aim(body, ignore=()):
+    """
+    Masks the card and credentials in a form encoded AIM request
+
+    The fields in ``ignore`` are masked too.
+    """
+    fields = []
+    for k, v in urlparse.parse_qsl(body, keep_blank_values=True):
+        if k == "x_card_num":
+            v = mask_card_number(v)
+        elif k in SCRUBBED_FIELDS or k in ignore:
+            v = MASK
+        fields.append((k, v))
+    return urllib.urlencode(fields).decode("utf-8")
+
+
+def scrub_arb(body, ignore=()):
+    """
+    Masks the card and credentials in an ARB XML request
+
+    The elements in ``ignore`` are masked too.
+    """
+    if isinstance(body, str):
+        body = body.decode("utf-8")
+
+    def mask(match):
+        element, value = match.groups()
+        value = (mask_card_number(value) if element == "cardNumber"
+                else MASK)
+        return u"<%s>%s</%s>" % (element, value, element)
+    return re.sub(r"<(%s)>([^<]*)</\1>" % "|".join(SCRUBBED_ELEMENTS +
+            tuple(ignore)), mask, body)
+
+
+def scrub(body, ignore=()):
+    if body.lstrip().startswith("<"):
+        return scrub_arb(body, ignore=ignore)
+    return scrub_aim(body, ignore=ignore)
+
+
+def normalize(body, ignore=()):
+    """
+    Returns ``body`` scrubbed, in a form that can be compared
+
+    AIM fields are sorted, as their order depends on a ``dict``.
+    """
+    body = scrub(body, ignore=ignore)
+    if body.lstrip().startswith("<"):
+        return body
+    return sorted(urlparse.parse_qsl(body, keep_blank_values=True))
+
+
+class RecordedResponse(object):
+    def __init__(self, status, content):
+        self.status = status
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+class CassetteConnection(object):
+    """
+    Stands in for an ``httplib`` connection, going through a ``Cassette``
+
+    While recording, requests are passed on to a real connection of the
+    cassette's ``connection_class``.
+    """
+    def __init__(self, cassette, host, timeout=None):
+        self.cassette = cassette
+        self.host = host
+        self.timeout = timeout
+        self.connection = None
+        self.response = None
+
+    def get_connection(self):
+        if self.connection is None:
+            if self.timeout is None:
+                self.connection = self.cassette.connection_class(self.host)
+            else:
+                self.connection = self.cassette.connection_class(self.host,
+                        timeout=self.timeout)
+        return self.connection
+
+    def connect(self):
+        if self.cassette.is_recording:
+            self.get_connection().connect()
+
+    def request(self, method, path, body, headers=None):
+        if not self.cassette.is_recording:
+            self.response = self.cassette.play(path, body)
+            return
+        connection = self.get_connection()
+        connection.request(method, path, body, headers=headers or {})
+        response = connection.getresponse()
+        self.response = RecordedResponse(response.status, response.read())
+        self.cassette.record(path, body, self.response)
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class CassetteApiMixin(object):
+    """Sends an ``authorize`` API's requests through ``cassette``"""
+    cassette = None
+
+    def connection_class(self, host, timeout=None):
+        return CassetteConnection(self.cassette, host, timeout=timeout)
+
+    def request(self, body):
+        connection = self.connection_class(self.server)
+        connection.request("POST", self.path, body, headers=self.headers)
+        return self.parse_response(connection.getresponse().read())
+
+
+class Cassette(object):
+    """
+    The exchanges with a gateway saved in the JSON file at ``path``
+
+    ``connection_class`` is used to reach the gateway while recording.
+    Recordings are saved when the ``with`` block exits without an error, or
+    by calling ``save``.  The AIM fields and ARB elements in ``ignore`` may
+    differ between a replayed request and the recorded one.
+    """
+    def __init__(self, path, mode=None,
+            connection_class=httplib.HTTPSConnection, ignore=()):
+        if mode is None:
+            mode = get_mode()
+        if mode not in MODES:
+            raise ValueError("Unknown cassette mode %s, use one of %s" % (
+                    mode, ", ".join(MODES)))
+        if mode == "once":
+            mode = "replay" if os.path.exists(path) else "record"
+        self.path = path
+        self.mode = mode
+        self.connection_class = connection_class
+        self.ignore = tuple(ignore)
+        self.interactions = []
+        self.played = set()
+        self.lock = threading.Lock()
+        if mode == "replay":
+            self.load()
+
+    @property
+    def is_recording(self):
+        return self.mode == "record"
+
+    def wrap(self, api_class):
+        """Returns a subclass of ``api_class`` that uses this cassette"""
+        return type("Cassette%s" % api_class.__name__,
+                (CassetteApiMixin, api_class), {"cassette": self})
+
+    def record(self, path, body, response):
+        with self.lock:
+            self.interactions.append({
+                "path": path,
+                "request": scrub(body),
+                "status": response.status,
+                "response": response.content.decode("utf-8"),
+            })
+
+    def play(self, path, body):
+        """
+        Returns the first response recorded for ``path`` not played yet
+
+        Raises ``CassetteError`` if the request it was recorded for differs
+        from ``body``.
+        """
+        with self.lock:
+            for i, interaction in enumerate(self.interactions):
+                if i not in self.played and interaction["path"] == path:
+                    self.played.add(i)
+                    break
+            else:
+                raise CassetteError("No recorded response to %s left in "
+                        "%s" % (path, self.path))
+        if (normalize(interaction["request"], ignore=self.ignore) !=
+                normalize(body, ignore=self.ignore)):
+            raise CassetteError("Request to %s doesn't match the one "
+                    "recorded in %s:\n%s\n%s" % (path, self.path,
+                    interaction["request"], scrub(body)))
+        return RecordedResponse(interaction["status"],
+                interaction["response"].encode("utf-8"))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise CassetteError("No cassette at %s, record it with "
+                    "ARMSTRONG_DONATIONS_CASSETTES=once" % self.path)
+        with open(self.path) as f:
+            self.interactions = json.load(f)["interactions"]
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, "w") as f:
+            json.dump({"interactions": self.interactions}, f, indent=2,
+                    separators=(",", ": "), sort_keys=True)
+            f.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.is_recording and exc_type is None:
+            self.save()
@@ -0,0 +1,217 @@
+"""
+Running ``successful_purchase`` receivers after the response
+
+Receivers that send receipts or talk to other services don't need to hold
+up the donor's redirect.  Flag them with ``signals.deferrable``::
+
+    @deferrable
+    def send_receipt(sender, donation, **kwargs):
+        ...
+
+    successful_purchase.connect(send_receipt, dispatch_uid="send_receipt")
+
+Then choose where flagged receivers run with
+``ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS``:
+
+* ``None`` (the default): inline, like every other receiver
+* ``"threads"``: on a pool of ``ARMSTRONG_DONATIONS_DEFERRED_WORKERS``
+  background threads (default ``2``) in the same process, with the same
+  arguments as usual
+* ``"database"``: recorded as ``DeferredReceiverTask`` rows and run by the
+  ``run_deferred_receivers`` command.  Those receivers are called with
+  ``sender=None``, ``form=None`` and ``result`` as it was stored in JSON.
+
+A receiver that raises is logged and tried again up to
+``ARMSTRONG_DONATIONS_DEFERRED_RETRIES`` times (default ``3``).  It waits
+``ARMSTRONG_DONATIONS_DEFERRED_BACKOFF`` seconds (default ``5``) before the
+first retry, twice that before the second, and so on.  Receivers may run
+more than once, so they should be idempotent.
+
+A task still running ``ARMSTRONG_DONATIONS_DEFERRED_LEASE`` seconds (default
+``300``) after it was claimed is taken to belong to a runner that died.  It
+is run again, counting the lost run as a failed attempt, so the lease should
+be longer than any receiver takes.
+"""
+import datetime
+from decimal import Decimal
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+from django.utils.importlib import import_module
+import json
+import logging
+import time
+import traceback
+
+from . import models
+from . import signals
+from . import workers
+
+MODES = ("threads", "database", )
+DEFAULT_WORKERS = 2
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 5
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_LEASE = 300
+LOST_RUN_ERROR = u"The runner stopped before the receiver finished"
+
+logger = logging.getLogger(__name__)
+
+
+def get_mode():
+    mode = getattr(settings, "ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS", None)
+    if mode is not None and mode not in MODES:
+        raise ImproperlyConfigured("ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS "
+                "must be None or one of %s" % ", ".join(MODES))
+    return mode
+
+
+def get_retries():
+    return getattr(settings, "ARMSTRONG_DONATIONS_DEFERRED_RETRIES",
+            DEFAULT_RETRIES)
+
+
+def get_backoff(attempt):
+    """Seconds to wait after failed attempt number ``attempt``"""
+    return getattr(settings, "ARMSTRONG_DONATIONS_DEFERRED_BACKOFF",
+            DEFAULT_BACKOFF) * 2 ** (attempt - 1)
+
+
+def get_lease():
+    return getattr(settings, "ARMSTRONG_DONATIONS_DEFERRED_LEASE",
+            DEFAULT_LEASE)
+
+
+def get_workers():
+    return workers.get_pool("receivers", getattr(settings,
+            "ARMSTRONG_DONATIONS_DEFERRED_WORKERS", DEFAULT_WORKERS))
+
+
+def get_receiver_path(receiver):
+    return "%s.%s" % (receiver.__module__, receiver.__name__)
+
+
+def get_receiver(path):
+    module, attr = path.rsplit(".", 1)
+    return getattr(import_module(module), attr)
+
+
+def to_json(value):
+    """Turns ``value`` into something ``json.dumps`` accepts"""
+    if isinstance(value, dict):
+        return dict((u"%s" % k, to_json(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_json(a) for a in value]
+    if value is None or isinstance(value, (bool, int, long, float,
+            basestring)):
+        return value
+    if isinstance(value, Decimal):
+        return u"%s" % value
+    return u"%s" % (value, )
+
+
+def defer(receiver, signal, sender, named):
+    """Schedules ``receiver`` according to the configured mode"""
+    if get_mode() == "database":
+        return models.DeferredReceiverTask.objects.create(
+                receiver=get_receiver_path(receiver),
+                donation=named["donation"],
+                result=json.dumps(to_json(named.get("result", None))))
+    get_workers().submit(call_with_retries, receiver, signal, sender, named)
+
+
+def call_with_retries(receiver, signal, sender, named, sleep=time.sleep):
+    """Calls ``receiver`` until it succeeds or runs out of retries"""
+    retries = get_retries()
+    for attempt in range(1, retries + 2):
+        try:
+            receiver(signal=signal, sender=sender, **named)
+            return True
+        except Exception:
+            logger.exception("Deferred receiver %s failed (attempt %d)",
+                    get_receiver_path(receiver), attempt)
+        if attempt <= retries:
+            sleep(get_backoff(attempt))
+    logger.error("Giving up on deferred receiver %s for donation %s",
+            get_receiver_path(receiver),
+            getattr(named.get("donation", None), "pk", None))
+    return False
+
+
+def run_task(task, now=None):
+    """Runs a claimed ``DeferredReceiverTask`` and records the outcome"""
+    if now is None:
+        now = datetime.datetime.now()
+    task.attempts += 1
+    try:
+        get_receiver(task.receiver)(signal=signals.successful_purchase,
+                sender=None, donation=task.donation, form=None,
+                result=json.loads(task.result) if task.result else None)
+    except Exception:
+        logger.exception("Deferred receiver %s failed (attempt %d)",
+                task.receiver, task.attempts)
+        task.last_error = traceback.format_exc()
+        if task.attempts > get_retries():
+            logger.error("Giving up on deferred receiver %s for donation "
+                    "%s", task.receiver, task.donation_id)
+            task.status = task.FAILED
+        else:
+            task.status = task.PENDING
+            task.run_at = now + datetime.timedelta(
+                    seconds=get_backoff(task.attempts))
+    else:
+        task.status = task.SUCCEEDED
+    task.save()
+    return task
+
+
+def reclaim_stale(now=None):
+    """
+    Hands back tasks that have been ``RUNNING`` for longer than the lease
+
+    Each counts as a failed attempt, so a task whose runner keeps dying is
+    failed once it is out of retries like any other.  Returns the number
+    of tasks reclaimed.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    Task = models.DeferredReceiverTask
+    stale = Task.objects.filter(status=Task.RUNNING,
+            updated__lt=now - datetime.timedelta(seconds=get_lease()))
+    failed = stale.filter(attempts__gte=get_retries()).update(
+            status=Task.FAILED, attempts=F("attempts") + 1,
+            last_error=LOST_RUN_ERROR, updated=now)
+    reclaimed = stale.update(status=Task.PENDING,
+            attempts=F("attempts") + 1, last_error=LOST_RUN_ERROR,
+            run_at=now, updated=now)
+    if failed or reclaimed:
+        logger.warning("Reclaimed %d deferred receiver(s) from runners that "
+                "stopped, giving up on %d", reclaimed, failed)
+    return failed + reclaimed
+
+
+def run_pending(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """
+    Runs up to ``batch_size`` tasks that are due
+
+    Each task is claimed with a conditional ``UPDATE`` first, so several
+    processes can drain the table at once.  Tasks left ``RUNNING`` by a
+    runner that died are reclaimed first (see ``reclaim_stale``).  Returns
+    the number run.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    reclaim_stale(now=now)
+    due = list(models.DeferredReceiverTask.objects.filter(
+            status=models.DeferredReceiverTask.PENDING, run_at__lte=now)
+            .select_related("donation").order_by("run_at")[:batch_size])
+    count = 0
+    for task in due:
+        claimed = models.DeferredReceiverTask.objects.filter(pk=task.pk,
+                status=models.DeferredReceiverTask.PENDING).update(
+                        status=models.DeferredReceiverTask.RUNNING,
+                        updated=now)
+        if claimed:
+            run_task(task, now=now)
+            count += 1
+    return count
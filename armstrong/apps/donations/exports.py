@@ -0,0 +1,173 @@
+"""
+Streaming exports of donations with their donor, address, type and code
+
+Donations are read in primary key order, ``chunk_size`` rows at a time, with
+a single joined ``values()`` query per chunk.  No model instances are built
+and only one chunk is held in memory, so exports of any size run in flat
+memory.  Every chunk ends on a watermark (the last primary key written); pass
+it back as ``after`` to resume an interrupted export.
+
+Use the ``export_donations`` management command, or route ``ExportView``
+yourself (it is limited to staff members)::
+
+    url(r"^donations/export/$", ExportView.as_view()),
+"""
+import csv
+import datetime
+from decimal import Decimal
+from django.contrib.auth.decorators import user_passes_test
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.utils.decorators import method_decorator
+from django.views.generic import View
+import json
+from StringIO import StringIO
+
+from . import models
+
+DEFAULT_CHUNK_SIZE = 1000
+FORMATS = ("csv", "jsonl", )
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+# Output column and the ``values()`` lookup it is read from
+EXPORT_FIELDS = (
+    ("id", "pk"),
+    ("created", "created"),
+    ("amount", "amount"),
+    ("processed", "processed"),
+    ("anonymous", "anonymous"),
+    ("attribution", "attribution"),
+    ("donor_id", "donor"),
+    ("first_name", "donor__first_name"),
+    ("last_name", "donor__last_name"),
+    ("email", "donor__email"),
+    ("phone", "donor__phone"),
+    ("address", "donor__address__address"),
+    ("city", "donor__address__city"),
+    ("state", "donor__address__state"),
+    ("zipcode", "donor__address__zipcode"),
+    ("mailing_address", "donor__mailing_address__address"),
+    ("mailing_city", "donor__mailing_address__city"),
+    ("mailing_state", "donor__mailing_address__state"),
+    ("mailing_zipcode", "donor__mailing_address__zipcode"),
+    ("donation_type", "donation_type__donation_type__name"),
+    ("donation_type_option_id", "donation_type"),
+    ("promo_code", "code__code"),
+)
+COLUMNS = [a for a, b in EXPORT_FIELDS]
+
+
+def iter_chunks(queryset=None, after=None, since=None,
+        chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields lists of export rows, each at most ``chunk_size`` long
+
+    Only donations with a primary key greater than ``after`` and, if
+    ``since`` is given, created on or after it are included.
+    """
+    if queryset is None:
+        queryset = models.Donation.objects.all()
+    if since is not None:
+        queryset = queryset.filter(created__gte=since)
+    lookups = [b for a, b in EXPORT_FIELDS]
+    last_pk = after or 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by("pk")
+                .values(*lookups)[:chunk_size])
+        if not rows:
+            return
+        last_pk = rows[-1]["pk"]
+        yield [dict((a, row[b]) for a, b in EXPORT_FIELDS) for row in rows]
+
+
+def to_text(value):
+    if value is None:
+        return u""
+    if isinstance(value, bool):
+        return u"1" if value else u"0"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return u"%s" % value
+
+
+def to_json(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return u"%s" % value
+    return value
+
+
+def format_csv(rows, header=False):
+    """Returns ``rows`` as UTF-8 encoded CSV"""
+    out = StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow([to_text(row[a]).encode("utf-8") for a in COLUMNS])
+    return out.getvalue()
+
+
+def format_jsonl(rows, header=False):
+    """Returns ``rows`` as one JSON object per line"""
+    return "".join("%s\n" % json.dumps(dict((a, to_json(row[a]))
+            for a in COLUMNS)) for row in rows)
+
+
+FORMATTERS = {
+    "csv": format_csv,
+    "jsonl": format_jsonl,
+}
+
+
+def export(format="csv", **kwargs):
+    """
+    Yields the export in ``format`` one chunk at a time
+
+    Keyword arguments are passed on to ``iter_chunks``.
+    """
+    formatter = FORMATTERS[format]
+    header = True
+    for rows in iter_chunks(**kwargs):
+        yield formatter(rows, header=header)
+        header = False
+    if header:
+        yield formatter([], header=True)
+
+
+class ExportView(View):
+    """
+    Streams an export of donations
+
+    Accepts ``format`` (``csv`` or ``jsonl``), ``after`` (a primary key to
+    resume from) and ``since`` (``YYYY-MM-DD``) as query parameters.  The
+    response is built from a generator, so it is only streamed if no
+    middleware reads its whole content (``GZipMiddleware`` and ETags do).
+    """
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    @method_decorator(user_passes_test(lambda u: u.is_staff))
+    def dispatch(self, *args, **kwargs):
+        return super(ExportView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get("format", "csv")
+        if format not in FORMATS:
+            return HttpResponseBadRequest("Unknown format: %s" % format)
+        try:
+            after = int(request.GET.get("after", 0))
+            since = request.GET.get("since", None) or None
+            if since is not None:
+                since = datetime.datetime.strptime(since, "%Y-%m-%d")
+        except ValueError:
+            return HttpResponseBadRequest("Invalid after or since value")
+        response = HttpResponse(export(format, after=after, since=since,
+                chunk_size=self.chunk_size),
+                content_type=CONTENT_TYPES[format])
+        response["Content-Disposition"] = \
+                "attachment; filename=donations.%s" % format
+        return response
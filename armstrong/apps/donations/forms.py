@@ -2,18 +2,24 @@ from copy import copy
 from django import forms
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+import logging
 
 from .constants import MONTH_CHOICES
 from .constants import YEAR_CHOICES
 from .constants import MAILING_SAME_AS_BILLING
 
+from . import lookups
 from . import models
+from . import queries
 from . import text
 
 state_kwargs_fields = {}
 if hasattr(settings, "ARMSTRONG_INITIAL_STATE"):
     state_kwargs_fields["initial"] = settings.ARMSTRONG_INITIAL_STATE
 
+logger = logging.getLogger(__name__)
+
 
 class BaseDonationForm(forms.Form):
     """
@@ -29,6 +35,16 @@ class BaseDonationForm(forms.Form):
             help_text=text.get("donation.help_text.attribution"))
     anonymous = forms.BooleanField(required=False,
             label=text.get("donation.label.anonymous"))
+    submission_token = forms.CharField(required=False,
+            widget=forms.HiddenInput, initial=models.generate_token)
+
+    # Update an existing ``Donor`` with the same email and name instead of
+    # creating a new one on every donation.  Off by default: anyone who knows
+    # a donor's email and name could change that donor's phone and addresses.
+    reuse_donors = False
+
+    # ``Donor`` fields a later donation may fill in on a reused ``Donor``
+    updated_donor_fields = ("first_name", "last_name", "phone", "email", )
 
     def __init__(self, data=None, prefix=None, *args, **kwargs):
         # TODO: provide custom prefixes to each sub-form
@@ -69,7 +85,53 @@ class BaseDonationForm(forms.Form):
             "anonymous": bool(self.cleaned_data["anonymous"]),
         }
 
+    def _get_data(self):
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._validity = {}
+
+    data = property(_get_data, _set_data)
+
+    @property
+    def subforms(self):
+        return (self.donor_form, self.billing_address_form,
+                self.mailing_address_form)
+
     def is_valid(self, donation_only=False):
+        """
+        Returns whether the donation and, unless ``donation_only`` is set,
+        the donor and address forms are valid
+
+        Results are memoized for the life of the form.  Assigning new
+        ``data``, or replacing one of the subforms, throws them away.
+        """
+        subforms = self.subforms
+        memoized_subforms = self._validity.get("subforms", ())
+        if (len(memoized_subforms) != len(subforms) or not all(a is b
+                for a, b in zip(memoized_subforms, subforms))):
+            self._validity = {"subforms": subforms}
+        if "donation" not in self._validity:
+            donation_is_valid = self.is_donation_valid()
+            # is_donation_valid may have replaced ``data``
+            self._validity.setdefault("subforms", subforms)
+            self._validity["donation"] = donation_is_valid
+        if donation_only:
+            return self._validity["donation"]
+        if "all" not in self._validity:
+            mailing_address_validity = self.billing_address_form.is_valid() \
+                    if self.mailing_same_as_billing \
+                    else self.mailing_address_form.is_valid()
+            self._validity["all"] = all([
+                self._validity["donation"],
+                self.donor_form.is_valid(),
+                self.billing_address_form.is_valid(),
+                mailing_address_validity,
+            ])
+        return self._validity["all"]
+
+    def is_donation_valid(self):
         parent = super(BaseDonationForm, self)
         donation_is_valid = parent.is_valid()
         if not donation_is_valid and "amount" in self.errors:
@@ -77,7 +139,7 @@ class BaseDonationForm(forms.Form):
             if donation_type_field in self.data:
                 donation_type_pk = self.data[donation_type_field]
                 try:
-                    dt = models.DonationTypeOption.objects.get(pk=donation_type_pk)
+                    dt = lookups.get_donation_type_option(donation_type_pk)
 
                     # We've made it this far, so create a copy of the data (which is
                     # most likely an immutable `QueryDict`) and adjust the amount to
@@ -88,30 +150,34 @@ class BaseDonationForm(forms.Form):
                     donation_is_valid = parent.is_valid()
                 except models.DonationTypeOption.DoesNotExist:
                     donation_is_valid = False
-
-        if donation_only:
-            return donation_is_valid
-        mailing_address_validity = self.billing_address_form.is_valid() \
-                if self.mailing_same_as_billing \
-                else self.mailing_address_form.is_valid()
-        return all([
-            donation_is_valid,
-            self.donor_form.is_valid(),
-            self.billing_address_form.is_valid(),
-            mailing_address_validity,
-        ])
+        return donation_is_valid
 
     # TODO: support commit=True?
     def save(self, **kwargs):
+        """
+        Saves the donor, their addresses and the donation
+
+        Everything is written in one transaction.  The number of queries it
+        took is stored in ``save_query_count`` and logged at debug level.
+        """
+        with queries.QueryCounter() as counter:
+            with transaction.commit_on_success():
+                donation = self.save_donation()
+        self.save_query_count = counter.count
+        logger.debug("Saved donation %s in %d queries", donation.pk,
+                counter.count)
+        return donation
+
+    def save_donation(self):
         donation = models.Donation(**self.get_donation_kwargs())
         promo_code_field_name = self.add_prefix("promo_code")
         if (promo_code_field_name in self.data
                 and self.data[promo_code_field_name]):
-            donation.code = models.PromoCode.objects.get(
-                    code=self.data[promo_code_field_name])
+            donation.code = lookups.get_promo_code(
+                    self.data[promo_code_field_name])
         if self.add_prefix("donation_type_pk") in self.data:
-            donation.donation_type = models.DonationTypeOption.objects.get(
-                    pk=self.data[self.add_prefix("donation_type_pk")])
+            donation.donation_type = lookups.get_donation_type_option(
+                    self.data[self.add_prefix("donation_type_pk")])
         donor = self.donor_form.save(commit=False)
         try:
             user = User.objects.get(pk=self.data[self.add_prefix("user_pk")])
@@ -120,15 +186,85 @@ class BaseDonationForm(forms.Form):
                 donor.email = user.email
         except (KeyError, ValueError):
             pass
+        existing = self.get_existing_donor(donor)
         if self.billing_address_form.is_valid():
-            donor.address = self.billing_address_form.save()
-            donor.mailing_address = self.mailing_address_form.save() if \
-                    not self.mailing_same_as_billing else donor.address
-        donor.save()
+            donor.address = self.save_address(self.billing_address_form,
+                    existing and existing.address)
+            donor.mailing_address = donor.address \
+                    if self.mailing_matches_billing \
+                    else self.save_address(self.mailing_address_form,
+                            existing and existing.mailing_address)
+        elif existing is not None:
+            donor.address = existing.address
+            donor.mailing_address = existing.mailing_address
+        if existing is not None:
+            donor = self.update_existing_donor(existing, donor)
+        else:
+            donor.save()
         donation.donor = donor
         donation.save()
         return donation
 
+    def get_existing_donor(self, donor):
+        """
+        Returns the ``Donor`` that ``donor`` duplicates, if there is one
+
+        Its addresses are fetched in the same query so ``save_address`` can
+        reuse them without another round trip.
+        """
+        if not self.reuse_donors:
+            return None
+        key = donor.get_key()
+        if not key:
+            return None
+        existing = list(models.Donor.objects.filter(key=key)
+                .select_related("address", "mailing_address")
+                .order_by("pk")[:1])
+        return existing[0] if existing else None
+
+    def update_existing_donor(self, existing, donor):
+        """
+        Copies what this form submitted for ``donor`` onto ``existing``
+
+        Only the fields in ``updated_donor_fields`` that were filled in are
+        copied, so a later donation can't blank out what an earlier one
+        recorded.  The user is only set if ``existing`` has none, and is
+        never cleared or replaced.
+        """
+        for name in self.updated_donor_fields:
+            value = getattr(donor, name)
+            if value:
+                setattr(existing, name, value)
+        if existing.user_id is None and donor.user_id is not None:
+            existing.user = donor.user
+        existing.address = donor.address
+        existing.mailing_address = donor.mailing_address
+        existing.save()
+        return existing
+
+    def save_address(self, address_form, existing=None):
+        """Saves ``address_form`` unless ``existing`` is the same address"""
+        address = address_form.save(commit=False)
+        if existing is not None and existing.key == address.get_key():
+            return existing
+        address.save()
+        return address
+
+    @property
+    def mailing_matches_billing(self):
+        """
+        ``True`` if the mailing address is the same as the billing address
+
+        Either because the donor said so, or because they typed the same
+        address in twice.
+        """
+        if self.mailing_same_as_billing:
+            return True
+        return (self.billing_address_form.is_valid()
+                and self.mailing_address_form.is_valid()
+                and self.mailing_address_form.cleaned_data ==
+                        self.billing_address_form.cleaned_data)
+
 
 class StripSensitiveFields(object):
     """
@@ -141,13 +277,26 @@ class StripSensitiveFields(object):
 
     def is_valid(self, *args, **kwargs):
         r = super(StripSensitiveFields, self).is_valid(*args, **kwargs)
-        if not r and self.fields_to_strip:
-            empty_values = [""] * len(self.fields_to_strip)
-            new_data = dict(zip(self.fields_to_strip, empty_values))
-            self.data = copy(self.data)
-            self.data.update(new_data)
+        if not r:
+            self.strip_sensitive_fields()
         return r
 
+    def strip_sensitive_fields(self):
+        """Blanks the ``fields_to_strip`` in ``data`` and ``cleaned_data``"""
+        if not self.fields_to_strip:
+            return
+        empty_values = [""] * len(self.fields_to_strip)
+        new_data = dict(zip(self.fields_to_strip, empty_values))
+        # Assigning ``data`` throws memoized validity away, but blanking
+        # these fields doesn't change what the form was validated against
+        validity = getattr(self, "_validity", None)
+        self.data = copy(self.data)
+        self.data.update(new_data)
+        if validity is not None:
+            self._validity = validity
+        if hasattr(self, "cleaned_data"):
+            self.cleaned_data.update(new_data)
+
 
 class CreditCardDonationForm(StripSensitiveFields, BaseDonationForm):
     """
@@ -0,0 +1,159 @@
+"""
+Protection against the same donation being submitted twice
+
+Every donation form carries a hidden ``submission_token`` issued when the
+form is first displayed.  The token plus a hash of the submitted data make up
+the submission key.  ``DonationFormView`` claims the key before charging
+anything, so a double-click or browser retry gets the first submission's
+response instead of a second charge.
+
+Sensitive fields (those listed in a form's ``fields_to_strip``) are left out
+of the hash.  Failed purchases release their key so the donor can correct
+their details and try again.
+
+The cache of recent submissions is configured with::
+
+    ARMSTRONG_DONATIONS_SUBMISSION_CACHE = \\
+            "armstrong.apps.donations.idempotency.MemorySubmissionCache"
+    ARMSTRONG_DONATIONS_SUBMISSION_TTL = 600  # seconds
+
+``MemorySubmissionCache`` only sees submissions to its own process; use
+``DatabaseSubmissionCache`` if requests are spread over several processes.
+"""
+from collections import deque
+import datetime
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+from django.utils.importlib import import_module
+import hashlib
+import threading
+import time
+
+from . import models
+
+DEFAULT_CACHE = "armstrong.apps.donations.idempotency.MemorySubmissionCache"
+DEFAULT_TTL = 600
+
+TOKEN_FIELD = "submission_token"
+IGNORED_FIELDS = ("csrfmiddlewaretoken", "confirmed", )
+
+
+def get_submission_key(form):
+    """
+    Returns the key identifying this submission of ``form``
+
+    Returns ``None`` if the form was submitted without a token, in which
+    case the submission can't be told apart from a new donation.
+    """
+    token_field = form.add_prefix(TOKEN_FIELD)
+    token = form.data.get(token_field, None)
+    if not token:
+        return None
+    skipped = set([token_field] + list(IGNORED_FIELDS) + [form.add_prefix(a)
+            for a in getattr(form, "fields_to_strip", [])])
+    digest = hashlib.sha256(token.encode("utf-8"))
+    for name in sorted(form.data.keys()):
+        if name in skipped:
+            continue
+        values = (form.data.getlist(name) if hasattr(form.data, "getlist")
+                else [form.data[name]])
+        for value in values:
+            digest.update((u"%s=%s\n" % (name, value)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class MemorySubmissionCache(object):
+    """
+    Keeps recent submissions in the memory of the current process
+
+    Entries are dictionaries with a ``location`` key holding the URL the
+    first submission was redirected to, or ``None`` while it's still being
+    processed.
+    """
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.expiry = deque()
+        self.lock = threading.Lock()
+
+    def evict(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, key = self.expiry.popleft()
+            entry = self.entries.get(key, None)
+            if entry is not None and entry["expires"] <= now:
+                del self.entries[key]
+
+    def claim(self, key):
+        """
+        Claims ``key`` for a new submission
+
+        Returns ``None`` if the key was free, otherwise the entry recorded
+        by the submission that claimed it first.
+        """
+        now = time.time()
+        with self.lock:
+            self.evict(now)
+            if key in self.entries:
+                return {"location": self.entries[key]["location"]}
+            expires = now + self.ttl
+            self.entries[key] = {"location": None, "expires": expires}
+            self.expiry.append((expires, key))
+        return None
+
+    def complete(self, key, location):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]["location"] = location
+
+    def release(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class DatabaseSubmissionCache(object):
+    """Keeps recent submissions in the ``Submission`` table"""
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+
+    def claim(self, key):
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+                seconds=self.ttl)
+        models.Submission.objects.filter(created__lt=cutoff).delete()
+        sid = transaction.savepoint()
+        try:
+            models.Submission.objects.create(key=key)
+            transaction.savepoint_commit(sid)
+            return None
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        try:
+            submission = models.Submission.objects.get(key=key)
+        except models.Submission.DoesNotExist:
+            # The first submission was released in the meantime
+            return self.claim(key)
+        return {"location": submission.location or None}
+
+    def complete(self, key, location):
+        models.Submission.objects.filter(key=key).update(location=location)
+
+    def release(self, key):
+        models.Submission.objects.filter(key=key).delete()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the configured submission cache for this process"""
+    path = getattr(settings, "ARMSTRONG_DONATIONS_SUBMISSION_CACHE",
+            DEFAULT_CACHE)
+    ttl = getattr(settings, "ARMSTRONG_DONATIONS_SUBMISSION_TTL",
+            DEFAULT_TTL)
+    with _caches_lock:
+        if (path, ttl) not in _caches:
+            module, attr = path.rsplit(".", 1)
+            _caches[(path, ttl)] = getattr(import_module(module), attr)(
+                    ttl=ttl)
+        return _caches[(path, ttl)]
@@ -0,0 +1,290 @@
+"""
+Bulk imports of historical donations with their donors and addresses
+
+Rows use the same columns as ``exports`` writes, so an export can be loaded
+straight back in.  ``id``, ``donor_id`` and ``donation_type`` are ignored,
+``donation_type_option_id`` and ``promo_code`` must name existing rows, and
+``amount`` is stored as given (promo codes are not applied again).
+
+Input is read one row at a time and written ``batch_size`` rows at a time,
+each batch in its own transaction.  Donors and addresses are matched on the
+same keys ``merge_duplicate_donors`` uses, against the database and the rest
+of the import, and only new ones are inserted.  Donors without an email
+address can't be matched, so each of them is saved individually.
+
+Rows are inserted without calling ``save()`` or sending signals, so run
+``rebuild_donation_rollups`` and ``reconcile_campaigns`` afterwards.
+"""
+import csv
+import datetime
+from decimal import Decimal
+from decimal import InvalidOperation
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.db import transaction
+from django.db.models import AutoField
+from django.db.models.query import QuerySet
+import json
+import logging
+import time
+
+from . import lookups
+from . import models
+
+DEFAULT_BATCH_SIZE = 1000
+FORMATS = ("csv", "jsonl", )
+# Keeps ``key__in`` lookups under SQLite's limit on query parameters
+KEY_CHUNK_SIZE = 500
+
+ADDRESS_FIELDS = ("address", "city", "state", "zipcode", )
+DATETIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", )
+TRUE_VALUES = ("1", "true", "t", "yes", "y", )
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidRow(ValueError):
+    """Raised for an input row that can't be imported"""
+    def __init__(self, number, message):
+        super(InvalidRow, self).__init__("Row %d: %s" % (number, message))
+        self.number = number
+
+
+def read_csv(f):
+    """Yields each row of the UTF-8 encoded CSV file ``f`` as a dictionary"""
+    for row in csv.DictReader(f):
+        yield dict((k, v.decode("utf-8")) for k, v in row.items()
+                if k is not None and v is not None)
+
+
+def read_jsonl(f):
+    """Yields each line of ``f`` as a dictionary, skipping blank lines"""
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS = {
+    "csv": read_csv,
+    "jsonl": read_jsonl,
+}
+
+
+def to_text(value):
+    if value is None:
+        return u""
+    return (u"%s" % value).strip()
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return to_text(value).lower() in TRUE_VALUES
+
+
+def to_datetime(value):
+    value = to_text(value)
+    if not value:
+        return None
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Unrecognized date: %s" % value)
+
+
+def get_address(row, prefix=""):
+    values = dict((a, to_text(row.get(prefix + a))) for a in ADDRESS_FIELDS)
+    if not any(values.values()):
+        return None
+    return models.DonorAddress(**values)
+
+
+def parse_row(row):
+    """
+    Turns an input row into unsaved ``Donation``, ``Donor`` and addresses
+
+    Returns ``(donation, donor, address, mailing_address)``, where either
+    address may be ``None``.
+    """
+    address = get_address(row)
+    mailing_address = get_address(row, "mailing_")
+    donor = models.Donor(first_name=to_text(row.get("first_name")),
+            last_name=to_text(row.get("last_name")),
+            email=to_text(row.get("email")) or None,
+            phone=to_text(row.get("phone")) or None)
+    donation = models.Donation(
+            created=to_datetime(row.get("created")) or datetime.datetime.now(),
+            processed=to_bool(row.get("processed")),
+            anonymous=to_bool(row.get("anonymous")),
+            attribution=to_text(row.get("attribution")))
+    option_id = to_text(row.get("donation_type_option_id"))
+    if option_id:
+        option = lookups.get_donation_type_option(option_id)
+        donation.donation_type_id = option.pk
+    code = to_text(row.get("promo_code"))
+    if code:
+        donation.code_id = lookups.get_promo_code(code).pk
+    amount = to_text(row.get("amount"))
+    if amount:
+        try:
+            donation.amount = Decimal(amount)
+        except InvalidOperation:
+            raise ValueError("Invalid amount: %s" % amount)
+    elif option_id:
+        donation.amount = option.amount
+    else:
+        raise ValueError("amount or donation_type_option_id is required")
+    return donation, donor, address, mailing_address
+
+
+def chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def bulk_insert(model, objs, using=DEFAULT_DB_ALIAS):
+    """
+    Inserts ``objs`` with as few queries as the database allows
+
+    Like ``QuerySet.bulk_create``, except that rows are inserted raw (as
+    ``loaddata`` does), so ``auto_now_add`` fields keep imported values.
+    Primary keys are not set on ``objs``.
+    """
+    if not objs:
+        return
+    fields = [a for a in model._meta.local_fields
+            if not isinstance(a, AutoField)]
+    if not hasattr(QuerySet, "bulk_create"):
+        # Django 1.3 has no multi-row inserts
+        for obj in objs:
+            obj.save_base(raw=True, using=using)
+        return
+    size = max(connections[using].ops.bulk_batch_size(fields, objs), 1)
+    for batch in chunks(objs, size):
+        model._base_manager._insert(batch, fields=fields, using=using,
+                raw=True)
+
+
+def get_pks(model, keys, using=DEFAULT_DB_ALIAS):
+    """Returns a dictionary of each of ``keys`` to the oldest row with it"""
+    pks = {}
+    for chunk in chunks(list(keys), KEY_CHUNK_SIZE):
+        rows = (model._default_manager.using(using).filter(key__in=chunk)
+                .order_by("-pk").values_list("key", "pk"))
+        pks.update(rows)
+    return pks
+
+
+def save_keyed(model, objs, using=DEFAULT_DB_ALIAS):
+    """
+    Sets the primary key of each of ``objs``, inserting the ones not found
+
+    Objects are matched on ``key``.  Objects with an empty key are saved one
+    at a time.
+    """
+    keyed = {}
+    for obj in objs:
+        obj.key = obj.get_key()
+        if obj.key:
+            keyed.setdefault(obj.key, obj)
+        else:
+            obj.save_base(raw=True, using=using)
+    pks = get_pks(model, keyed.keys(), using=using)
+    missing = [obj for key, obj in keyed.items() if key not in pks]
+    if missing:
+        bulk_insert(model, missing, using=using)
+        pks.update(get_pks(model, [a.key for a in missing], using=using))
+    inserted = len(missing) + len([a for a in objs if not a.key])
+    for obj in objs:
+        if obj.key:
+            obj.pk = pks[obj.key]
+    return inserted
+
+
+class Importer(object):
+    """
+    Imports donations from an iterable of dictionaries
+
+    ``progress`` is called with the running ``stats`` after every batch.
+    Invalid rows raise ``InvalidRow`` unless ``skip_invalid`` is set, in
+    which case they are logged and counted as ``skipped``.
+    """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, using=DEFAULT_DB_ALIAS,
+            skip_invalid=False, progress=None):
+        self.batch_size = batch_size
+        self.using = using
+        self.skip_invalid = skip_invalid
+        self.progress = progress
+        self.stats = {
+            "rows": 0,
+            "donations": 0,
+            "donors": 0,
+            "addresses": 0,
+            "skipped": 0,
+            "elapsed": 0.0,
+            "rate": 0.0,
+        }
+
+    def import_rows(self, rows):
+        """Imports ``rows`` and returns the stats"""
+        self.started = time.time()
+        batch = []
+        for row in rows:
+            self.stats["rows"] += 1
+            try:
+                batch.append(parse_row(row))
+            except (ValueError, models.DonationTypeOption.DoesNotExist,
+                    models.PromoCode.DoesNotExist) as e:
+                self.invalid(e)
+            if len(batch) >= self.batch_size:
+                self.save_batch(batch)
+                batch = []
+        if batch:
+            self.save_batch(batch)
+        self.update_rate()
+        return self.stats
+
+    def invalid(self, e):
+        error = InvalidRow(self.stats["rows"], e)
+        if not self.skip_invalid:
+            raise error
+        logger.warning("Skipping invalid row: %s", error)
+        self.stats["skipped"] += 1
+
+    def save_batch(self, batch):
+        with transaction.commit_on_success(using=self.using):
+            addresses = [a for row in batch for a in row[2:] if a is not None]
+            self.stats["addresses"] += save_keyed(models.DonorAddress,
+                    addresses, using=self.using)
+            for donation, donor, address, mailing_address in batch:
+                donor.address_id = address and address.pk
+                donor.mailing_address_id = mailing_address and \
+                        mailing_address.pk
+            self.stats["donors"] += save_keyed(models.Donor,
+                    [a[1] for a in batch], using=self.using)
+            donations = []
+            for donation, donor, address, mailing_address in batch:
+                donation.donor_id = donor.pk
+                donations.append(donation)
+            bulk_insert(models.Donation, donations, using=self.using)
+        self.stats["donations"] += len(donations)
+        self.update_rate()
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    def update_rate(self):
+        elapsed = time.time() - self.started
+        self.stats["elapsed"] = elapsed
+        self.stats["rate"] = self.stats["rows"] / elapsed if elapsed else 0.0
+
+
+def import_file(f, format="csv", **kwargs):
+    """
+    Imports the open file ``f`` and returns the stats
+
+    Keyword arguments are passed on to ``Importer``.
+    """
+    return Importer(**kwargs).import_rows(READERS[format](f))
@@ -0,0 +1,168 @@
+"""
+In-process cache of donation types, their options and promo codes
+
+These tables are small and rarely change, but a single donation looks rows
+up in them several times.  ``LookupCache`` loads all three tables at once and
+answers lookups from memory until they change.
+
+Saving or deleting any of the models bumps the cache's version (see the
+receivers at the bottom of ``models``), which makes the next lookup reload
+the tables.  On its own the version lives in the current process, so other
+processes only notice changes once ``ARMSTRONG_DONATIONS_LOOKUP_TTL`` seconds
+(default ``300``) have passed.  Setting ``ARMSTRONG_DONATIONS_LOOKUP_CACHE``
+to the name of one of your ``CACHES`` shares the version, and the loaded
+tables, between every process using that cache::
+
+    ARMSTRONG_DONATIONS_LOOKUP_CACHE = "default"
+    ARMSTRONG_DONATIONS_LOOKUP_TTL = 300
+
+Objects handed out by the cache are shared between requests and must be
+treated as read-only.
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+import threading
+import time
+
+from . import models
+
+DEFAULT_TTL = 300
+VERSION_KEY = "armstrong.apps.donations.lookups.version"
+TABLES_KEY = "armstrong.apps.donations.lookups.tables.%s"
+
+
+def load_tables():
+    """Reads every donation type, option and promo code from the database"""
+    types = dict((a.pk, a) for a in models.DonationType.objects.all())
+    cache_name = models.DonationTypeOption._meta.get_field(
+            "donation_type").get_cache_name()
+    options = {}
+    for option in models.DonationTypeOption.objects.all():
+        setattr(option, cache_name, types[option.donation_type_id])
+        options[option.pk] = option
+    codes = dict((a.code, a) for a in models.PromoCode.objects.all())
+    return {
+        "types": types,
+        "options": options,
+        "codes": codes,
+    }
+
+
+class LookupCache(object):
+    def __init__(self, cache=None, ttl=DEFAULT_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.local_version = 0
+        self.tables = None
+        self.loaded_version = None
+        self.loaded_at = 0
+
+    def get_version(self):
+        if self.cache is None:
+            return self.local_version
+        version = self.cache.get(VERSION_KEY)
+        if version is None:
+            version = int(time.time() * 1000)
+            if not self.cache.add(VERSION_KEY, version):
+                version = self.cache.get(VERSION_KEY, version)
+        return version
+
+    def invalidate(self):
+        with self.lock:
+            self.local_version += 1
+            self.tables = None
+        if self.cache is not None:
+            try:
+                self.cache.incr(VERSION_KEY)
+            except ValueError:
+                # Nothing has read the shared version yet
+                pass
+
+    def get_tables(self):
+        version = self.get_version()
+        with self.lock:
+            if (self.tables is not None and self.loaded_version == version
+                    and time.time() - self.loaded_at < self.ttl):
+                return self.tables
+        tables = None
+        if self.cache is not None:
+            tables = self.cache.get(TABLES_KEY % version)
+        if tables is None:
+            tables = load_tables()
+            if self.cache is not None:
+                self.cache.set(TABLES_KEY % version, tables, self.ttl)
+        with self.lock:
+            self.tables = tables
+            self.loaded_version = version
+            self.loaded_at = time.time()
+        return tables
+
+    def get(self, table, key, model):
+        try:
+            return self.get_tables()[table][key]
+        except KeyError:
+            raise model.DoesNotExist(
+                    "%s matching %r does not exist" % (model.__name__, key))
+
+    def get_donation_type(self, pk):
+        return self.get("types", to_pk(pk, models.DonationType),
+                models.DonationType)
+
+    def get_donation_type_option(self, pk):
+        return self.get("options", to_pk(pk, models.DonationTypeOption),
+                models.DonationTypeOption)
+
+    def get_promo_code(self, code):
+        return self.get("codes", code, models.PromoCode)
+
+
+def to_pk(value, model):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise model.DoesNotExist("%r is not a valid %s primary key" % (
+                value, model.__name__))
+
+
+_lookups = {}
+_lookups_lock = threading.Lock()
+
+
+def get_lookups():
+    """Returns the configured ``LookupCache`` for this process"""
+    name = getattr(settings, "ARMSTRONG_DONATIONS_LOOKUP_CACHE", None)
+    ttl = getattr(settings, "ARMSTRONG_DONATIONS_LOOKUP_TTL", DEFAULT_TTL)
+    with _lookups_lock:
+        if (name, ttl) not in _lookups:
+            _lookups[(name, ttl)] = LookupCache(
+                    cache=get_cache(name) if name else None, ttl=ttl)
+        return _lookups[(name, ttl)]
+
+
+def get_donation_type(pk):
+    return get_lookups().get_donation_type(pk)
+
+
+def get_donation_type_option(pk):
+    return get_lookups().get_donation_type_option(pk)
+
+
+def get_promo_code(code):
+    return get_lookups().get_promo_code(code)
+
+
+def invalidate():
+    """Makes every ``LookupCache`` in this process reload on next use"""
+    # Make sure the configured cache exists so a shared version gets bumped
+    # even if this process has not looked anything up yet.
+    get_lookups()
+    with _lookups_lock:
+        lookups = _lookups.values()
+    for lookup in lookups:
+        lookup.invalidate()
+
+
+def clear():
+    with _lookups_lock:
+        _lookups.clear()
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+import json
+from optparse import make_option
+
+from ... import benchmarks
+
+
+class Command(BaseCommand):
+    args = "[benchmark ...]"
+    help = "Benchmark the donation pipeline in a throwaway test database"
+    option_list = BaseCommand.option_list + (
+        make_option("--iterations", type="int",
+                default=benchmarks.DEFAULT_ITERATIONS,
+                help="Timed runs of each benchmark"),
+        make_option("--warmup", type="int", default=benchmarks.DEFAULT_WARMUP,
+                help="Untimed runs before timing starts"),
+        make_option("--output", default=None,
+                help="File to save the results to as JSON"),
+        make_option("--baseline", default=None,
+                help="JSON results to compare against.  Regressions make "
+                        "the command fail"),
+        make_option("--tolerance", type="float",
+                default=benchmarks.DEFAULT_TOLERANCE,
+                help="Fraction median times and objects may grow by "
+                        "before counting as a regression"),
+    )
+
+    def handle(self, *names, **options):
+        try:
+            benchmarks.get_benchmarks(names)
+        except ValueError as e:
+            raise CommandError(str(e))
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+        connection = connections[DEFAULT_DB_ALIAS]
+        old_name = settings.DATABASES[DEFAULT_DB_ALIAS]["NAME"]
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            results = benchmarks.run(names, iterations=options["iterations"],
+                    warmup=options["warmup"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        self.stdout.write("%-18s %10s %10s %8s %8s\n" % ("benchmark",
+                "median ms", "per sec", "queries", "objects"))
+        for name, result in sorted(results["results"].items()):
+            self.stdout.write("%-18s %10.3f %10.1f %8d %8d\n" % (name,
+                    result["median"] * 1000, result["per_second"],
+                    result["queries"], result["objects"]))
+        if baseline is not None:
+            self.report(benchmarks.compare(results, baseline,
+                    tolerance=options["tolerance"]))
+
+    def report(self, comparisons):
+        regressions = [a for a in comparisons if a["regressed"]]
+        for comparison in comparisons:
+            self.stdout.write("%(benchmark)-18s %(metric)-8s %(change)+7.1f%%"
+                    "%(flag)s\n" % dict(comparison,
+                            change=comparison["change"] * 100,
+                            flag=" REGRESSED" if comparison["regressed"]
+                                    else ""))
+        if regressions:
+            raise CommandError("%d metric(s) regressed against the "
+                    "baseline" % len(regressions))
@@ -0,0 +1,24 @@
+import datetime
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from ... import models
+
+
+class Command(BaseCommand):
+    help = "Fail queued purchases that were never finished"
+    option_list = BaseCommand.option_list + (
+        make_option("--minutes", type="int", default=30,
+                help="Age in minutes after which unfinished jobs expire"),
+    )
+
+    def handle(self, *args, **options):
+        cutoff = (datetime.datetime.now()
+                - datetime.timedelta(minutes=options["minutes"]))
+        expired = models.PurchaseJob.objects.filter(created__lt=cutoff,
+                status__in=[models.PurchaseJob.PENDING,
+                        models.PurchaseJob.PROCESSING])
+        count = expired.update(status=models.PurchaseJob.FAILED,
+                reason=u"Purchase was not completed, please try again",
+                updated=datetime.datetime.now())
+        self.stdout.write("Expired %d purchase job(s)\n" % count)
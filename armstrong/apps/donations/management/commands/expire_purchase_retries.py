@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from ... import retries
+
+
+class Command(BaseCommand):
+    help = "Fail purchase retries abandoned by the process that held them"
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int",
+                default=retries.DEFAULT_BATCH_SIZE,
+                help="Jobs updated per query"),
+        make_option("--grace", type="int", default=5,
+                help="Minutes a retry may be overdue before it is failed"),
+    )
+
+    def handle(self, *args, **options):
+        count = retries.expire_abandoned(grace=options["grace"],
+                batch_size=options["batch_size"])
+        self.stdout.write("Failed %d abandoned purchase retry(s)\n" % count)
@@ -0,0 +1,72 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from optparse import make_option
+import os
+
+from ... import exports
+
+
+class Command(BaseCommand):
+    help = "Export donations with their donor, address, type and promo code"
+    option_list = BaseCommand.option_list + (
+        make_option("--format", default="csv", choices=exports.FORMATS,
+                help="csv or jsonl"),
+        make_option("--output", default=None,
+                help="File to write to (appended to when resuming), "
+                        "defaults to stdout"),
+        make_option("--chunk-size", type="int",
+                default=exports.DEFAULT_CHUNK_SIZE,
+                help="Rows fetched per query"),
+        make_option("--after", type="int", default=None,
+                help="Only export donations with a greater primary key"),
+        make_option("--since", default=None,
+                help="Only export donations created on or after this date "
+                        "(YYYY-MM-DD)"),
+        make_option("--watermark", default=None,
+                help="File holding the last exported primary key.  Read to "
+                        "resume an export and updated after every chunk"),
+    )
+
+    def handle(self, *args, **options):
+        since = options["since"]
+        if since:
+            try:
+                since = datetime.datetime.strptime(since, "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--since must look like YYYY-MM-DD")
+        after = options["after"]
+        if after is None and options["watermark"]:
+            after = self.read_watermark(options["watermark"])
+        if options["output"]:
+            out = open(options["output"], "ab" if after else "wb")
+        else:
+            out = self.stdout
+        formatter = exports.FORMATTERS[options["format"]]
+        count = 0
+        try:
+            for rows in exports.iter_chunks(after=after, since=since,
+                    chunk_size=options["chunk_size"]):
+                out.write(formatter(rows, header=not (after or count)))
+                out.flush()
+                count += len(rows)
+                if options["watermark"]:
+                    self.write_watermark(options["watermark"],
+                            rows[-1]["id"])
+        finally:
+            if options["output"]:
+                out.close()
+        self.stderr.write("Exported %d donation(s)\n" % count)
+
+    def read_watermark(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            value = f.read().strip()
+        return int(value) if value else None
+
+    def write_watermark(self, path, pk):
+        tmp = "%s.tmp" % path
+        with open(tmp, "w") as f:
+            f.write("%d\n" % pk)
+        os.rename(tmp, path)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from optparse import make_option
+import os
+import sys
+
+from ... import imports
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = "Import donations with their donors and addresses from CSV or JSONL"
+    option_list = BaseCommand.option_list + (
+        make_option("--format", default=None, choices=imports.FORMATS,
+                help="csv or jsonl, defaults to the file's extension"),
+        make_option("--batch-size", type="int",
+                default=imports.DEFAULT_BATCH_SIZE,
+                help="Rows written per transaction"),
+        make_option("--skip-invalid", action="store_true", default=False,
+                help="Log and skip rows that can't be imported instead of "
+                        "stopping"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one file to import, or - for stdin")
+        path = args[0]
+        format = options["format"]
+        if format is None:
+            format = os.path.splitext(path)[1].lstrip(".").lower()
+            if format not in imports.FORMATS:
+                raise CommandError("Use --format to say what %s holds" % path)
+        f = sys.stdin if path == "-" else open(path, "rb")
+        try:
+            stats = imports.import_file(f, format=format,
+                    batch_size=options["batch_size"],
+                    skip_invalid=options["skip_invalid"],
+                    progress=self.report)
+        except imports.InvalidRow as e:
+            raise CommandError(str(e))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        self.report(stats)
+        self.stderr.write("Added %(donors)d donor(s) and %(addresses)d "
+                "address(es), skipped %(skipped)d row(s)\n" % stats)
+
+    def report(self, stats):
+        self.stderr.write("Imported %(donations)d of %(rows)d row(s) in "
+                "%(elapsed).1fs (%(rate).0f rows/sec)\n" % stats)
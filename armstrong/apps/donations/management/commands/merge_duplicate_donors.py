@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Min
+from optparse import make_option
+
+from ... import models
+
+
+class Command(BaseCommand):
+    help = "Merge donors and donor addresses that are duplicates"
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=500,
+                help="Number of rows handled per transaction"),
+    )
+
+    def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        for model in (models.DonorAddress, models.Donor):
+            count = self.fill_keys(model)
+            self.stdout.write("Filled in %d %s key(s)\n" % (count,
+                    model._meta.verbose_name))
+        count = self.merge(models.DonorAddress, self.merge_addresses)
+        self.stdout.write("Merged %d duplicate donor address(es)\n" % count)
+        count = self.merge(models.Donor, self.merge_donors)
+        self.stdout.write("Merged %d duplicate donor(s)\n" % count)
+
+    def fill_keys(self, model):
+        """Computes the key of rows saved before keys existed"""
+        count, last_pk = 0, 0
+        while True:
+            rows = list(model.objects.filter(key="", pk__gt=last_pk)
+                    .order_by("pk")[:self.batch_size])
+            if not rows:
+                return count
+            with transaction.commit_on_success():
+                for row in rows:
+                    key = row.get_key()
+                    if key:
+                        model.objects.filter(pk=row.pk).update(key=key)
+                        count += 1
+            last_pk = rows[-1].pk
+
+    def merge(self, model, merge_group):
+        """
+        Calls ``merge_group`` for every set of rows sharing a key
+
+        The row with the lowest primary key is kept, matching the one
+        ``BaseDonationForm.save`` reuses.
+        """
+        count = 0
+        while True:
+            groups = list(model.objects.exclude(key="").values("key")
+                    .annotate(rows=Count("pk"), keep=Min("pk"))
+                    .filter(rows__gt=1).order_by()[:self.batch_size])
+            if not groups:
+                return count
+            with transaction.commit_on_success():
+                for group in groups:
+                    duplicates = list(model.objects.filter(key=group["key"])
+                            .exclude(pk=group["keep"])
+                            .values_list("pk", flat=True))
+                    merge_group(group["keep"], duplicates)
+                    model.objects.filter(pk__in=duplicates).delete()
+                    count += len(duplicates)
+
+    def merge_addresses(self, keep, duplicates):
+        models.Donor.objects.filter(address__in=duplicates).update(
+                address=keep)
+        models.Donor.objects.filter(mailing_address__in=duplicates).update(
+                mailing_address=keep)
+
+    def merge_donors(self, keep, duplicates):
+        """
+        Moves the duplicates' donations to ``keep``
+
+        ``user`` and ``phone`` are copied from the oldest duplicate that has
+        them when ``keep`` doesn't, so they aren't lost with the duplicates.
+        """
+        models.Donation.objects.filter(donor__in=duplicates).update(
+                donor=keep)
+        donor = models.Donor.objects.get(pk=keep)
+        updates = {}
+        for duplicate in models.Donor.objects.filter(pk__in=duplicates) \
+                .order_by("-pk"):
+            if duplicate.user_id and not donor.user_id:
+                updates["user"] = duplicate.user_id
+            if duplicate.phone and not donor.phone:
+                updates["phone"] = duplicate.phone
+        if updates:
+            models.Donor.objects.filter(pk=keep).update(**updates)
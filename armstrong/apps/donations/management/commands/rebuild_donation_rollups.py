@@ -0,0 +1,35 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from optparse import make_option
+
+from ... import rollups
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError("Dates must look like YYYY-MM-DD: %s" % value)
+
+
+class Command(BaseCommand):
+    help = "Recompute the daily donation rollups"
+    option_list = BaseCommand.option_list + (
+        make_option("--start", default=None,
+                help="First day to recompute (YYYY-MM-DD)"),
+        make_option("--end", default=None,
+                help="Last day to recompute (YYYY-MM-DD), defaults to today"),
+    )
+
+    def handle(self, *args, **options):
+        if options["start"] is None:
+            if options["end"] is not None:
+                raise CommandError("--end requires --start")
+            count = rollups.rebuild_all()
+        else:
+            start = parse_date(options["start"])
+            end = (parse_date(options["end"]) if options["end"]
+                    else datetime.date.today())
+            count = rollups.rebuild(start, end + datetime.timedelta(days=1))
+        self.stdout.write("Wrote %d rollup row(s)\n" % count)
@@ -0,0 +1,29 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from optparse import make_option
+
+from ... import models
+from ... import progress
+
+
+class Command(BaseCommand):
+    args = "[slug ...]"
+    help = "Recompute campaign totals from their donations"
+    option_list = BaseCommand.option_list + (
+        make_option("--all", action="store_true", default=False,
+                help="Include campaigns that ended more than a day ago"),
+    )
+
+    def handle(self, *slugs, **options):
+        campaigns = models.Campaign.objects.all()
+        if slugs:
+            campaigns = campaigns.filter(slug__in=slugs)
+        elif not options["all"]:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=1)
+            campaigns = campaigns.filter(Q(end__isnull=True) |
+                    Q(end__gt=cutoff))
+        for campaign in campaigns:
+            totals = progress.reconcile(campaign)
+            self.stdout.write("%s: %s from %d donation(s)\n" % (
+                    campaign.slug, totals["total"], totals["count"]))
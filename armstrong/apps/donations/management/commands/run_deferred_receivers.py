@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import time
+
+from ... import deferred
+
+
+class Command(BaseCommand):
+    help = "Run deferred successful_purchase receivers that are due"
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int",
+                default=deferred.DEFAULT_BATCH_SIZE,
+                help="Tasks claimed per query"),
+        make_option("--poll", type="float", default=None,
+                help="Keep running, checking for due tasks every this many "
+                        "seconds"),
+    )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = deferred.run_pending(batch_size=options["batch_size"])
+            total += count
+            if count:
+                continue
+            if options["poll"] is None:
+                break
+            time.sleep(options["poll"])
+        self.stdout.write("Ran %d deferred receiver(s)\n" % total)
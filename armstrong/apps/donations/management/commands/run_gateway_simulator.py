@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from ... import simulator
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for the Authorize.net gateway"
+    args = "[host:port]"
+    option_list = BaseCommand.option_list + (
+        make_option("--latency", default="0",
+                help="Seconds, or a distribution such as uniform:0.1,0.5"),
+        make_option("--decline-rate", type="float", default=0.0,
+                dest="decline_rate",
+                help="Fraction of requests to decline (0 to 1)"),
+        make_option("--error-rate", type="float", default=0.0,
+                dest="error_rate",
+                help="Fraction of requests to fail (0 to 1)"),
+        make_option("--error-mode", default="gateway", dest="error_mode",
+                choices=simulator.ERROR_MODES,
+                help="How failures look: %s" % ", ".join(
+                        simulator.ERROR_MODES)),
+        make_option("--seed", type="int", default=None,
+                help="Seed for repeatable outcomes"),
+    )
+
+    def handle(self, address=None, **options):
+        host, port = (address or simulator.get_simulator_address()).split(":")
+        server = simulator.GatewaySimulator(host=host, port=int(port),
+                latency=options["latency"],
+                decline_rate=options["decline_rate"],
+                error_rate=options["error_rate"],
+                error_mode=options["error_mode"], seed=options["seed"])
+        self.stdout.write("Simulating Authorize.net on http://%s/\n" %
+                server.address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
@@ -0,0 +1,216 @@
+"""
+Managers and querysets for reporting on donations
+"""
+import datetime
+from django.db import connections
+from django.db import models
+from django.db.models import Count
+from django.db.models import Sum
+from django.db.models.query import QuerySet
+
+PERIODS = ("day", "week", "month", "year", )
+
+# Foreign keys followed by ``__unicode__``, ``is_repeating`` and the backends
+DONATION_RELATED = ("donor", "donor__address", "donor__mailing_address",
+        "donation_type", "donation_type__donation_type", "code", )
+DONOR_RELATED = ("address", "mailing_address", "user", )
+
+
+def trunc_sql(connection, period, column):
+    """
+    Returns SQL truncating ``column`` to the start of its ``period``
+
+    Weeks start on Monday.  Django's own ``date_trunc_sql`` has no notion
+    of weeks, so they are handled per database.
+    """
+    if period != "week":
+        return connection.ops.date_trunc_sql(period, column)
+    vendor = getattr(connection, "vendor", "")
+    if vendor == "postgresql":
+        return "DATE_TRUNC('week', %s)" % column
+    if vendor == "mysql":
+        return "DATE_SUB(DATE(%s), INTERVAL WEEKDAY(%s) DAY)" % (column,
+                column)
+    if vendor == "oracle":
+        return "TRUNC(%s, 'IW')" % column
+    return "DATE(%s, 'weekday 0', '-6 days')" % column
+
+
+def to_date(value):
+    """Turns whatever the database returned for a truncated date into a date"""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(("%s" % value)[:10], "%Y-%m-%d").date()
+
+
+class DonationQuerySet(QuerySet):
+    def with_related(self):
+        """Joins in the donor, their addresses, the option, type and code"""
+        return self.select_related(*DONATION_RELATED)
+
+    def processed(self):
+        return self.filter(processed=True)
+
+    def unprocessed(self):
+        return self.filter(processed=False)
+
+    def created_between(self, start, end):
+        """Donations created on or after ``start`` and before ``end``"""
+        return self.filter(created__gte=start, created__lt=end)
+
+    def summarize(self):
+        """Returns a dictionary with the ``total`` and ``count``"""
+        totals = self.aggregate(total=Sum("amount"), count=Count("pk"))
+        if totals["total"] is None:
+            totals["total"] = 0
+        return totals
+
+    def grouped(self, *fields):
+        return (self.values(*fields)
+                .annotate(total=Sum("amount"), count=Count("pk"))
+                .order_by(*fields))
+
+    def totals_by_period(self, period="day", fields=()):
+        """
+        Totals and counts for each ``day``, ``week``, ``month`` or ``year``
+
+        Returns a list of dictionaries with ``period`` (the date that period
+        started on), ``total`` and ``count``, oldest first.  Rows are also
+        grouped by any ``fields`` given, which are included in each row.
+        """
+        if period not in PERIODS:
+            raise ValueError("period must be one of %s" % ", ".join(PERIODS))
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        column = "%s.%s" % (quote(self.model._meta.db_table),
+                quote("created"))
+        rows = (self.extra(select={"period": trunc_sql(connection, period,
+                        column)})
+                .values("period", *fields)
+                .annotate(total=Sum("amount"), count=Count("pk"))
+                .order_by("period", *fields))
+        return [dict(row, period=to_date(row["period"])) for row in rows]
+
+    def totals_by_donation_type(self):
+        return self.grouped("donation_type__donation_type",
+                "donation_type__donation_type__name")
+
+    def totals_by_option(self):
+        return self.grouped("donation_type")
+
+    def totals_by_promo_code(self):
+        return self.grouped("code__code")
+
+    def totals_by_processed(self):
+        return self.grouped("processed")
+
+
+class DonationManager(models.Manager):
+    """
+    Adds database-side reporting to ``Donation.objects``
+
+    Every ``DonationQuerySet`` method is available on the manager and on
+    any queryset it returns, so they can be combined with ``filter``::
+
+        Donation.objects.processed().created_between(start, end) \\
+                .totals_by_period("month")
+
+    Use ``with_related()`` when listing donations or passing them to a
+    backend, so following their foreign keys doesn't run a query per row.
+    """
+    def get_query_set(self):
+        return DonationQuerySet(self.model, using=self._db)
+
+    def with_related(self):
+        return self.get_query_set().with_related()
+
+    def processed(self):
+        return self.get_query_set().processed()
+
+    def unprocessed(self):
+        return self.get_query_set().unprocessed()
+
+    def created_between(self, start, end):
+        return self.get_query_set().created_between(start, end)
+
+    def summarize(self):
+        return self.get_query_set().summarize()
+
+    def totals_by_period(self, period="day", fields=()):
+        return self.get_query_set().totals_by_period(period, fields=fields)
+
+    def totals_by_donation_type(self):
+        return self.get_query_set().totals_by_donation_type()
+
+    def totals_by_option(self):
+        return self.get_query_set().totals_by_option()
+
+    def totals_by_promo_code(self):
+        return self.get_query_set().totals_by_promo_code()
+
+    def totals_by_processed(self):
+        return self.get_query_set().totals_by_processed()
+
+
+class DonorQuerySet(QuerySet):
+    def with_related(self):
+        """Joins in the donor's addresses and user"""
+        return self.select_related(*DONOR_RELATED)
+
+
+class DonorManager(models.Manager):
+    def get_query_set(self):
+        return DonorQuerySet(self.model, using=self._db)
+
+    def with_related(self):
+        return self.get_query_set().with_related()
+
+
+class DonationTypeOptionManager(models.Manager):
+    """
+    Always joins in the ``DonationType``
+
+    An option's ``name`` and ``__unicode__`` come from its type, and the
+    join is cheap, so it is part of the default queryset.  It is also used
+    when following ``Donation.donation_type``.
+    """
+    use_for_related_fields = True
+
+    def get_query_set(self):
+        return (super(DonationTypeOptionManager, self).get_query_set()
+                .select_related("donation_type"))
+
+
+class DailyRollupQuerySet(QuerySet):
+    def between(self, start, end):
+        """Rollups for dates on or after ``start`` and before ``end``"""
+        return self.filter(date__gte=start, date__lt=end)
+
+    def summarize(self):
+        """Returns a dictionary with the ``total`` and ``count``"""
+        totals = self.aggregate(total=Sum("total"), count=Sum("count"))
+        for key in ("total", "count"):
+            if totals[key] is None:
+                totals[key] = 0
+        return totals
+
+    def totals_by_day(self):
+        return (self.values("date")
+                .annotate(total=Sum("total"), count=Sum("count"))
+                .order_by("date"))
+
+
+class DailyRollupManager(models.Manager):
+    def get_query_set(self):
+        return DailyRollupQuerySet(self.model, using=self._db)
+
+    def between(self, start, end):
+        return self.get_query_set().between(start, end)
+
+    def summarize(self):
+        return self.get_query_set().summarize()
+
+    def totals_by_day(self):
+        return self.get_query_set().totals_by_day()
@@ -0,0 +1,198 @@
+"""
+Latency and outcome metrics for payment gateway calls
+
+Backends report every call they make to the gateway with ``record``.  Each
+call is passed on to the sinks configured with the
+``ARMSTRONG_DONATIONS_METRICS_SINKS`` setting, which defaults to keeping
+in-process stats only::
+
+    ARMSTRONG_DONATIONS_METRICS_SINKS = (
+        "armstrong.apps.donations.metrics.StatsSink",
+        "armstrong.apps.donations.metrics.LoggingSink",
+    )
+
+``GatewayMetricsView`` exposes the ``StatsSink`` numbers in the Prometheus
+text format.  It isn't routed by default; add it to your own URL
+configuration behind whatever protection your metrics need.
+"""
+from bisect import bisect_left
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.importlib import import_module
+from django.views.generic import View
+import logging
+import threading
+
+DEFAULT_SINKS = ("armstrong.apps.donations.metrics.StatsSink", )
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram(object):
+    """Counts observations into fixed, cumulative-on-read buckets"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns ``(upper_bound, count)`` pairs, ending with ``+Inf``"""
+        total, r = 0, []
+        for bound, count in zip(self.buckets + (float("inf"), ),
+                self.counts):
+            total += count
+            r.append((bound, total))
+        return r
+
+
+class StatsSink(object):
+    """
+    Keeps counters and latency histograms in memory
+
+    ``stats`` returns a plain ``dict`` snapshot that is safe to serialize.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.codes = {}
+        self.latency = {}
+
+    def record(self, call, duration, outcome, result_code=None,
+            reason_code=None):
+        with self.lock:
+            key = (call, outcome)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            key = (call, result_code or "", reason_code or "")
+            self.codes[key] = self.codes.get(key, 0) + 1
+            if call not in self.latency:
+                self.latency[call] = Histogram(self.buckets)
+            self.latency[call].observe(duration)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": [{"call": call, "outcome": outcome, "count": count}
+                        for (call, outcome), count in
+                        sorted(self.calls.items())],
+                "codes": [{"call": call, "result_code": result_code,
+                            "reason_code": reason_code, "count": count}
+                        for (call, result_code, reason_code), count in
+                        sorted(self.codes.items())],
+                "latency": dict((call, {
+                    "buckets": histogram.cumulative(),
+                    "sum": histogram.sum,
+                    "count": histogram.count,
+                }) for call, histogram in self.latency.items()),
+            }
+
+
+class LoggingSink(object):
+    """Logs one line per gateway call"""
+    logger = logging.getLogger("armstrong.apps.donations.gateway")
+
+    def record(self, call, duration, outcome, result_code=None,
+            reason_code=None):
+        self.logger.info("gateway call=%s outcome=%s result_code=%s "
+                "reason_code=%s duration=%.3f", call, outcome, result_code,
+                reason_code, duration)
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    """Returns the configured sink instances, shared by the process"""
+    paths = tuple(getattr(settings, "ARMSTRONG_DONATIONS_METRICS_SINKS",
+            DEFAULT_SINKS))
+    sinks = _sinks.get(paths, None)
+    if sinks is None:
+        with _sinks_lock:
+            if paths not in _sinks:
+                r = []
+                for path in paths:
+                    module, attr = path.rsplit(".", 1)
+                    r.append(getattr(import_module(module), attr)())
+                _sinks[paths] = r
+            sinks = _sinks[paths]
+    return sinks
+
+
+def get_stats_sink():
+    """Returns the first configured ``StatsSink``, if any"""
+    for sink in get_sinks():
+        if isinstance(sink, StatsSink):
+            return sink
+    return None
+
+
+def record(call, duration, outcome, result_code=None, reason_code=None):
+    """Passes a gateway call on to every configured sink"""
+    for sink in get_sinks():
+        sink.record(call, duration, outcome, result_code=result_code,
+                reason_code=reason_code)
+
+
+def format_labels(**labels):
+    return u",".join(u'%s="%s"' % (k, unicode(v).replace(u"\\", u"\\\\")
+            .replace(u'"', u'\\"')) for k, v in sorted(labels.items()))
+
+
+def render_prometheus(sink):
+    """Renders the numbers in ``sink`` in the Prometheus text format"""
+    stats = sink.stats()
+    lines = [
+        u"# HELP armstrong_donations_gateway_calls_total "
+                u"Gateway calls by outcome.",
+        u"# TYPE armstrong_donations_gateway_calls_total counter",
+    ]
+    for a in stats["calls"]:
+        lines.append(u"armstrong_donations_gateway_calls_total{%s} %d" % (
+                format_labels(call=a["call"], outcome=a["outcome"]),
+                a["count"]))
+    lines += [
+        u"# HELP armstrong_donations_gateway_responses_total "
+                u"Gateway responses by result and reason code.",
+        u"# TYPE armstrong_donations_gateway_responses_total counter",
+    ]
+    for a in stats["codes"]:
+        lines.append(u"armstrong_donations_gateway_responses_total{%s} %d" % (
+                format_labels(call=a["call"], result_code=a["result_code"],
+                        reason_code=a["reason_code"]), a["count"]))
+    lines += [
+        u"# HELP armstrong_donations_gateway_call_seconds "
+                u"Wall time of gateway calls.",
+        u"# TYPE armstrong_donations_gateway_call_seconds histogram",
+    ]
+    for call, histogram in sorted(stats["latency"].items()):
+        for bound, count in histogram["buckets"]:
+            le = u"+Inf" if bound == float("inf") else repr(bound)
+            lines.append(
+                    u"armstrong_donations_gateway_call_seconds_bucket{%s} %d"
+                    % (format_labels(call=call, le=le), count))
+        lines.append(u"armstrong_donations_gateway_call_seconds_sum{%s} %r"
+                % (format_labels(call=call), histogram["sum"]))
+        lines.append(u"armstrong_donations_gateway_call_seconds_count{%s} %d"
+                % (format_labels(call=call), histogram["count"]))
+    return u"\n".join(lines) + u"\n"
+
+
+class GatewayMetricsView(View):
+    """Serves the in-process gateway stats in the Prometheus text format"""
+    def get(self, request, *args, **kwargs):
+        sink = get_stats_sink()
+        content = render_prometheus(sink) if sink is not None else u""
+        return HttpResponse(content, content_type=PROMETHEUS_CONTENT_TYPE)
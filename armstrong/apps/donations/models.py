@@ -1,8 +1,29 @@
+import datetime
 from decimal import Decimal
 from django.contrib.auth.models import User
 from django.contrib.localflavor.us import models as us
 from django.db import models
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 from django.utils.translation import ugettext_lazy as _
+import hashlib
+import re
+import uuid
+
+from . import managers
+from . import signals
+
+
+def normalize(value):
+    """Lower-cases ``value`` and reduces punctuation and spacing to spaces"""
+    value = re.sub(r"[\s.,#]+", u" ", (u"%s" % (value or u"")).lower())
+    return value.strip()
+
+
+def make_key(*parts):
+    """Returns a hash of the normalized ``parts`` for duplicate lookups"""
+    value = u"\x1f".join(normalize(a) for a in parts)
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()
 
 
 class DonorAddress(models.Model):
@@ -11,6 +32,17 @@ class DonorAddress(models.Model):
     city = models.CharField(max_length=20)
     state = us.USStateField()
     zipcode = models.CharField(max_length=10)
+    key = models.CharField(max_length=40, blank=True, default="",
+            db_index=True, editable=False)
+
+    def get_key(self):
+        """Returns the hash identifying this address for deduplication"""
+        return make_key(self.address, self.city, self.state,
+                (self.zipcode or "")[:5])
+
+    def save(self, **kwargs):
+        self.key = self.get_key()
+        super(DonorAddress, self).save(**kwargs)
 
     def __unicode__(self):
         return "%(address)s, %(city)s, %(state)s, %(zipcode)s" % self.__dict__
@@ -33,6 +65,21 @@ class Donor(models.Model):
     # TODO: Make sure form widget is USPhoneNumberField
     phone = models.CharField(max_length=10, null=True, blank=True)
     email = models.EmailField(null=True, blank=True)
+    key = models.CharField(max_length=40, blank=True, default="",
+            db_index=True, editable=False)
+
+    objects = managers.DonorManager()
+
+    def get_key(self):
+        """
+        Returns the hash identifying this donor for deduplication
+
+        Donors are matched on their email address and name, so donors
+        without an email address get an empty key and are never matched.
+        """
+        if not self.email:
+            return ""
+        return make_key(self.email, self.first_name, self.last_name)
 
     def save(self, **kwargs):
         if self.user:
@@ -40,6 +87,7 @@ class Donor(models.Model):
                 self.first_name = self.user.first_name
             if not self.last_name:
                 self.last_name = self.user.last_name
+        self.key = self.get_key()
         super(Donor, self).save(**kwargs)
 
     def __unicode__(self):
@@ -74,6 +122,8 @@ class DonationTypeOption(models.Model):
         help_text=_(u"Number of times (if any) this donation will repeat")
     )
 
+    objects = managers.DonationTypeOptionManager()
+
     @property
     def name(self):
         return self.donation_type.name
@@ -108,11 +158,14 @@ class Donation(models.Model):
             blank=True)
     code = models.ForeignKey(PromoCode, null=True, blank=True)
     amount = models.DecimalField(max_digits=9, decimal_places=2)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
     processed = models.BooleanField(default=False)
     attribution = models.CharField(max_length=255, default="")
     anonymous = models.BooleanField()
 
+    # Composite indexes for reports are created by sql/donation.sql
+    objects = managers.DonationManager()
+
     def save(self, **kwargs):
         if self.donation_type and not self.amount:
             self.amount = self.donation_type.amount
@@ -130,3 +183,217 @@ class Donation(models.Model):
 
     def __unicode__(self):
         return "%s donated %s" % (self.donor, self.amount)
+
+
+def generate_token():
+    return uuid.uuid4().hex
+
+
+class PurchaseJob(models.Model):
+    """
+    Tracks a ``Donation`` whose purchase has been queued
+
+    ``token`` is handed to the donor so they can poll the status of the
+    purchase without exposing the ``Donation`` primary key.  Purchases that
+    failed for a transient reason wait in ``RETRYING`` until
+    ``next_attempt`` (see ``retries``).
+    """
+    PENDING = "pending"
+    PROCESSING = "processing"
+    RETRYING = "retrying"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, _(u"Pending")),
+        (PROCESSING, _(u"Processing")),
+        (RETRYING, _(u"Retrying")),
+        (SUCCEEDED, _(u"Succeeded")),
+        (FAILED, _(u"Failed")),
+    )
+
+    donation = models.ForeignKey(Donation, related_name="purchase_jobs")
+    token = models.CharField(max_length=32, unique=True,
+            default=generate_token)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+            default=PENDING, db_index=True)
+    reason = models.CharField(max_length=255, blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)
+    # Indexed together with ``status`` by sql/purchasejob.sql
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    def mark(self, status, reason=""):
+        self.status = status
+        self.reason = reason[:255]
+        self.save()
+
+    def as_dict(self):
+        return {
+            "token": self.token,
+            "status": self.status,
+            "reason": self.reason,
+            "finished": self.is_finished,
+        }
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.donation, self.status)
+
+
+class DeferredReceiverTask(models.Model):
+    """
+    A ``deferrable`` receiver of ``successful_purchase`` waiting to run
+
+    Created when ``ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS`` is
+    ``"database"`` and run by the ``run_deferred_receivers`` command.
+    ``result`` holds the JSON encoded purchase result.  The form is never
+    stored, so card data stays out of the database.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, _(u"Pending")),
+        (RUNNING, _(u"Running")),
+        (SUCCEEDED, _(u"Succeeded")),
+        (FAILED, _(u"Failed")),
+    )
+
+    receiver = models.CharField(max_length=255)
+    donation = models.ForeignKey(Donation, related_name="deferred_tasks")
+    result = models.TextField(blank=True, default="")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+            default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # Indexed together with ``status`` by sql/deferredreceivertask.sql
+    run_at = models.DateTimeField(default=datetime.datetime.now)
+    last_error = models.TextField(blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"%s for %s (%s)" % (self.receiver, self.donation_id,
+                self.status)
+
+
+class Submission(models.Model):
+    """
+    A recently submitted donation form, used to spot duplicate submissions
+
+    ``location`` is where the first submission was redirected to and is
+    empty while that submission is still being processed.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    location = models.CharField(max_length=255, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+class DailyDonationRollup(models.Model):
+    """
+    Totals of processed donations per day, donation type and promo code
+
+    Rows are kept up to date by ``rollups.record_donation`` as purchases
+    succeed, and can be recomputed with the ``rebuild_donation_rollups``
+    command.
+    """
+    date = models.DateField(db_index=True)
+    donation_type = models.ForeignKey(DonationType, null=True, blank=True,
+            related_name="rollups")
+    code = models.ForeignKey(PromoCode, null=True, blank=True,
+            related_name="rollups")
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    count = models.PositiveIntegerField(default=0)
+    # Identifies the row's date, donation type and promo code.  A unique
+    # constraint on those columns wouldn't do: NULLs never equal each other,
+    # so it would allow duplicate rows without a donation type or code.
+    key = models.CharField(max_length=60, unique=True, editable=False)
+
+    objects = managers.DailyRollupManager()
+
+    @staticmethod
+    def make_key(date, donation_type, code):
+        """Returns the ``key`` of the rollup for these pks, or ``None``s"""
+        return u"%s:%s:%s" % (date.strftime("%Y-%m-%d"),
+                u"" if donation_type is None else donation_type,
+                u"" if code is None else code)
+
+    def save(self, **kwargs):
+        self.key = self.make_key(self.date, self.donation_type_id,
+                self.code_id)
+        super(DailyDonationRollup, self).save(**kwargs)
+
+    def __unicode__(self):
+        return u"%s: %s from %d donation(s)" % (self.date, self.total,
+                self.count)
+
+
+class Campaign(models.Model):
+    """
+    A fundraising goal, such as a pledge drive
+
+    Processed donations made between ``start`` and ``end`` (and of
+    ``donation_type``, if one is set) count towards the campaign.  ``raised``
+    and ``donations`` are incremented as purchases succeed, so displaying
+    progress never has to add up ``Donation`` rows.  The
+    ``reconcile_campaigns`` command corrects them if they drift.
+    """
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(unique=True)
+    goal = models.DecimalField(max_digits=12, decimal_places=2)
+    start = models.DateTimeField()
+    end = models.DateTimeField(null=True, blank=True)
+    donation_type = models.ForeignKey(DonationType, null=True, blank=True,
+            related_name="campaigns")
+    raised = models.DecimalField(max_digits=12, decimal_places=2, default=0,
+            editable=False)
+    donations = models.PositiveIntegerField(default=0, editable=False)
+    reconciled = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def get_donations(self):
+        """Returns the processed donations that count towards this"""
+        donations = Donation.objects.processed().filter(
+                created__gte=self.start)
+        if self.end is not None:
+            donations = donations.filter(created__lt=self.end)
+        if self.donation_type_id is not None:
+            donations = donations.filter(
+                    donation_type__donation_type=self.donation_type_id)
+        return donations
+
+    def __unicode__(self):
+        return self.name
+
+
+def invalidate_lookups(sender, **kwargs):
+    from . import lookups
+    lookups.invalidate()
+
+for model in (DonationType, DonationTypeOption, PromoCode):
+    post_save.connect(invalidate_lookups, sender=model,
+            dispatch_uid="donations_lookups_save_%s" % model.__name__)
+    post_delete.connect(invalidate_lookups, sender=model,
+            dispatch_uid="donations_lookups_delete_%s" % model.__name__)
+
+
+def update_rollups(sender, donation, **kwargs):
+    from . import rollups
+    rollups.handle_successful_purchase(donation)
+
+signals.successful_purchase.connect(update_rollups,
+        dispatch_uid="donations_rollups_successful_purchase")
+
+
+def update_campaigns(sender, donation, **kwargs):
+    from . import progress
+    progress.handle_successful_purchase(donation)
+
+signals.successful_purchase.connect(update_campaigns,
+        dispatch_uid="donations_campaigns_successful_purchase")
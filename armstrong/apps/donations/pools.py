@@ -0,0 +1,253 @@
+"""
+Per-process pools of reusable payment gateway clients
+
+Building a new ``aim.Api`` or ``arb.Api`` for every purchase means every
+donation pays for a fresh TCP connection and TLS handshake with the gateway.
+The pools in this module hold on to idle clients, and the clients they create
+keep their HTTPS connection open between requests.
+
+Pools are configured through the ``ARMSTRONG_DONATIONS_GATEWAY_POOL``
+setting::
+
+    ARMSTRONG_DONATIONS_GATEWAY_POOL = {
+        "SIZE": 4,            # idle clients kept per pool, 0 disables pooling
+        "IDLE_TIMEOUT": 30,   # seconds before an idle client is discarded
+        "HEALTH_CHECK": "path.to.callable",  # optional, called with the client
+    }
+"""
+from authorize.base import BaseApi
+from collections import deque
+from django.conf import settings as django_settings
+from django.utils.importlib import import_module
+import httplib
+import select
+import socket
+import threading
+import time
+
+DEFAULT_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 30
+
+
+class GatewayUnreachable(IOError):
+    """Raised when no connection to the gateway could be opened"""
+    pass
+
+
+class GatewayHTTPError(IOError):
+    """Raised when the gateway answers with an HTTP server error"""
+    def __init__(self, status):
+        super(GatewayHTTPError, self).__init__(
+                "Gateway responded with HTTP %d" % status)
+        self.status = status
+
+
+class KeepAliveConnection(object):
+    """
+    Sends requests for an ``authorize`` API object over one HTTPS connection
+
+    ``authorize.base.BaseApi.request`` opens a new ``HTTPSConnection`` for
+    every call.  This replaces it with a connection that stays open until it
+    fails or is closed by the pool.
+    """
+    def __init__(self, api, timeout=None):
+        self.api = api
+        self.timeout = timeout
+        self.connection = None
+        api.request = self.request
+
+    def connect(self):
+        connection_class = getattr(self.api, "connection_class",
+                httplib.HTTPSConnection)
+        if self.timeout is None:
+            return connection_class(self.api.server)
+        return connection_class(self.api.server, timeout=self.timeout)
+
+    def request(self, body):
+        if self.connection is not None and self.is_stale():
+            self.close()
+        try:
+            return self.send(body)
+        except Exception:
+            # Never send the request again: the gateway may have acted on
+            # it before the connection failed, and it may be a charge
+            self.close()
+            raise
+
+    def is_stale(self):
+        """
+        Returns ``True`` if the gateway has closed the idle connection
+
+        Nothing should be waiting to be read on an idle connection, so one
+        that is readable has been closed (or is out of step) and a new one
+        is opened before anything is sent.
+        """
+        sock = getattr(self.connection, "sock", None)
+        if sock is None:
+            return False
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def send(self, body):
+        if self.connection is None:
+            connection = self.connect()
+            try:
+                # Connect up front so a failure here is known to have
+                # happened before anything was sent
+                connection.connect()
+            except socket.error as e:
+                raise GatewayUnreachable(e)
+            self.connection = connection
+        self.connection.request("POST", self.api.path, body,
+                headers=self.api.headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        if response.status >= 500:
+            raise GatewayHTTPError(response.status)
+        return self.api.parse_response(content)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def keep_alive(api, timeout=None):
+    """
+    Make ``api`` reuse its HTTPS connection if it is an ``authorize`` API
+
+    ``timeout`` is the socket timeout in seconds for that connection.
+    Anything else (stubs, custom ``api_class`` implementations) is returned
+    untouched.
+    """
+    if isinstance(api, BaseApi) and not getattr(api, "async", False):
+        api.keep_alive = KeepAliveConnection(api, timeout=timeout)
+    return api
+
+
+def close(api):
+    """Closes the connection ``keep_alive`` gave ``api``, if it has one"""
+    connection = getattr(api, "keep_alive", None)
+    if isinstance(connection, KeepAliveConnection):
+        connection.close()
+
+
+class GatewayClientPool(object):
+    """
+    Holds up to ``size`` idle gateway clients for reuse
+
+    ``acquire`` never blocks: if there is no idle client available a new one
+    is created with ``factory``.  Clients handed back with ``release`` are
+    kept until the pool is full, they have been idle for longer than
+    ``idle_timeout`` seconds, or ``health_check`` returns ``False`` for them.
+    New clients' connections use a socket timeout of ``timeout`` seconds.
+    """
+    def __init__(self, factory, size=DEFAULT_SIZE,
+            idle_timeout=DEFAULT_IDLE_TIMEOUT, health_check=None,
+            timeout=None):
+        self.factory = factory
+        self.timeout = timeout
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.idle = deque()
+        self.checked_out = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        client = None
+        while client is None:
+            with self.lock:
+                if not self.idle:
+                    break
+                candidate, last_used = self.idle.pop()
+            if self.is_healthy(candidate, last_used):
+                client = candidate
+            else:
+                self.close(candidate)
+        if client is None:
+            client = keep_alive(self.factory(), timeout=self.timeout)
+        with self.lock:
+            self.checked_out.append(client)
+        return client
+
+    def release(self, client):
+        with self.lock:
+            if not self.owns(client):
+                return
+            self.checked_out = [a for a in self.checked_out
+                    if a is not client]
+            if len(self.idle) < self.size:
+                self.idle.append((client, time.time()))
+                return
+        self.close(client)
+
+    def owns(self, client):
+        return any(a is client for a in self.checked_out)
+
+    def is_healthy(self, client, last_used):
+        if time.time() - last_used > self.idle_timeout:
+            return False
+        if self.health_check is not None:
+            return bool(self.health_check(client))
+        return True
+
+    def close(self, client):
+        close(client)
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for client, last_used in idle:
+            self.close(client)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool_settings(settings=None):
+    if settings is None:
+        settings = django_settings
+    config = getattr(settings, "ARMSTRONG_DONATIONS_GATEWAY_POOL", {})
+    health_check = config.get("HEALTH_CHECK", None)
+    if isinstance(health_check, basestring):
+        module, attr = health_check.rsplit(".", 1)
+        health_check = getattr(import_module(module), attr)
+    return {
+        "size": config.get("SIZE", DEFAULT_SIZE),
+        "idle_timeout": config.get("IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT),
+        "health_check": health_check,
+    }
+
+
+def get_pool(key, factory, settings=None, timeout=None):
+    """
+    Returns the process-wide pool for ``key``, creating it if needed
+
+    ``key`` should identify everything that went into building a client
+    (API class, credentials, test mode) so that a change in configuration
+    results in a new pool rather than stale clients.  Returns ``None`` if
+    pooling has been disabled by setting ``SIZE`` to ``0``.
+    """
+    config = get_pool_settings(settings)
+    if not config["size"]:
+        return None
+    key = key + (config["size"], config["idle_timeout"],
+            config["health_check"], timeout)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = GatewayClientPool(factory, timeout=timeout,
+                    **config)
+        return _pools[key]
+
+
+def clear_pools():
+    """Closes and forgets every pool in this process"""
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
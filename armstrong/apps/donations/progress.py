@@ -0,0 +1,189 @@
+"""
+Campaign progress ("thermometer") counters
+
+Every ``Campaign`` keeps a running ``raised`` total and ``donations`` count
+that is atomically incremented as purchases succeed.  ``get_progress``
+serves them from a cache, so pages showing a thermometer never add up
+``Donation`` rows and only read the ``Campaign`` row once per TTL::
+
+    ARMSTRONG_DONATIONS_PROGRESS_CACHE = "default"  # or None for in-process
+    ARMSTRONG_DONATIONS_PROGRESS_TTL = 10  # seconds
+
+Progress is available as JSON from ``CampaignProgressView`` and in templates
+through ``{% get_campaign_progress "slug" as progress %}`` from the
+``donation_tags`` library.  Run the ``reconcile_campaigns`` command
+periodically to correct the counters against the ``Donation`` table.
+"""
+import datetime
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import F
+from django.db.models import Q
+from django.http import Http404
+from django.http import HttpResponse
+from django.views.generic import View
+import json
+import logging
+import threading
+import time
+
+from . import models
+
+DEFAULT_TTL = 10
+CACHE_KEY = "armstrong.apps.donations.progress.%s"
+
+logger = logging.getLogger(__name__)
+
+
+def get_campaigns_for(donation):
+    """Returns the campaigns ``donation`` counts towards"""
+    created = donation.created
+    campaigns = models.Campaign.objects.filter(
+            Q(end__isnull=True) | Q(end__gt=created), start__lte=created)
+    option = donation.donation_type
+    if option is None:
+        return campaigns.filter(donation_type__isnull=True)
+    return campaigns.filter(Q(donation_type__isnull=True) |
+            Q(donation_type=option.donation_type_id))
+
+
+def record_donation(donation):
+    """Adds a successfully processed ``donation`` to its campaigns"""
+    campaigns = get_campaigns_for(donation)
+    slugs = list(campaigns.values_list("slug", flat=True))
+    if not slugs:
+        return
+    campaigns.update(raised=F("raised") + donation.amount,
+            donations=F("donations") + 1)
+    cache = get_cache_for_progress()
+    for slug in slugs:
+        cache.forget(slug)
+
+
+def handle_successful_purchase(donation):
+    """
+    Records ``donation`` from the ``successful_purchase`` signal
+
+    Errors are logged instead of failing a purchase that has already been
+    charged; ``reconcile_campaigns`` will correct the counters.
+    """
+    try:
+        record_donation(donation)
+    except Exception:
+        logger.exception("Unable to add donation %s to its campaigns",
+                getattr(donation, "pk", None))
+
+
+def reconcile(campaign):
+    """Recomputes ``campaign``'s counters from its donations"""
+    totals = campaign.get_donations().summarize()
+    models.Campaign.objects.filter(pk=campaign.pk).update(
+            raised=totals["total"], donations=totals["count"],
+            reconciled=datetime.datetime.now())
+    get_cache_for_progress().forget(campaign.slug)
+    return totals
+
+
+def get_campaign_progress(campaign):
+    goal = campaign.goal
+    raised = campaign.raised
+    percent = float(raised * 100 / goal) if goal else 0.0
+    return {
+        "slug": campaign.slug,
+        "name": campaign.name,
+        "goal": goal,
+        "raised": raised,
+        "donations": campaign.donations,
+        "percent": min(percent, 100.0),
+        "remaining": max(goal - raised, Decimal("0")),
+    }
+
+
+class ProgressCache(object):
+    """
+    Caches campaign progress for ``ttl`` seconds
+
+    Uses the Django cache ``cache`` if one is given, otherwise a dictionary
+    in the current process.
+    """
+    def __init__(self, cache=None, ttl=DEFAULT_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, slug):
+        if self.cache is not None:
+            progress = self.cache.get(CACHE_KEY % slug)
+        else:
+            with self.lock:
+                expires, progress = self.entries.get(slug, (0, None))
+            if expires <= time.time():
+                progress = None
+        if progress is None:
+            progress = self.load(slug)
+        return progress
+
+    def load(self, slug):
+        progress = get_campaign_progress(
+                models.Campaign.objects.get(slug=slug))
+        if self.cache is not None:
+            self.cache.set(CACHE_KEY % slug, progress, self.ttl)
+        else:
+            with self.lock:
+                self.entries[slug] = (time.time() + self.ttl, progress)
+        return progress
+
+    def forget(self, slug):
+        if self.cache is not None:
+            self.cache.delete(CACHE_KEY % slug)
+        else:
+            with self.lock:
+                self.entries.pop(slug, None)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache_for_progress():
+    """Returns the configured ``ProgressCache`` for this process"""
+    name = getattr(settings, "ARMSTRONG_DONATIONS_PROGRESS_CACHE", None)
+    ttl = getattr(settings, "ARMSTRONG_DONATIONS_PROGRESS_TTL", DEFAULT_TTL)
+    with _caches_lock:
+        if (name, ttl) not in _caches:
+            _caches[(name, ttl)] = ProgressCache(
+                    cache=get_cache(name) if name else None, ttl=ttl)
+        return _caches[(name, ttl)]
+
+
+def get_progress(slug):
+    """
+    Returns the progress of the campaign ``slug`` as a dictionary
+
+    Raises ``Campaign.DoesNotExist`` if there is no such campaign.
+    """
+    return get_cache_for_progress().get(slug)
+
+
+def clear():
+    with _caches_lock:
+        _caches.clear()
+
+
+class CampaignProgressView(View):
+    """Returns a campaign's progress as JSON"""
+    def get(self, request, slug, *args, **kwargs):
+        try:
+            progress = get_progress(slug)
+        except models.Campaign.DoesNotExist:
+            raise Http404
+        data = dict(progress)
+        for key in ("goal", "raised", "remaining"):
+            data[key] = float(data[key])
+        response = HttpResponse(json.dumps(data),
+                content_type="application/json")
+        response["Cache-Control"] = "public, max-age=%d" % (
+                get_cache_for_progress().ttl)
+        return response
@@ -0,0 +1,61 @@
+"""
+Counting the database queries a block of code makes
+"""
+from django.conf import settings
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on one connection inside a ``with`` block
+
+    Django only records queries while ``DEBUG`` is on, so the connection's
+    debug cursor is switched on for the duration of the block.  Queries
+    recorded only because of that are dropped again on the way out, so
+    long-lived threads don't build up a list of them.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.count = None
+        self.queries = []
+
+    def __enter__(self):
+        self.use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.use_debug_cursor = self.use_debug_cursor
+        self.queries = self.connection.queries[self.start:]
+        self.count = len(self.queries)
+        recording = self.use_debug_cursor or (self.use_debug_cursor is None
+                and settings.DEBUG)
+        if not recording:
+            del self.connection.queries[self.start:]
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryBudget(QueryCounter):
+    """
+    Fails if a ``with`` block runs more than ``budget`` queries
+
+    Raises ``QueryBudgetExceeded`` listing the queries that were run::
+
+        with QueryBudget(1):
+            [unicode(a) for a in Donation.objects.with_related()]
+    """
+    def __init__(self, budget, using=DEFAULT_DB_ALIAS):
+        super(QueryBudget, self).__init__(using=using)
+        self.budget = budget
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(QueryBudget, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and self.count > self.budget:
+            raise QueryBudgetExceeded("%d queries run, budget is %d:\n%s" % (
+                    self.count, self.budget,
+                    "\n".join(a["sql"] for a in self.queries)))
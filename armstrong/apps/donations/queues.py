@@ -0,0 +1,83 @@
+"""
+Runs backend purchases outside of the web request
+
+``DonationFormView`` can hand a saved ``Donation`` to a ``PurchaseQueue``
+instead of calling ``Backend.purchase`` itself.  Each queued purchase is
+recorded as a ``PurchaseJob`` so the donor can poll its status, while a pool
+of worker threads talks to the gateway.
+
+Card data only ever lives in the memory of the process that received it: the
+form is handed to the workers directly and is never written to the database.
+Jobs left behind by a process that died before finishing them can be failed
+with the ``expire_purchase_jobs`` management command so donors are asked to
+try again.
+
+The number of worker threads per process is configured with the
+``ARMSTRONG_DONATIONS_PURCHASE_WORKERS`` setting.  Setting it to ``0`` runs
+queued purchases inline.  When ``retries`` are enabled, purchases that fail
+for a transient reason are handed to the ``RetryQueue``.
+"""
+from django.conf import settings
+import logging
+import threading
+
+from . import backends
+from . import models
+from . import retries
+from .workers import WorkerPool
+
+DEFAULT_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+class PurchaseQueue(object):
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.pool = WorkerPool(workers, name="donations-purchase")
+
+    def enqueue(self, donation, form, backend=None):
+        """Records a ``PurchaseJob`` for ``donation`` and schedules it"""
+        job = models.PurchaseJob.objects.create(donation=donation)
+        self.pool.submit(self.process, job, form, backend=backend)
+        return job
+
+    def process(self, job, form, backend=None):
+        """Runs the purchase for ``job`` and records the outcome"""
+        if backend is None:
+            backend = backends.get_backend()
+        job.mark(models.PurchaseJob.PROCESSING)
+        try:
+            result = backend.purchase(job.donation, form)
+        except Exception as e:
+            if retries.is_enabled() and backends.is_transient_error(e):
+                retries.get_queue().schedule(job, form, backend=backend,
+                        reason=u"%s" % e)
+                return job
+            logger.exception("Queued purchase for donation %s failed",
+                    job.donation.pk)
+            job.mark(models.PurchaseJob.FAILED, reason=u"%s" % e)
+            return job
+        reason = u"%s" % (result.get("reason", None) or "")
+        if (not result["status"] and retries.is_enabled() and
+                backends.classify_failure(result) == backends.TRANSIENT):
+            retries.get_queue().schedule(job, form, backend=backend,
+                    reason=reason)
+            return job
+        status = (models.PurchaseJob.SUCCEEDED if result["status"]
+                else models.PurchaseJob.FAILED)
+        job.mark(status, reason=reason)
+        return job
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Returns the ``PurchaseQueue`` for this process"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = PurchaseQueue(workers=getattr(settings,
+                    "ARMSTRONG_DONATIONS_PURCHASE_WORKERS", DEFAULT_WORKERS))
+        return _queue
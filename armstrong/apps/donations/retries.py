@@ -0,0 +1,279 @@
+"""
+Retrying purchases that failed for a reason that may go away
+
+A refused connection, an HTTP 502 or 503 from the gateway, an open circuit
+breaker or one of Authorize.net's "try again in 5 minutes" errors says
+nothing about the donor's card.  With retries enabled those purchases are
+recorded as a ``PurchaseJob`` in ``RETRYING`` and tried again after an
+exponential backoff with jitter, while the donor is sent to its status page.
+Card declines and anything that may already have charged the card
+(timeouts, other server errors) are never retried; see
+``backends.classify_failure`` and ``backends.is_transient_error``.
+
+Configured with::
+
+    ARMSTRONG_DONATIONS_RETRIES = {
+        "ENABLED": False,
+        "MAX_ATTEMPTS": 4,      # purchase attempts, including the first
+        "BASE_DELAY": 2,        # seconds before the first retry
+        "MAX_DELAY": 60,        # longest wait between two attempts
+        "WORKERS": 2,           # threads retrying purchases
+        "POLL": 1,              # seconds between checks for due retries
+    }
+
+The wait before retry ``n`` is ``BASE_DELAY * 2 ** (n - 1)``, capped at
+``MAX_DELAY``, of which a random half is taken off so donors that failed
+together don't all come back at once.
+
+Like ``queues``, card data only lives in the memory of the process that
+received it, and is blanked once the purchase has succeeded or failed for
+good.  Each process drains its own due retries in batches on a
+background thread.  Retries left behind by a process that died can't be
+attempted again, and are failed by the ``expire_purchase_retries`` command
+so the donor is asked to try again.
+"""
+import datetime
+from django.conf import settings as django_settings
+from django.db import connection
+import logging
+import random
+import threading
+import time
+
+from . import backends
+from . import models
+from .workers import WorkerPool
+
+DEFAULTS = {
+    "ENABLED": False,
+    "MAX_ATTEMPTS": 4,
+    "BASE_DELAY": 2,
+    "MAX_DELAY": 60,
+    "WORKERS": 2,
+    "POLL": 1,
+}
+DEFAULT_BATCH_SIZE = 100
+ABANDONED_REASON = u"Purchase was not completed, please try again"
+
+logger = logging.getLogger(__name__)
+
+
+def get_retry_settings(settings=None):
+    if settings is None:
+        settings = django_settings
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, "ARMSTRONG_DONATIONS_RETRIES", {}))
+    return config
+
+
+def is_enabled(settings=None):
+    return bool(get_retry_settings(settings)["ENABLED"])
+
+
+def strip_card_data(form):
+    """Blanks the card fields of ``form`` once its purchase is settled"""
+    strip = getattr(form, "strip_sensitive_fields", None)
+    if strip is not None:
+        strip()
+
+
+class RetryQueue(object):
+    """
+    Holds the forms of purchases waiting to be retried by this process
+
+    ``schedule`` records a failed attempt and when to try next, ``drain``
+    hands the retries that are due to a pool of ``workers`` threads.  A
+    background thread calls ``drain`` every ``poll`` seconds.  With a
+    ``poll`` of ``None`` no thread is started and ``drain`` is left to the
+    caller, which is handy for tests.
+    """
+    def __init__(self, max_attempts=DEFAULTS["MAX_ATTEMPTS"],
+            base_delay=DEFAULTS["BASE_DELAY"],
+            max_delay=DEFAULTS["MAX_DELAY"], workers=DEFAULTS["WORKERS"],
+            poll=DEFAULTS["POLL"], random=random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll = poll
+        self.random = random
+        self.pool = WorkerPool(workers, name="donations-retry")
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get_delay(self, attempt):
+        """Returns the seconds to wait after failed attempt ``attempt``"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (0.5 + self.random() / 2)
+
+    def schedule(self, job, form, backend=None, reason="", now=None):
+        """
+        Records a transient failure of ``job`` and schedules another attempt
+
+        Returns ``False``, after marking the job as failed, if it has run out
+        of attempts.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            logger.error("Giving up on purchase for donation %s after %d "
+                    "attempts", job.donation_id, job.attempts)
+            job.next_attempt = None
+            job.mark(models.PurchaseJob.FAILED, reason=reason)
+            strip_card_data(form)
+            return False
+        job.next_attempt = now + datetime.timedelta(
+                seconds=self.get_delay(job.attempts))
+        with self.lock:
+            self.waiting[job.pk] = (form, backend)
+        job.mark(models.PurchaseJob.RETRYING, reason=reason)
+        self.start()
+        return True
+
+    def drain(self, batch_size=DEFAULT_BATCH_SIZE, now=None):
+        """
+        Starts up to ``batch_size`` of this process's retries that are due
+
+        Each job is claimed with a conditional ``UPDATE`` first, so a job
+        failed by ``expire_purchase_retries`` in the meantime is left alone.
+        The forms of jobs that are no longer waiting to be retried are
+        dropped, with their card data blanked.  Returns the number started.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        self.forget_settled()
+        with self.lock:
+            pks = list(self.waiting)
+        if not pks:
+            return 0
+        due = list(models.PurchaseJob.objects.filter(pk__in=pks,
+                status=models.PurchaseJob.RETRYING, next_attempt__lte=now)
+                .select_related("donation")
+                .order_by("next_attempt")[:batch_size])
+        count = 0
+        for job in due:
+            with self.lock:
+                form, backend = self.waiting.pop(job.pk)
+            claimed = models.PurchaseJob.objects.filter(pk=job.pk,
+                    status=models.PurchaseJob.RETRYING).update(
+                            status=models.PurchaseJob.PROCESSING,
+                            updated=now)
+            if claimed:
+                job.status = models.PurchaseJob.PROCESSING
+                self.pool.submit(self.attempt, job, form, backend=backend)
+                count += 1
+            else:
+                strip_card_data(form)
+        return count
+
+    def forget_settled(self):
+        """Drops the forms of waiting jobs that are no longer ``RETRYING``"""
+        with self.lock:
+            pks = list(self.waiting)
+        if not pks:
+            return
+        retrying = set(models.PurchaseJob.objects.filter(pk__in=pks,
+                status=models.PurchaseJob.RETRYING)
+                .values_list("pk", flat=True))
+        for pk in pks:
+            if pk in retrying:
+                continue
+            with self.lock:
+                waiting = self.waiting.pop(pk, None)
+            if waiting is not None:
+                strip_card_data(waiting[0])
+
+    def attempt(self, job, form, backend=None):
+        """Tries the purchase for ``job`` again and records the outcome"""
+        if backend is None:
+            backend = backends.get_backend()
+        try:
+            result = backend.purchase(job.donation, form)
+        except Exception as e:
+            if backends.is_transient_error(e):
+                logger.warning("Retried purchase for donation %s failed: %s",
+                        job.donation_id, e)
+                self.schedule(job, form, backend=backend, reason=u"%s" % e)
+            else:
+                logger.exception("Retried purchase for donation %s failed",
+                        job.donation_id)
+                job.mark(models.PurchaseJob.FAILED, reason=u"%s" % e)
+                strip_card_data(form)
+            return job
+        reason = u"%s" % (result.get("reason", None) or "")
+        if result["status"]:
+            job.mark(models.PurchaseJob.SUCCEEDED, reason=reason)
+            # A subscription created in the background still needs the card
+            if not (job.donation.is_repeating and
+                    getattr(backend, "defer_recurring", False)):
+                strip_card_data(form)
+        elif backends.classify_failure(result) == backends.TRANSIENT:
+            self.schedule(job, form, backend=backend, reason=reason)
+        else:
+            job.mark(models.PurchaseJob.FAILED, reason=reason)
+            strip_card_data(form)
+        return job
+
+    def start(self):
+        """Starts the thread that drains this queue, if it isn't running"""
+        if self.poll is None:
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.work,
+                    name="donations-retry-drain")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def work(self):
+        while True:
+            time.sleep(self.poll)
+            try:
+                self.drain()
+            except Exception:
+                logger.exception("Draining purchase retries failed")
+            finally:
+                connection.close()
+
+
+def expire_abandoned(grace=5, batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """
+    Fails retries that are more than ``grace`` minutes overdue
+
+    The process holding them has gone away along with their card data.
+    Jobs are updated ``batch_size`` at a time; returns the number failed.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(minutes=grace)
+    total = 0
+    while True:
+        pks = list(models.PurchaseJob.objects.filter(
+                status=models.PurchaseJob.RETRYING, next_attempt__lt=cutoff)
+                .values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return total
+        total += models.PurchaseJob.objects.filter(pk__in=pks,
+                status=models.PurchaseJob.RETRYING).update(
+                        status=models.PurchaseJob.FAILED,
+                        reason=ABANDONED_REASON, next_attempt=None,
+                        updated=now)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Returns the ``RetryQueue`` for this process"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            config = get_retry_settings()
+            _queue = RetryQueue(max_attempts=config["MAX_ATTEMPTS"],
+                    base_delay=config["BASE_DELAY"],
+                    max_delay=config["MAX_DELAY"],
+                    workers=config["WORKERS"], poll=config["POLL"])
+        return _queue
@@ -0,0 +1,102 @@
+"""
+Maintains ``DailyDonationRollup`` rows
+
+Dashboards read totals from the rollup table instead of aggregating every
+``Donation``.  ``record_donation`` adds a donation to its day's row when its
+purchase succeeds (it is connected to ``successful_purchase``), and
+``rebuild`` recomputes the rows for a range of dates from scratch.
+
+Reading totals for any range only touches one row per day, donation type
+and promo code::
+
+    DailyDonationRollup.objects.between(start, end).summarize()
+"""
+import datetime
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+import logging
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def get_rollup_kwargs(donation):
+    option = donation.donation_type
+    return {
+        "date": donation.created.date(),
+        "donation_type": option.donation_type_id if option else None,
+        "code": donation.code_id,
+    }
+
+
+def add_to_rollup(date, donation_type, code, total, count):
+    """Adds ``total`` and ``count`` to a rollup row, creating it if needed"""
+    rows = models.DailyDonationRollup.objects.filter(
+            key=models.DailyDonationRollup.make_key(date, donation_type, code))
+    if rows.update(total=F("total") + total, count=F("count") + count):
+        return
+    sid = transaction.savepoint()
+    try:
+        models.DailyDonationRollup.objects.create(date=date,
+                donation_type_id=donation_type, code_id=code, total=total,
+                count=count)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Another process created the row first
+        transaction.savepoint_rollback(sid)
+        rows.update(total=F("total") + total, count=F("count") + count)
+
+
+def record_donation(donation):
+    """Adds a successfully processed ``donation`` to its rollup"""
+    kwargs = get_rollup_kwargs(donation)
+    add_to_rollup(kwargs["date"], kwargs["donation_type"], kwargs["code"],
+            donation.amount, 1)
+
+
+def handle_successful_purchase(donation):
+    """
+    Records ``donation`` from the ``successful_purchase`` signal
+
+    The donation has already been charged at this point, so a problem with
+    the rollups is logged rather than allowed to fail the purchase.  Run
+    ``rebuild_donation_rollups`` for that day to correct the totals.
+    """
+    try:
+        record_donation(donation)
+    except Exception:
+        logger.exception("Unable to add donation %s to its rollup",
+                getattr(donation, "pk", None))
+
+
+@transaction.commit_on_success
+def rebuild(start, end):
+    """
+    Recomputes the rollups for dates on or after ``start`` and before ``end``
+
+    Returns the number of rollup rows written.
+    """
+    models.DailyDonationRollup.objects.between(start, end).delete()
+    rows = (models.Donation.objects.processed()
+            .created_between(start, end)
+            .totals_by_period("day", fields=("donation_type__donation_type",
+                    "code")))
+    count = 0
+    for row in rows:
+        models.DailyDonationRollup.objects.create(date=row["period"],
+                donation_type_id=row["donation_type__donation_type"],
+                code_id=row["code"], total=row["total"], count=row["count"])
+        count += 1
+    return count
+
+
+def rebuild_all():
+    """Recomputes the rollups for every day there are donations"""
+    first = models.Donation.objects.order_by("created")[:1]
+    if not first:
+        return 0
+    start = first[0].created.date()
+    end = datetime.date.today() + datetime.timedelta(days=1)
+    return rebuild(start, end)
@@ -0,0 +1,218 @@
+"""
+Spreading purchases over several gateway accounts
+
+``RoutingBackend`` wraps several backends, called routes, and sends each
+purchase to one of them.  Use it as the backend and list the routes in
+``ARMSTRONG_DONATIONS_ROUTING``::
+
+    ARMSTRONG_DONATIONS_BACKEND = \\
+            "armstrong.apps.donations.routing.RoutingBackend"
+    ARMSTRONG_DONATIONS_ROUTING = {
+        "STRATEGY": "weighted",
+        "ROUTES": [
+            {
+                "NAME": "primary",
+                "WEIGHT": 3,
+                "SETTINGS": {"AUTHORIZE": {"LOGIN": "...", "KEY": "..."}},
+            },
+            {
+                "NAME": "secondary",
+                "SETTINGS": {"AUTHORIZE": {"LOGIN": "...", "KEY": "..."}},
+            },
+        ],
+    }
+
+Each route builds ``BACKEND`` (``AuthorizeNetBackend`` by default) with a
+``settings`` keyword argument.  There, ``SETTINGS`` takes precedence over
+the project's settings.  Every route must use the same form class.
+
+``STRATEGY`` picks the route tried first:
+
+* ``"weighted"`` (the default): smooth weighted round-robin, so a route
+  with a ``WEIGHT`` (default ``1``) of ``3`` gets three purchases for every
+  one sent to a route with a weight of ``1``
+* ``"latency"``: the route whose purchases have been the fastest, as an
+  exponentially weighted average with ``LATENCY_SMOOTHING`` (default
+  ``0.2``) as the weight of the latest purchase.  Routes that haven't been
+  measured yet go first.
+* ``"health"``: the first route in ``ROUTES`` that is healthy
+
+A route is unhealthy while its circuit breaker is open (see ``breakers``).
+Unhealthy routes are only tried once every healthy one has been.  A purchase
+that fails in a way that is safe to retry (see
+``backends.is_transient_error`` and ``backends.classify_failure``) fails
+over to the next route.  Declines and anything that may have charged the
+card do not.  The result of ``purchase`` has the ``route`` that handled it.
+"""
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+import logging
+import threading
+import time
+
+from . import backends
+
+DEFAULT_BACKEND = "armstrong.apps.donations.backends.AuthorizeNetBackend"
+DEFAULTS = {
+    "STRATEGY": "weighted",
+    "ROUTES": [],
+    "LATENCY_SMOOTHING": 0.2,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_routing_settings(settings=None):
+    if settings is None:
+        settings = django_settings
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, "ARMSTRONG_DONATIONS_ROUTING", {}))
+    return config
+
+
+class RouteSettings(object):
+    """Settings where ``overrides`` take precedence over ``settings``"""
+    def __init__(self, overrides, settings):
+        self.overrides = overrides
+        self.settings = settings
+
+    def __getattr__(self, name):
+        if name in self.overrides:
+            return self.overrides[name]
+        return getattr(self.settings, name)
+
+
+class Route(object):
+    """One backend a ``RoutingBackend`` can send purchases to"""
+    def __init__(self, name, backend, weight=1):
+        self.name = name
+        self.backend = backend
+        self.weight = weight
+        self.current_weight = 0
+        self.latency = None
+
+    @property
+    def is_healthy(self):
+        get_breaker = getattr(self.backend, "get_circuit_breaker", None)
+        return get_breaker is None or get_breaker().allows_calls
+
+    def record_latency(self, seconds, smoothing):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += smoothing * (seconds - self.latency)
+
+    def __repr__(self):
+        return "<Route %s>" % self.name
+
+
+def build_route(config, settings):
+    module, attr = config.get("BACKEND", DEFAULT_BACKEND).rsplit(".", 1)
+    backend_class = getattr(import_module(module), attr)
+    return Route(config["NAME"], backend_class(settings=RouteSettings(
+            config.get("SETTINGS", {}), settings)),
+            weight=config.get("WEIGHT", 1))
+
+
+def by_weight(routes):
+    """Orders ``routes`` by smooth weighted round-robin"""
+    if not routes:
+        return routes
+    total = 0
+    for route in routes:
+        route.current_weight += route.weight
+        total += route.weight
+    first = max(routes, key=lambda a: a.current_weight)
+    first.current_weight -= total
+    return [first] + sorted([a for a in routes if a is not first],
+            key=lambda a: -a.weight)
+
+
+def by_latency(routes):
+    """Orders ``routes`` fastest first, with unmeasured ones before them"""
+    return sorted(routes, key=lambda a: (a.latency is not None, a.latency))
+
+
+def by_health(routes):
+    """Keeps ``routes`` in the configured order"""
+    return list(routes)
+
+
+STRATEGIES = {
+    "weighted": by_weight,
+    "latency": by_latency,
+    "health": by_health,
+}
+
+
+class RoutingBackend(backends.Backend):
+    """
+    Sends each purchase to one of several backends, failing over between them
+
+    ``routes`` is a list of ``Route`` objects.  If it isn't given the routes
+    are built from ``ARMSTRONG_DONATIONS_ROUTING``, as is ``strategy``.
+    """
+    def __init__(self, routes=None, strategy=None, settings=None):
+        if settings is None:
+            settings = django_settings
+        self.settings = settings
+        config = get_routing_settings(settings)
+        if routes is None:
+            routes = [build_route(a, settings) for a in config["ROUTES"]]
+        if not routes:
+            raise ImproperlyConfigured("ARMSTRONG_DONATIONS_ROUTING must "
+                    "have at least one route")
+        if strategy is None:
+            strategy = config["STRATEGY"]
+        if strategy not in STRATEGIES:
+            raise ImproperlyConfigured("Unknown routing strategy %s, use "
+                    "one of %s" % (strategy, ", ".join(sorted(STRATEGIES))))
+        form_classes = set(a.backend.get_form_class() for a in routes)
+        if len(form_classes) > 1:
+            raise ImproperlyConfigured("Every route must use the same form "
+                    "class")
+        self.routes = routes
+        self.strategy = strategy
+        self.latency_smoothing = config["LATENCY_SMOOTHING"]
+        self.lock = threading.Lock()
+
+    def get_form_class(self):
+        return self.routes[0].backend.get_form_class()
+
+    def is_available(self):
+        return any(a.is_healthy for a in self.routes)
+
+    def get_routes(self):
+        """Returns the routes in the order a purchase should try them"""
+        healthy = [a for a in self.routes if a.is_healthy]
+        unhealthy = [a for a in self.routes if a not in healthy]
+        with self.lock:
+            return STRATEGIES[self.strategy](healthy) + unhealthy
+
+    def purchase(self, donation, form):
+        result = error = None
+        for route in self.get_routes():
+            started = time.time()
+            try:
+                result = route.backend.purchase(donation, form)
+            except Exception as e:
+                if not backends.is_transient_error(e):
+                    raise
+                logger.warning("Purchase through route %s failed, trying "
+                        "the next one: %s", route.name, e)
+                result, error = None, e
+                continue
+            error = None
+            with self.lock:
+                route.record_latency(time.time() - started,
+                        self.latency_smoothing)
+            result["route"] = route.name
+            if (result["status"] or backends.classify_failure(result) !=
+                    backends.TRANSIENT):
+                return result
+            logger.warning("Purchase through route %s failed, trying the "
+                    "next one: %s", route.name, result.get("reason", None))
+        if error is not None:
+            raise error
+        return result
@@ -1,3 +1,38 @@
 from django.dispatch import Signal
+from django.dispatch.dispatcher import _make_id
 
-successful_purchase = Signal(providing_args=["donation", "form", "result"])
+
+def deferrable(receiver):
+    """
+    Flags ``receiver`` as safe to run after the response has been sent
+
+    Only takes effect when ``ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS`` is set;
+    see ``deferred``.  ``receiver`` must be a module level function.
+    """
+    receiver.deferrable = True
+    return receiver
+
+
+def is_deferrable(receiver):
+    return getattr(receiver, "deferrable", False)
+
+
+class DeferrableSignal(Signal):
+    """``Signal`` that passes ``deferrable`` receivers on to ``deferred``"""
+    def send(self, sender, **named):
+        from . import deferred
+        if not self.receivers or deferred.get_mode() is None:
+            return super(DeferrableSignal, self).send(sender, **named)
+        responses = []
+        for receiver in self._live_receivers(_make_id(sender)):
+            if is_deferrable(receiver):
+                deferred.defer(receiver, self, sender, named)
+                responses.append((receiver, None))
+            else:
+                responses.append((receiver, receiver(signal=self,
+                        sender=sender, **named)))
+        return responses
+
+
+successful_purchase = DeferrableSignal(
+        providing_args=["donation", "form", "result"])
@@ -0,0 +1,336 @@
+"""
+A local stand-in for the Authorize.net gateway
+
+``GatewaySimulator`` is a small HTTP server that understands the AIM
+(``/gateway/transact.dll``) and ARB (``/xml/v1/request.api``) requests the
+``authorize`` library sends, and answers them in the same formats.  Its
+latency, decline rate and error rate are configurable, so the whole donation
+flow can be load tested without network access.
+
+Start it with the ``run_gateway_simulator`` management command and point the
+backend at it::
+
+    ARMSTRONG_DONATIONS_BACKEND = \\
+            "armstrong.apps.donations.simulator.SimulatedAuthorizeNetBackend"
+    ARMSTRONG_DONATIONS_SIMULATOR = "127.0.0.1:8099"
+
+``SimulatedAimApi`` and ``SimulatedArbApi`` can also be passed to
+``AuthorizeNetBackend`` directly as its ``api_class`` and
+``recurring_api_class``.  ``StubAimApi`` and ``StubArbApi`` approve every
+request in-process, without a server.
+"""
+from authorize import aim
+from authorize import arb
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from django.conf import settings
+import httplib
+import itertools
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+from xml.etree.cElementTree import fromstring
+from xml.sax.saxutils import escape
+
+from .backends import AuthorizeNetBackend
+
+DEFAULT_ADDRESS = "127.0.0.1:8099"
+
+AIM_PATH = "/gateway/transact.dll"
+ARB_PATH = "/xml/v1/request.api"
+
+# Number of fields in an AIM direct response
+AIM_RESPONSE_FIELDS = 40
+
+APPROVED = (u"1", u"1", u"This transaction has been approved.")
+DECLINED = (u"2", u"2", u"This transaction has been declined.")
+GATEWAY_ERROR = (u"3", u"19", u"An error occurred during processing.  "
+        u"Please try again in 5 minutes.")
+
+ERROR_MODES = ("gateway", "http", "disconnect", )
+
+
+def parse_latency(spec):
+    """
+    Turns a latency specification into a callable returning seconds
+
+    ``spec`` is either a number of seconds or ``<distribution>:<args>``:
+
+    * ``fixed:0.2``
+    * ``uniform:0.1,0.5``
+    * ``normal:0.3,0.1`` (mean and standard deviation)
+    * ``lognormal:-1.5,0.5`` (mu and sigma of the underlying normal)
+
+    Negative samples are treated as no delay.
+    """
+    spec = ("%s" % spec).strip()
+    if ":" not in spec:
+        spec = "fixed:%s" % (spec or 0)
+    distribution, args = spec.split(":", 1)
+    args = [float(a) for a in args.split(",")]
+    if distribution == "fixed":
+        sample = lambda rng: args[0]
+    elif distribution in ("uniform", "normal", "lognormal"):
+        method = {"uniform": "uniform", "normal": "gauss",
+                "lognormal": "lognormvariate"}[distribution]
+        sample = lambda rng: getattr(rng, method)(*args)
+    else:
+        raise ValueError("Unknown latency distribution: %s" % distribution)
+    return lambda rng: max(0.0, sample(rng))
+
+
+class GatewaySimulator(object):
+    """
+    Serves simulated AIM and ARB responses
+
+    ``decline_rate`` and ``error_rate`` are probabilities between ``0`` and
+    ``1``.  ``error_mode`` selects what an injected error looks like:
+
+    * ``gateway``: a well-formed error response from the gateway
+    * ``http``: an HTTP 500 with an empty body
+    * ``disconnect``: the connection is closed without any response
+    """
+    def __init__(self, host="127.0.0.1", port=8099, latency=0,
+            decline_rate=0.0, error_rate=0.0, error_mode="gateway",
+            seed=None):
+        if error_mode not in ERROR_MODES:
+            raise ValueError("error_mode must be one of %s" % (
+                    ", ".join(ERROR_MODES)))
+        self.latency = parse_latency(latency)
+        self.decline_rate = decline_rate
+        self.error_rate = error_rate
+        self.error_mode = error_mode
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.server = ThreadingHTTPServer((host, port), SimulatorHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server.server_address[:2]
+
+    def serve_forever(self, poll_interval=0.5):
+        self.server.serve_forever(poll_interval=poll_interval)
+
+    def start(self):
+        """Serves requests on a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever,
+                kwargs={"poll_interval": 0.05},
+                name="donations-gateway-simulator")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def draw(self):
+        """Decides the delay and outcome of the next request"""
+        with self.random_lock:
+            delay = self.latency(self.random)
+            roll = self.random.random()
+        if roll < self.error_rate:
+            return delay, "error"
+        if roll < self.error_rate + self.decline_rate:
+            return delay, "declined"
+        return delay, "approved"
+
+    def next_id(self):
+        return u"%d" % self.ids.next()
+
+    def aim_response(self, fields, outcome):
+        return aim_response(fields, outcome, self.next_id())
+
+    def arb_response(self, body, outcome):
+        return arb_response(body, outcome, self.next_id())
+
+
+def aim_response(fields, outcome, trans_id):
+    """Returns the AIM direct response to a request with ``fields``"""
+    code, reason_code, reason_text = {
+        "approved": APPROVED,
+        "declined": DECLINED,
+        "error": GATEWAY_ERROR,
+    }[outcome]
+    values = [u""] * AIM_RESPONSE_FIELDS
+    values[:9] = [code, u"1", reason_code, reason_text,
+            u"SIM%s" % trans_id[-3:] if code == u"1" else u"",
+            u"Y", trans_id, fields.get("x_invoice_num", u""),
+            fields.get("x_description", u"")]
+    values[9:21] = [fields.get("x_amount", u""), u"CC",
+            fields.get("x_type", u"auth_capture"),
+            fields.get("x_cust_id", u""), fields.get("x_first_name", u""),
+            fields.get("x_last_name", u""), fields.get("x_company", u""),
+            fields.get("x_address", u""), fields.get("x_city", u""),
+            fields.get("x_state", u""), fields.get("x_zip", u""),
+            fields.get("x_country", u"")]
+    delimiter = fields.get("x_delim_char", u"|") or u"|"
+    return delimiter.join(a.replace(delimiter, u" ") for a in values)
+
+
+def arb_response(body, outcome, subscription_id):
+    """Returns the ARB response to the XML request ``body``"""
+    try:
+        action = fromstring(body).tag.split("}")[-1]
+    except SyntaxError:
+        action = "ErrorResponse"
+    name = action.replace("Request", "Response")
+    if outcome == "approved":
+        result, code, text = u"Ok", u"I00001", u"Successful."
+    elif outcome == "declined":
+        result, code, text = (u"Error", u"E00027",
+                u"The transaction was unsuccessful.")
+    else:
+        result, code, text = (u"Error", u"E00001",
+                u"An error occurred during processing. Please try again.")
+    subscription = (u"<subscriptionId>%s</subscriptionId>" %
+            subscription_id if outcome == "approved" else u"")
+    return (u'<?xml version="1.0" encoding="utf-8"?>'
+            u'<%(name)s xmlns="AnetApi/xml/v1/schema/'
+            u'AnetApiSchema.xsd"><messages>'
+            u'<resultCode>%(result)s</resultCode><message>'
+            u'<code>%(code)s</code><text>%(text)s</text></message>'
+            u'</messages>%(subscription)s</%(name)s>' % {
+                "name": name,
+                "result": result,
+                "code": code,
+                "text": escape(text),
+                "subscription": subscription,
+            })
+
+
+def parse_aim_request(body):
+    return dict((k, v.decode("utf-8")) for k, v in
+            urlparse.parse_qsl(body, keep_blank_values=True))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        delay, outcome = simulator.draw()
+        if delay:
+            time.sleep(delay)
+        if outcome == "error" and simulator.error_mode == "disconnect":
+            self.close_connection = 1
+            return
+        if outcome == "error" and simulator.error_mode == "http":
+            return self.respond(500, "")
+        path = self.path.split("?", 1)[0]
+        if path == AIM_PATH:
+            return self.respond(200, simulator.aim_response(
+                    parse_aim_request(body), outcome),
+                    content_type="text/plain")
+        if path == ARB_PATH:
+            return self.respond(200, simulator.arb_response(body, outcome),
+                    content_type="text/xml")
+        self.respond(404, "")
+
+    def respond(self, status, content, content_type="text/plain"):
+        content = content.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "%s; charset=utf-8" % content_type)
+        self.send_header("Content-Length", "%d" % len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def get_simulator_address():
+    return getattr(settings, "ARMSTRONG_DONATIONS_SIMULATOR", DEFAULT_ADDRESS)
+
+
+class SimulatedApiMixin(object):
+    """Sends an ``authorize`` API's requests to the simulator over HTTP"""
+    connection_class = httplib.HTTPConnection
+
+    def __init__(self, *args, **kwargs):
+        self.simulator_address = kwargs.pop("simulator_address", None)
+        super(SimulatedApiMixin, self).__init__(*args, **kwargs)
+        self.server = self.simulator_address or get_simulator_address()
+
+    def request(self, body):
+        conn = self.connection_class(self.server)
+        conn.request("POST", self.path, body, headers=self.headers)
+        return self.parse_response(conn.getresponse().read())
+
+
+class SimulatedAimApi(SimulatedApiMixin, aim.Api):
+    pass
+
+
+class SimulatedArbApi(SimulatedApiMixin, arb.Api):
+    pass
+
+
+class StubResponse(object):
+    status = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content.encode("utf-8")
+
+
+class StubConnection(object):
+    """
+    Stands in for an ``httplib`` connection, approving every request
+
+    Requests are still built and responses still parsed, only the network
+    round trip is skipped.  Used for benchmarks and offline tests.
+    """
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.response = None
+
+    def connect(self):
+        pass
+
+    def request(self, method, path, body, headers=None):
+        trans_id = u"%d" % self.ids.next()
+        if path == AIM_PATH:
+            content = aim_response(parse_aim_request(body), "approved",
+                    trans_id)
+        else:
+            content = arb_response(body, "approved", trans_id)
+        self.response = StubResponse(content)
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        pass
+
+
+class StubAimApi(SimulatedAimApi):
+    connection_class = StubConnection
+
+
+class StubArbApi(SimulatedArbApi):
+    connection_class = StubConnection
+
+
+class SimulatedAuthorizeNetBackend(AuthorizeNetBackend):
+    """``AuthorizeNetBackend`` that talks to a ``GatewaySimulator``"""
+    def __init__(self, api_class=None, recurring_api_class=None, **kwargs):
+        super(SimulatedAuthorizeNetBackend, self).__init__(
+                api_class=api_class or SimulatedAimApi,
+                recurring_api_class=recurring_api_class or SimulatedArbApi,
+                **kwargs)
@@ -0,0 +1,2 @@
+-- Index backing deferred.run_pending's search for due tasks
+CREATE INDEX donations_deferredreceivertask_status_run_at ON donations_deferredreceivertask (status, run_at);
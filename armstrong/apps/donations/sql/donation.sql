@@ -0,0 +1,4 @@
+-- Indexes backing the reports in managers.DonationQuerySet
+CREATE INDEX donations_donation_processed_created ON donations_donation (processed, created);
+CREATE INDEX donations_donation_type_created ON donations_donation (donation_type_id, created);
+CREATE INDEX donations_donation_code_created ON donations_donation (code_id, created);
@@ -0,0 +1,2 @@
+-- Index backing retries.RetryQueue.drain's search for due retries
+CREATE INDEX donations_purchasejob_status_next_attempt ON donations_purchasejob (status, next_attempt);
@@ -0,0 +1,39 @@
+from django import template
+
+from .. import models
+from .. import progress
+
+register = template.Library()
+
+
+class CampaignProgressNode(template.Node):
+    def __init__(self, slug, var_name):
+        self.slug = slug
+        self.var_name = var_name
+
+    def render(self, context):
+        try:
+            context[self.var_name] = progress.get_progress(
+                    self.slug.resolve(context))
+        except models.Campaign.DoesNotExist:
+            context[self.var_name] = None
+        return ""
+
+
+@register.tag
+def get_campaign_progress(parser, token):
+    """
+    Puts a campaign's progress into the context
+
+    ::
+
+        {% get_campaign_progress "pledge-drive" as progress %}
+        {{ progress.raised }} of {{ progress.goal }} ({{ progress.percent }}%)
+
+    The variable is set to ``None`` if there is no campaign with that slug.
+    """
+    bits = token.split_contents()
+    if len(bits) != 4 or bits[2] != "as":
+        raise template.TemplateSyntaxError(
+                "Usage: {%% %s <slug> as <variable> %%}" % bits[0])
+    return CampaignProgressNode(parser.compile_filter(bits[1]), bits[3])
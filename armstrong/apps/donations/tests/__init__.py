@@ -1,4 +1,23 @@
 from .backends import *
+from .benchmarks import *
+from .breakers import *
+from .cassettes import *
+from .deferred import *
+from .exports import *
 from .forms import *
+from .idempotency import *
+from .imports import *
+from .lookups import *
+from .managers import *
+from .metrics import *
 from .models import *
+from .pools import *
+from .progress import *
+from .queues import *
+from .retries import *
+from .rollups import *
+from .routing import *
+from .simulator import *
+from .timing import *
 from .views import *
+from .workers import *
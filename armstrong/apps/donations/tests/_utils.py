@@ -6,8 +6,12 @@ from django.test.client import RequestFactory
 import fudge
 import random
 
+from .. import backends
+from .. import breakers
 from .. import forms
+from .. import lookups
 from .. import models
+from .. import queries
 from ..models import (Donation, DonorAddress, Donor, DonationType, PromoCode)
 
 
@@ -24,10 +28,17 @@ class TestCase(ArmstrongTestCase):
         super(TestCase, self).setUp()
         # TODO: move this to armstrong.dev
         self.factory = RequestFactory()
+        backends.clear_backend_cache()
+        breakers.clear_breakers()
+        lookups.clear()
 
     def tearDown(self):
         self.restore_patched_objects()
 
+    def assertQueryBudget(self, budget, using="default"):
+        """Fails if the ``with`` block runs more than ``budget`` queries"""
+        return queries.QueryBudget(budget, using=using)
+
     def restore_patched_objects(self):
         if hasattr(self, "patches"):
             [p.restore() for p in self.patches]
@@ -1,3 +1,4 @@
+from armstrong.dev.tests.utils.backports import override_settings
 from authorize import aim, arb
 import datetime
 from django.conf import settings as django_settings
@@ -10,9 +11,12 @@ import unittest
 from ._utils import TestCase
 
 from .. import backends
+from .. import cassettes
 from .. import forms
 from .. import models
+from .. import pools
 from .. import signals
+from .. import workers
 
 
 class BackendTestCase(TestCase):
@@ -43,6 +47,33 @@ class BackendTestCase(TestCase):
         signals.successful_purchase.disconnect(signal)
 
 
+class GetBackendTestCase(TestCase):
+    def test_returns_the_same_backend_on_repeated_calls(self):
+        self.assertTrue(backends.get_backend() is backends.get_backend())
+
+    def test_rebuilds_backend_when_gateway_settings_change(self):
+        backend = backends.get_backend()
+        with override_settings(ARMSTRONG_DONATIONS_TESTING=True):
+            self.assertFalse(backend is backends.get_backend())
+
+    def test_rebuilds_backend_when_backend_setting_changes(self):
+        backend = backends.get_backend()
+        with override_settings(ARMSTRONG_DONATIONS_BACKEND=
+                "armstrong.apps.donations.backends.AuthorizeNetBackend"):
+            other = backends.get_backend()
+        self.assertFalse(backend is other)
+        self.assertIsA(other, backends.AuthorizeNetBackend)
+
+    def test_clear_backend_cache_forces_a_rebuild(self):
+        backend = backends.get_backend()
+        backends.clear_backend_cache()
+        self.assertFalse(backend is backends.get_backend())
+
+    def test_arguments_bypass_the_cache(self):
+        backend = backends.get_backend()
+        self.assertFalse(backend is backends.get_backend(testing=True))
+
+
 class AuthorizeNetBackendTestCase(TestCase):
     def get_api_stub(self, response=None, reason_text=None, successful=True):
         if response is None:
@@ -234,7 +265,7 @@ class AuthorizeNetBackendTestCase(TestCase):
         fudge.verify()
 
     def test_includes_donation_type_if_provided_for_transaction(self):
-        donation, donation_form = self.random_donation_and_form
+        donation, donation_form = self.get_recorded_donation_and_form()
         donation.donation_type = self.random_monthly_type
 
         api = fudge.Fake("api")
@@ -256,9 +287,12 @@ class AuthorizeNetBackendTestCase(TestCase):
         ).returns({"reason_code": u"1", "reason_text": u"Some random Reason"})
         get_api = fudge.Fake().expects_call().returns(api)
 
-        backend = backends.AuthorizeNetBackend()
-        with fudge.patched_context(backend, "get_api", get_api):
-            backend.purchase(donation, donation_form)
+        with get_cassette("arb_create_subscription",
+                ignore=ARB_IGNORED) as cassette:
+            backend = backends.AuthorizeNetBackend(
+                    recurring_api_class=cassette.wrap(arb.Api))
+            with fudge.patched_context(backend, "get_api", get_api):
+                backend.purchase(donation, donation_form)
         fudge.verify()
 
     def test_dont_include_repeats_suffix_if_one_time(self):
@@ -379,6 +413,69 @@ class AuthorizeNetBackendTestCase(TestCase):
                     u"(TESTMODE) The credit card number is invalid.",
                     msg="Authorize.net really has failed us")
 
+    def get_recorded_donation_and_form(self):
+        """
+        Returns the donation and form the requests in _cassettes were for
+
+        They are the same on every run, apart from what the cassettes scrub
+        or ignore, so replayed requests can be checked against the recording.
+        The card is Authorize.net's test Visa.
+        """
+        address = models.DonorAddress.objects.create(address=u"1 Main St",
+                city=u"Anytown", state=u"TX", zipcode=u"78701")
+        donor = models.Donor.objects.create(first_name=u"Bob",
+                last_name=u"Example", address=address,
+                mailing_address=address)
+        donation = models.Donation.objects.create(amount=1, donor=donor)
+        donation_form = forms.AuthorizeDonationForm(self.get_base_random_data(
+                first_name=u"Bob", last_name=u"Example", amount=u"1",
+                card_number=u"4222222222222"))
+        self.assertTrue(donation_form.is_valid(), msg="sanity check")
+        return donation, donation_form
+
+    def test_replays_recorded_aim_transaction(self):
+        class TestableApi(aim.Api):
+            def __init__(self, *args, **kwargs):
+                kwargs["is_test"] = True
+                super(TestableApi, self).__init__(*args, **kwargs)
+
+            def transaction(self, **kwargs):
+                kwargs["test_request"] = u"TRUE"
+                return super(TestableApi, self).transaction(**kwargs)
+
+        donation, donation_form = self.get_recorded_donation_and_form()
+        with get_cassette("aim_transaction") as cassette:
+            backend = backends.AuthorizeNetBackend(
+                    api_class=cassette.wrap(TestableApi),
+                    settings=self.test_settings)
+            result = backend.purchase(donation, donation_form)
+        self.assertTrue(result["status"])
+
+    def test_replays_recorded_arb_subscription(self):
+        onetime_purchase = fudge.Fake().is_callable().returns({"status": True})
+
+        class TestableApi(arb.Api):
+            def __init__(self, *args, **kwargs):
+                kwargs["is_test"] = True
+                super(TestableApi, self).__init__(*args, **kwargs)
+
+            def create_subscription(self, **kwargs):
+                kwargs["test_request"] = u"TRUE"
+                return super(TestableApi, self).create_subscription(**kwargs)
+
+        donation, donation_form = self.get_recorded_donation_and_form()
+        donation.donation_type = self.random_monthly_type
+        with get_cassette("arb_create_subscription",
+                ignore=ARB_IGNORED) as cassette:
+            backend = backends.AuthorizeNetBackend(
+                    recurring_api_class=cassette.wrap(TestableApi),
+                    settings=self.test_settings)
+            with fudge.patched_context(backend, "onetime_purchase",
+                    onetime_purchase):
+                result = backend.purchase(donation, donation_form)
+        self.assertTrue(result["status"])
+        self.assertTrue(result["recurring_response"]["status"])
+
     def test_mark_donation_as_processed(self):
         donation, donation_form = self.random_donation_and_form
         self.assertFalse(donation.processed, msg="sanity check")
@@ -568,6 +665,29 @@ class AuthorizeNetBackendTestCase(TestCase):
                 backend.purchase(donation, donation_form)
         fudge.verify()
 
+    def test_failed_recurring_purchase_still_completes_the_charge(self):
+        donation, donation_form = self.random_donation_and_form
+        donation.donation_type = self.random_monthly_type
+        recurring_purchase = (fudge.Fake().is_callable()
+                .raises(pools.GatewayHTTPError(502)))
+        onetime_purchase = (fudge.Fake().is_callable()
+                .returns({"status": True}))
+
+        backend = backends.AuthorizeNetBackend()
+        signal = fudge.Fake().expects_call()
+        signals.successful_purchase.connect(signal)
+        with stub_recurring_purchase(backend, recurring_purchase):
+            with stub_onetime_purchase(backend, onetime_purchase):
+                result = backend.purchase(donation, donation_form)
+        signals.successful_purchase.disconnect(signal)
+        fudge.verify()
+        self.assertTrue(result["status"])
+        self.assertEqual({
+            "status": False,
+            "reason": u"Gateway responded with HTTP 502",
+        }, result["recurring_response"])
+        self.assertTrue(models.Donation.objects.get(pk=donation.pk).processed)
+
     def test_adds_recurring_response_to_return_on_failure(self):
         random_return = random.randint(1000, 2000)
         donation, donation_form = self.random_donation_and_form
@@ -605,6 +725,109 @@ class AuthorizeNetBackendTestCase(TestCase):
         fudge.verify()
         signals.successful_purchase.disconnect(signal)
 
+    def test_defer_recurring_defaults_to_false(self):
+        backend = backends.AuthorizeNetBackend()
+        self.assertFalse(backend.defer_recurring)
+
+    def test_defer_recurring_uses_settings_for_default_value(self):
+        settings = self.test_settings
+        settings.ARMSTRONG_DONATIONS_DEFER_RECURRING = True
+        backend = backends.AuthorizeNetBackend(settings=settings)
+        self.assertTrue(backend.defer_recurring)
+
+    def test_deferred_recurring_purchase_runs_on_recurring_workers(self):
+        donation, donation_form = self.random_donation_and_form
+        donation.donation_type = self.random_monthly_type
+        onetime_purchase = (fudge.Fake().is_callable()
+                .returns({"status": True}))
+        recurring_workers = (fudge.Fake().expects("submit")
+                .with_args(arg.any(), donation, donation_form, arg.any()))
+        get_recurring_workers = (fudge.Fake().is_callable()
+                .returns(recurring_workers))
+
+        backend = backends.AuthorizeNetBackend(defer_recurring=True)
+        with stub_onetime_purchase(backend, onetime_purchase):
+            with fudge.patched_context(backend, "get_recurring_workers",
+                    get_recurring_workers):
+                result = backend.purchase(donation, donation_form)
+        fudge.verify()
+        self.assertTrue(result["status"])
+        self.assertEqual(None, result["recurring_response"])
+
+    def test_deferred_recurring_purchase_marks_donation_processed(self):
+        donation, donation_form = self.random_donation_and_form
+        donation.donation_type = self.random_monthly_type
+        onetime_purchase = (fudge.Fake().is_callable()
+                .returns({"status": True}))
+        recurring_workers = fudge.Fake().provides("submit")
+        get_recurring_workers = (fudge.Fake().is_callable()
+                .returns(recurring_workers))
+
+        backend = backends.AuthorizeNetBackend(defer_recurring=True)
+        with stub_onetime_purchase(backend, onetime_purchase):
+            with fudge.patched_context(backend, "get_recurring_workers",
+                    get_recurring_workers):
+                backend.purchase(donation, donation_form)
+        self.assertTrue(models.Donation.objects.get(pk=donation.pk).processed)
+
+    def test_deferred_recurring_purchase_fires_signal_with_response(self):
+        random_return = random.randint(1000, 2000)
+        donation, form = self.random_donation_and_form
+        donation.donation_type = self.random_monthly_type
+        onetime_purchase = (fudge.Fake().is_callable()
+                .returns({"status": True}))
+        recurring_purchase = (fudge.Fake().is_callable()
+                .returns(random_return))
+        get_recurring_workers = (fudge.Fake().is_callable()
+                .returns(workers.WorkerPool(0)))
+
+        backend = backends.AuthorizeNetBackend(defer_recurring=True)
+        signal = (fudge.Fake().expects_call()
+                .with_args(sender=backend, donation=donation,
+                        signal=arg.any(), form=form, result={
+                            "status": True,
+                            "recurring_response": random_return,
+                        }))
+        signals.successful_purchase.connect(signal)
+        with stub_onetime_purchase(backend, onetime_purchase):
+            with stub_recurring_purchase(backend, recurring_purchase):
+                with fudge.patched_context(backend, "get_recurring_workers",
+                        get_recurring_workers):
+                    backend.purchase(donation, form)
+
+        fudge.verify()
+        signals.successful_purchase.disconnect(signal)
+
+    def test_failed_deferred_recurring_purchase_still_fires_signal(self):
+        donation, form = self.random_donation_and_form
+        donation.donation_type = self.random_monthly_type
+        onetime_purchase = (fudge.Fake().is_callable()
+                .returns({"status": True}))
+        recurring_purchase = (fudge.Fake().is_callable()
+                .raises(pools.GatewayUnreachable("refused")))
+        get_recurring_workers = (fudge.Fake().is_callable()
+                .returns(workers.WorkerPool(0)))
+
+        backend = backends.AuthorizeNetBackend(defer_recurring=True)
+        signal = (fudge.Fake().expects_call()
+                .with_args(sender=backend, donation=donation,
+                        signal=arg.any(), form=form, result={
+                            "status": True,
+                            "recurring_response": {
+                                "status": False,
+                                "reason": u"refused",
+                            },
+                        }))
+        signals.successful_purchase.connect(signal)
+        with stub_onetime_purchase(backend, onetime_purchase):
+            with stub_recurring_purchase(backend, recurring_purchase):
+                with fudge.patched_context(backend, "get_recurring_workers",
+                        get_recurring_workers):
+                    backend.purchase(donation, form)
+
+        fudge.verify()
+        signals.successful_purchase.disconnect(signal)
+
 from contextlib import contextmanager
 
 
@@ -620,3 +843,14 @@ def stub_onetime_purchase(backend, onetime_purchase):
     with fudge.patched_context(backend, "onetime_purchase",
             onetime_purchase):
         yield
+
+
+CASSETTES = os.path.join(os.path.dirname(__file__), "_cassettes")
+# Subscriptions start 30 days after the day the tests run
+ARB_IGNORED = ("startDate", )
+
+
+def get_cassette(name, **kwargs):
+    """Returns the recorded gateway exchanges in _cassettes/``name``.json"""
+    return cassettes.Cassette(os.path.join(CASSETTES, "%s.json" % name),
+            **kwargs)
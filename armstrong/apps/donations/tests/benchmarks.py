@@ -0,0 +1,65 @@
+from django.conf import settings
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import benchmarks
+from .. import models
+
+
+class BenchmarksTestCase(TestCase):
+    def result(self, median=0.01, queries=3, objects=100):
+        return {"median": median, "queries": queries, "objects": objects}
+
+    def test_every_benchmark_runs(self):
+        results = benchmarks.run(iterations=2, warmup=0)
+        self.assertEqual(sorted(a.name for a in benchmarks.BENCHMARKS),
+                sorted(results["results"]))
+        for result in results["results"].values():
+            self.assertEqual(2, result["iterations"])
+            self.assertTrue(result["median"] > 0)
+        self.assertEqual("sqlite", results["environment"]["database"])
+
+    def test_records_queries(self):
+        results = benchmarks.run(["form_save", "form_construction"],
+                iterations=1, warmup=0)["results"]
+        self.assertEqual(3, results["form_save"]["queries"])
+        self.assertEqual(0, results["form_construction"]["queries"])
+
+    def test_purchases_use_the_stub_gateway(self):
+        benchmarks.run(["backend_purchase"], iterations=2, warmup=1)
+        self.assertEqual(4, models.Donation.objects.processed().count())
+
+    def test_restores_the_backend(self):
+        benchmarks.run(["form_construction"], iterations=1, warmup=0)
+        self.assertFalse(hasattr(settings, "ARMSTRONG_DONATIONS_BACKEND"))
+        self.assertFalse(isinstance(backends.get_backend(),
+                benchmarks.StubAuthorizeNetBackend))
+
+    def test_unknown_benchmarks_raise(self):
+        with self.assertRaises(ValueError):
+            benchmarks.run(["unknown"])
+
+    def test_summarize(self):
+        summary = benchmarks.summarize([0.3, 0.1, 0.2, 0.4])
+        self.assertAlmostEqual(0.25, summary["median"])
+        self.assertAlmostEqual(0.25, summary["mean"])
+        self.assertAlmostEqual(0.1, summary["min"])
+        self.assertAlmostEqual(4.0, summary["per_second"])
+
+    def test_compare_flags_regressions(self):
+        baseline = {"results": {"a": self.result(), "b": self.result()}}
+        current = {"results": {"a": self.result(median=0.02),
+                "b": self.result(queries=4, median=0.011), "c": {}}}
+        regressed = [(a["benchmark"], a["metric"]) for a in
+                benchmarks.compare(current, baseline) if a["regressed"]]
+        self.assertEqual([("a", "median"), ("b", "queries")], regressed)
+
+    def test_compare_allows_tolerance(self):
+        baseline = {"results": {"a": self.result()}}
+        current = {"results": {"a": self.result(median=0.012,
+                objects=110)}}
+        self.assertFalse(any(a["regressed"] for a in benchmarks.compare(
+                current, baseline, tolerance=0.25)))
+        self.assertTrue(any(a["regressed"] for a in benchmarks.compare(
+                current, baseline, tolerance=0.05)))
@@ -0,0 +1,200 @@
+from armstrong.dev.tests.utils.backports import override_settings
+import fudge
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import breakers
+from .. import models
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        super(CircuitBreakerTestCase, self).setUp()
+        self.clock = FakeClock()
+        self.breaker = breakers.CircuitBreaker(failure_threshold=2,
+                reset_timeout=30, clock=self.clock)
+
+    def trip(self):
+        for i in range(self.breaker.failure_threshold):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+
+    def test_starts_closed(self):
+        self.assertEqual(breakers.CircuitBreaker.CLOSED, self.breaker.state)
+        self.breaker.before_call()
+
+    def test_opens_after_failure_threshold(self):
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open)
+
+    def test_open_circuit_raises_circuit_open(self):
+        self.trip()
+        self.assertRaises(breakers.CircuitOpen, self.breaker.before_call)
+
+    def test_lets_one_probe_through_after_reset_timeout(self):
+        self.trip()
+        self.clock.now += 31
+        self.breaker.before_call()
+        self.assertEqual(breakers.CircuitBreaker.HALF_OPEN,
+                self.breaker.state)
+        self.assertRaises(breakers.CircuitOpen, self.breaker.before_call)
+
+    def test_successful_probe_closes_the_circuit(self):
+        self.trip()
+        self.clock.now += 31
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(breakers.CircuitBreaker.CLOSED, self.breaker.state)
+        self.breaker.before_call()
+
+    def test_failed_probe_reopens_the_circuit(self):
+        self.trip()
+        self.clock.now += 31
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertRaises(breakers.CircuitOpen, self.breaker.before_call)
+
+    def test_allows_calls_matches_before_call(self):
+        self.assertTrue(self.breaker.allows_calls)
+        self.trip()
+        self.assertFalse(self.breaker.allows_calls)
+        self.clock.now += 31
+        self.assertTrue(self.breaker.allows_calls)
+        self.breaker.before_call()
+        self.assertFalse(self.breaker.allows_calls)
+
+
+class GetBreakerTestCase(TestCase):
+    def test_returns_the_same_breaker_for_the_same_name(self):
+        self.assertTrue(breakers.get_breaker("foo") is
+                breakers.get_breaker("foo"))
+
+    def test_uses_configured_settings(self):
+        config = {"FAILURE_THRESHOLD": 3, "RESET_TIMEOUT": 5,
+                "HALF_OPEN_CALLS": 2}
+        with override_settings(ARMSTRONG_DONATIONS_CIRCUIT_BREAKER=config):
+            breaker = breakers.get_breaker("foo")
+        self.assertEqual(3, breaker.failure_threshold)
+        self.assertEqual(5, breaker.reset_timeout)
+        self.assertEqual(2, breaker.half_open_calls)
+
+
+class BackendCircuitBreakerTestCase(TestCase):
+    def get_backend(self, response=None, error=None, timeout=20):
+        api = fudge.Fake()
+        transaction = api.provides("transaction")
+        if error is not None:
+            transaction.raises(error)
+        else:
+            transaction.returns(response or {
+                "code": u"3",
+                "reason_code": u"19",
+                "reason_text": u"An error occurred during processing.",
+            })
+        settings = fudge.Fake().has_attr(
+                AUTHORIZE={"LOGIN": u"login", "KEY": u"key"},
+                ARMSTRONG_DONATIONS_GATEWAY_POOL={"SIZE": 0},
+                ARMSTRONG_DONATIONS_CIRCUIT_BREAKER={
+                    "FAILURE_THRESHOLD": 2,
+                    "TIMEOUT": timeout,
+                })
+        return backends.AuthorizeNetBackend(
+                api_class=fudge.Fake().is_callable().returns(api),
+                settings=settings)
+
+    def purchase(self, backend):
+        donation, form = self.random_donation_and_form
+        return backend.purchase(donation, form)
+
+    def test_gateway_errors_open_the_circuit(self):
+        backend = self.get_backend()
+        self.purchase(backend)
+        self.purchase(backend)
+        self.assertTrue(backend.get_circuit_breaker().is_open)
+        self.assertRaises(breakers.CircuitOpen, self.purchase, backend)
+
+    def test_exceptions_open_the_circuit(self):
+        backend = self.get_backend(error=IOError("timed out"))
+        for i in range(2):
+            self.assertRaises(IOError, self.purchase, backend)
+        self.assertRaises(breakers.CircuitOpen, self.purchase, backend)
+
+    def test_declines_do_not_open_the_circuit(self):
+        backend = self.get_backend(response={
+            "code": u"2",
+            "reason_code": u"2",
+            "reason_text": u"This transaction has been declined.",
+        })
+        for i in range(3):
+            self.assertFalse(self.purchase(backend)["status"])
+        self.assertFalse(backend.get_circuit_breaker().is_open)
+
+    def test_calls_over_the_timeout_budget_count_as_failures(self):
+        backend = self.get_backend(timeout=-1, response={
+            "code": u"1",
+            "reason_code": u"1",
+            "reason_text": u"This transaction has been approved.",
+        })
+        self.purchase(backend)
+        self.purchase(backend)
+        self.assertTrue(backend.get_circuit_breaker().is_open)
+
+    def test_open_circuit_does_not_contact_the_gateway(self):
+        backend = self.get_backend()
+        backend.get_circuit_breaker().record_failure()
+        backend.get_circuit_breaker().record_failure()
+        backend.get_api = fudge.Fake().is_callable().times_called(0)
+        self.assertRaises(breakers.CircuitOpen, self.purchase, backend)
+        fudge.verify()
+
+    def test_is_unavailable_while_the_circuit_is_open(self):
+        backend = self.get_backend()
+        self.assertTrue(backend.is_available())
+        backend.get_circuit_breaker().record_failure()
+        backend.get_circuit_breaker().record_failure()
+        self.assertFalse(backend.is_available())
+
+    def test_open_circuit_after_the_charge_still_completes_the_purchase(self):
+        backend = self.get_backend(response={
+            "code": u"1",
+            "reason_code": u"1",
+            "reason_text": u"This transaction has been approved.",
+        })
+        backend.recurring_purchase = fudge.Fake().is_callable().raises(
+                breakers.CircuitOpen("open"))
+        donation, form = self.random_donation_and_form
+        donation.donation_type = self.random_monthly_type
+        result = backend.purchase(donation, form)
+        self.assertTrue(result["status"])
+        self.assertFalse(result["recurring_response"]["status"])
+        self.assertTrue(models.Donation.objects.get(pk=donation.pk).processed)
+
+    def test_failing_to_get_a_client_does_not_leak_the_probe(self):
+        backend = self.get_backend()
+        breaker = backend.get_circuit_breaker()
+        breaker.clock = FakeClock()
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.clock.now += breaker.reset_timeout + 1
+        backend.get_api = fudge.Fake().is_callable().raises(
+                IOError("pool closed"))
+        self.assertRaises(IOError, self.purchase, backend)
+        self.assertTrue(breaker.is_open)
@@ -0,0 +1,128 @@
+from authorize import aim
+import os
+import shutil
+import tempfile
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import cassettes
+from .. import simulator
+
+
+class ScrubTestCase(TestCase):
+    def test_masks_card_and_credentials_in_aim_requests(self):
+        scrubbed = cassettes.scrub("x_login=secret-login&"
+                "x_tran_key=secret-key&x_card_num=4222222222222&"
+                "x_card_code=123&x_exp_date=01-2030&x_amount=10")
+        for value in ("secret", "4222222222222", "123", "2030"):
+            self.assertFalse(value in scrubbed, value)
+        self.assertTrue("x_card_num=XXXX2222" in scrubbed)
+        self.assertTrue("x_amount=10" in scrubbed)
+
+    def test_masks_card_and_credentials_in_arb_requests(self):
+        scrubbed = cassettes.scrub("<ARBCreateSubscriptionRequest>"
+                "<merchantAuthentication><name>secret-login</name>"
+                "<transactionKey>secret-key</transactionKey>"
+                "</merchantAuthentication><amount>10</amount>"
+                "<cardNumber>4222222222222</cardNumber>"
+                "<expirationDate>2030-01</expirationDate>"
+                "<cardCode>123</cardCode></ARBCreateSubscriptionRequest>")
+        for value in ("secret", "4222222222222", "123", "2030"):
+            self.assertFalse(value in scrubbed, value)
+        self.assertTrue("<cardNumber>XXXX2222</cardNumber>" in scrubbed)
+        self.assertTrue("<amount>10</amount>" in scrubbed)
+
+    def test_masks_ignored_fields_and_elements(self):
+        self.assertEqual(u"x_amount=XXXX", cassettes.scrub("x_amount=10",
+                ignore=("x_amount", )))
+        self.assertEqual(u"<startDate>XXXX</startDate>", cassettes.scrub(
+                "<startDate>2030-01-01</startDate>", ignore=("startDate", )))
+
+
+class CassetteTestCase(TestCase):
+    def setUp(self):
+        super(CassetteTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cassette.json")
+        self.donation_and_form = self.random_donation_and_form
+
+    def tearDown(self):
+        super(CassetteTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def purchase(self, cassette):
+        # The same donation each time, so replays match the recording
+        donation, form = self.donation_and_form
+        self.card_number = form.cleaned_data["card_number"]
+        backend = backends.AuthorizeNetBackend(
+                api_class=cassette.wrap(aim.Api), testing=True)
+        return backend.purchase(donation, form)
+
+    def record(self):
+        with cassettes.Cassette(self.path, mode="record",
+                connection_class=simulator.StubConnection) as cassette:
+            return self.purchase(cassette)
+
+    def test_records_exchanges_without_card_data(self):
+        self.record()
+        with open(self.path) as f:
+            content = f.read()
+        self.assertTrue(simulator.AIM_PATH in content)
+        self.assertTrue("x_card_num=XXXX" in content)
+        self.assertFalse(self.card_number in content)
+
+    def test_replays_recorded_responses(self):
+        recorded = self.record()
+        with cassettes.Cassette(self.path, mode="replay") as cassette:
+            replayed = self.purchase(cassette)
+        self.assertTrue(replayed["status"])
+        self.assertEqual(recorded["response"]["trans_id"],
+                replayed["response"]["trans_id"])
+
+    def test_replay_raises_once_out_of_responses(self):
+        self.record()
+        with cassettes.Cassette(self.path, mode="replay") as cassette:
+            self.purchase(cassette)
+            self.assertRaises(cassettes.CassetteError, self.purchase,
+                    cassette)
+
+    def test_replay_raises_if_the_request_does_not_match(self):
+        self.record()
+        donation, form = self.donation_and_form
+        donation.amount += 1
+        with cassettes.Cassette(self.path, mode="replay") as cassette:
+            self.assertRaises(cassettes.CassetteError, self.purchase,
+                    cassette)
+
+    def test_replay_does_not_compare_ignored_fields(self):
+        self.record()
+        donation, form = self.donation_and_form
+        donation.donor.first_name = u"Someone else"
+        with cassettes.Cassette(self.path, mode="replay",
+                ignore=("x_first_name", )) as cassette:
+            self.assertTrue(self.purchase(cassette)["status"])
+
+    def test_once_records_missing_cassettes_and_replays_existing_ones(self):
+        self.assertTrue(cassettes.Cassette(self.path,
+                mode="once").is_recording)
+        self.record()
+        self.assertFalse(cassettes.Cassette(self.path,
+                mode="once").is_recording)
+
+    def test_replays_by_default(self):
+        self.record()
+        previous = os.environ.pop("ARMSTRONG_DONATIONS_CASSETTES", None)
+        try:
+            self.assertEqual("replay", cassettes.Cassette(self.path).mode)
+        finally:
+            if previous is not None:
+                os.environ["ARMSTRONG_DONATIONS_CASSETTES"] = previous
+
+    def test_replay_raises_if_the_cassette_is_missing(self):
+        self.assertRaises(cassettes.CassetteError, cassettes.Cassette,
+                self.path, mode="replay")
+
+    def test_rejects_unknown_modes(self):
+        self.assertRaises(ValueError, cassettes.Cassette, self.path,
+                mode="rewind")
@@ -0,0 +1,192 @@
+from armstrong.dev.tests.utils.backports import override_settings
+import datetime
+from decimal import Decimal
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+import fudge
+from fudge.inspector import arg
+import json
+from StringIO import StringIO
+
+from ._utils import TestCase
+
+from .. import deferred
+from .. import models
+from .. import signals
+from .. import workers
+
+calls = []
+
+
+def record_call(sender, donation, form, result, **kwargs):
+    calls.append((sender, donation, form, result))
+
+
+@signals.deferrable
+def deferred_record_call(sender, donation, form, result, **kwargs):
+    calls.append((sender, donation, form, result))
+
+
+@signals.deferrable
+def failing_receiver(sender, donation, **kwargs):
+    calls.append(donation)
+    raise ValueError("Receiver failed")
+
+
+class DeferredReceiversTestCase(TestCase):
+    receivers = (record_call, deferred_record_call, failing_receiver)
+
+    def setUp(self):
+        super(DeferredReceiversTestCase, self).setUp()
+        del calls[:]
+        self.donation = models.Donation.objects.create(
+                donor=self.random_donor, amount=10)
+        self.patches = [fudge.patch_object(deferred, "get_workers",
+                lambda: workers.WorkerPool(0))]
+
+    def tearDown(self):
+        super(DeferredReceiversTestCase, self).tearDown()
+        for receiver in self.receivers:
+            signals.successful_purchase.disconnect(receiver)
+
+    def send(self, *receivers):
+        for receiver in receivers:
+            signals.successful_purchase.connect(receiver)
+        return signals.successful_purchase.send(sender="backend",
+                donation=self.donation, form="form",
+                result={"status": True, "amount": Decimal("10")})
+
+    def test_deferrable_receivers_run_inline_by_default(self):
+        self.send(deferred_record_call)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(0, models.DeferredReceiverTask.objects.count())
+
+    def test_unknown_modes_raise(self):
+        with override_settings(ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS="bad"):
+            with self.assertRaises(ImproperlyConfigured):
+                self.send(record_call)
+
+    def test_threads_mode_hands_deferrable_receivers_to_the_pool(self):
+        pool = fudge.Fake().expects("submit").with_args(
+                deferred.call_with_retries, deferred_record_call,
+                signals.successful_purchase, "backend", arg.any())
+        self.patches.append(fudge.patch_object(deferred, "get_workers",
+                lambda: pool))
+        with override_settings(
+                ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS="threads"):
+            self.send(record_call, deferred_record_call)
+        self.assertEqual([("backend", self.donation, "form")],
+                [a[:3] for a in calls])
+        fudge.verify()
+
+    def test_threads_mode_passes_the_usual_arguments(self):
+        with override_settings(
+                ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS="threads"):
+            self.send(deferred_record_call)
+        self.assertEqual([("backend", self.donation, "form")],
+                [a[:3] for a in calls])
+
+    def test_call_with_retries_backs_off_then_gives_up(self):
+        sleeps = []
+        with override_settings(ARMSTRONG_DONATIONS_DEFERRED_RETRIES=2,
+                ARMSTRONG_DONATIONS_DEFERRED_BACKOFF=1):
+            self.assertFalse(deferred.call_with_retries(failing_receiver,
+                    signals.successful_purchase, None,
+                    {"donation": self.donation}, sleep=sleeps.append))
+        self.assertEqual(3, len(calls))
+        self.assertEqual([1, 2], sleeps)
+
+    def test_database_mode_records_tasks(self):
+        with override_settings(
+                ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS="database"):
+            self.send(record_call, deferred_record_call)
+        self.assertEqual(1, len(calls))
+        task = models.DeferredReceiverTask.objects.get()
+        self.assertEqual(
+                "armstrong.apps.donations.tests.deferred.deferred_record_call",
+                task.receiver)
+        self.assertEqual({"status": True, "amount": "10"},
+                json.loads(task.result))
+
+    def test_run_pending_runs_due_tasks(self):
+        with override_settings(
+                ARMSTRONG_DONATIONS_DEFERRED_RECEIVERS="database"):
+            self.send(deferred_record_call)
+        self.assertEqual(1, deferred.run_pending())
+        self.assertEqual([(None, self.donation, None,
+                {"status": True, "amount": "10"})], calls)
+        self.assertEqual(models.DeferredReceiverTask.SUCCEEDED,
+                models.DeferredReceiverTask.objects.get().status)
+        self.assertEqual(0, deferred.run_pending())
+
+    def test_failed_tasks_are_retried_later_then_failed(self):
+        task = models.DeferredReceiverTask.objects.create(
+                donation=self.donation, receiver=deferred.get_receiver_path(
+                        failing_receiver))
+        now = datetime.datetime.now()
+        with override_settings(ARMSTRONG_DONATIONS_DEFERRED_RETRIES=1,
+                ARMSTRONG_DONATIONS_DEFERRED_BACKOFF=60):
+            deferred.run_pending(now=now)
+            task = models.DeferredReceiverTask.objects.get()
+            self.assertEqual(models.DeferredReceiverTask.PENDING, task.status)
+            self.assertEqual(now + datetime.timedelta(seconds=60),
+                    task.run_at)
+            self.assertTrue("Receiver failed" in task.last_error)
+            self.assertEqual(0, deferred.run_pending(now=now))
+            deferred.run_pending(now=task.run_at)
+        task = models.DeferredReceiverTask.objects.get()
+        self.assertEqual(models.DeferredReceiverTask.FAILED, task.status)
+        self.assertEqual(2, task.attempts)
+
+    def test_claimed_tasks_are_not_run_twice(self):
+        models.DeferredReceiverTask.objects.create(donation=self.donation,
+                receiver=deferred.get_receiver_path(deferred_record_call),
+                status=models.DeferredReceiverTask.RUNNING)
+        self.assertEqual(0, deferred.run_pending())
+
+    def create_stale_task(self, **kwargs):
+        task = models.DeferredReceiverTask.objects.create(
+                donation=self.donation,
+                receiver=deferred.get_receiver_path(deferred_record_call),
+                status=models.DeferredReceiverTask.RUNNING, **kwargs)
+        claimed = datetime.datetime.now() - datetime.timedelta(seconds=61)
+        models.DeferredReceiverTask.objects.filter(pk=task.pk).update(
+                updated=claimed)
+        return task
+
+    def test_tasks_running_past_the_lease_are_run_again(self):
+        self.create_stale_task()
+        with override_settings(ARMSTRONG_DONATIONS_DEFERRED_LEASE=60):
+            self.assertEqual(1, deferred.run_pending())
+        self.assertEqual(1, len(calls))
+        task = models.DeferredReceiverTask.objects.get()
+        self.assertEqual(models.DeferredReceiverTask.SUCCEEDED, task.status)
+        self.assertEqual(2, task.attempts)
+        self.assertEqual(deferred.LOST_RUN_ERROR, task.last_error)
+
+    def test_tasks_within_the_lease_are_left_running(self):
+        self.create_stale_task()
+        with override_settings(ARMSTRONG_DONATIONS_DEFERRED_LEASE=120):
+            self.assertEqual(0, deferred.run_pending())
+        self.assertEqual(models.DeferredReceiverTask.RUNNING,
+                models.DeferredReceiverTask.objects.get().status)
+
+    def test_stale_tasks_out_of_retries_are_failed(self):
+        self.create_stale_task(attempts=1)
+        with override_settings(ARMSTRONG_DONATIONS_DEFERRED_LEASE=60,
+                ARMSTRONG_DONATIONS_DEFERRED_RETRIES=1):
+            self.assertEqual(0, deferred.run_pending())
+        self.assertEqual([], calls)
+        task = models.DeferredReceiverTask.objects.get()
+        self.assertEqual(models.DeferredReceiverTask.FAILED, task.status)
+        self.assertEqual(2, task.attempts)
+
+    def test_command_drains_the_table(self):
+        for i in range(3):
+            models.DeferredReceiverTask.objects.create(
+                    donation=self.donation,
+                    receiver=deferred.get_receiver_path(deferred_record_call))
+        out = StringIO()
+        call_command("run_deferred_receivers", batch_size=2, stdout=out)
+        self.assertEqual(3, len(calls))
+        self.assertTrue("Ran 3" in out.getvalue())
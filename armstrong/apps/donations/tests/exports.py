@@ -0,0 +1,97 @@
+import csv
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+import json
+import os
+from StringIO import StringIO
+import tempfile
+
+from ._utils import TestCase
+
+from .. import exports
+from .. import models
+
+
+class ExportTestCase(TestCase):
+    def create_donations(self, count):
+        donor = self.random_donor
+        return [models.Donation.objects.create(donor=donor, amount=10 + i)
+                for i in range(count)]
+
+    def test_iter_chunks_returns_rows_in_chunks(self):
+        self.create_donations(5)
+        chunks = list(exports.iter_chunks(chunk_size=2))
+        self.assertEqual([2, 2, 1], [len(a) for a in chunks])
+
+    def test_each_chunk_is_a_single_query(self):
+        self.create_donations(4)
+        chunks = exports.iter_chunks(chunk_size=2)
+        with self.assertNumQueries(1):
+            rows = chunks.next()
+        self.assertEqual(rows[0]["first_name"],
+                models.Donation.objects.get(pk=rows[0]["id"])
+                        .donor.first_name)
+
+    def test_rows_include_joined_data(self):
+        option = self.random_type
+        code = self.random_discount
+        donation = models.Donation.objects.create(donor=self.random_donor,
+                amount=100, donation_type=option, code=code)
+        row = list(exports.iter_chunks())[0][0]
+        self.assertEqual(donation.donor.address.city, row["city"])
+        self.assertEqual(option.donation_type.name, row["donation_type"])
+        self.assertEqual(code.code, row["promo_code"])
+
+    def test_resumes_after_a_watermark(self):
+        donations = self.create_donations(3)
+        rows = [a for chunk in exports.iter_chunks(after=donations[0].pk)
+                for a in chunk]
+        self.assertEqual([a.pk for a in donations[1:]],
+                [a["id"] for a in rows])
+
+    def test_csv_export_has_a_header(self):
+        self.create_donations(3)
+        rows = list(csv.reader(StringIO("".join(exports.export("csv",
+                chunk_size=2)))))
+        self.assertEqual(exports.COLUMNS, rows[0])
+        self.assertEqual(4, len(rows))
+
+    def test_jsonl_export_has_one_object_per_line(self):
+        donations = self.create_donations(2)
+        lines = "".join(exports.export("jsonl")).splitlines()
+        self.assertEqual([a.pk for a in donations],
+                [json.loads(a)["id"] for a in lines])
+
+    def test_command_writes_and_resumes_from_watermark(self):
+        donations = self.create_donations(3)
+        watermark = tempfile.mktemp()
+        try:
+            out = StringIO()
+            call_command("export_donations", format="jsonl",
+                    watermark=watermark, stdout=out, stderr=StringIO())
+            self.assertEqual(3, len(out.getvalue().splitlines()))
+            self.assertEqual("%d" % donations[-1].pk,
+                    open(watermark).read().strip())
+
+            self.create_donations(1)
+            out = StringIO()
+            call_command("export_donations", format="jsonl",
+                    watermark=watermark, stdout=out, stderr=StringIO())
+            self.assertEqual(1, len(out.getvalue().splitlines()))
+        finally:
+            os.remove(watermark)
+
+    def test_view_streams_the_export(self):
+        self.create_donations(2)
+        request = self.factory.get("/export/", {"format": "jsonl"})
+        request.user = self.random_user
+        request.user.is_staff = True
+        response = exports.ExportView.as_view()(request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(response.content.splitlines()))
+
+    def test_view_is_limited_to_staff(self):
+        request = self.factory.get("/export/")
+        request.user = AnonymousUser()
+        response = exports.ExportView.as_view()(request)
+        self.assertEqual(302, response.status_code)
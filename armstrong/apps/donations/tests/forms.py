@@ -16,6 +16,10 @@ class DjangoFormAssertionsMixin(object):
                 msg="%s not in form errors" % field_name)
 
 
+class ReusingDonationForm(forms.BaseDonationForm):
+    reuse_donors = True
+
+
 class BaseDonationFormTestCase(DjangoFormAssertionsMixin, TestCase):
     def test_attribution_is_stored(self):
         random_attribution = "Random Attribution %d" % random.randint(100, 200)
@@ -192,6 +196,44 @@ class BaseDonationFormTestCase(DjangoFormAssertionsMixin, TestCase):
         form.mailing_address_form = is_valid_false
         self.assertTrue(form.is_valid())
 
+    def test_is_valid_only_validates_subforms_once(self):
+        form = forms.BaseDonationForm(data={
+                "first_name": "Foo",
+                "last_name": "Bar",
+                "amount": "10.00",
+        })
+        attrs = ["billing_address_form", "donor_form", "mailing_address_form"]
+        for attr in attrs:
+            setattr(form, attr, fudge.Fake().expects("is_valid")
+                    .returns(True).times_called(1))
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.is_valid(donation_only=True))
+        fudge.verify()
+
+    def test_is_valid_runs_again_when_data_changes(self):
+        form = forms.BaseDonationForm(data={
+                "first_name": "Foo",
+                "last_name": "Bar",
+                "amount": "10.00",
+        })
+        self.assertTrue(form.is_valid(donation_only=True))
+        form.data = {}
+        form._errors = None
+        self.assertFalse(form.is_valid(donation_only=True))
+
+    def test_is_valid_memoizes_donation_type_fallback(self):
+        donation_type = self.random_type
+        data = self.get_base_random_data(donation_type_pk=donation_type.pk)
+        data.update(self.prefix_data(self.random_address_kwargs,
+                prefix="billing"))
+        del data["amount"]
+        form = forms.BaseDonationForm(data=data)
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+            self.assertTrue(form.is_valid(donation_only=True))
+
     def test_saves_mailing_address_if_present(self):
         name_kwargs = self.random_donor_kwargs
         address_kwargs = self.random_address_kwargs
@@ -216,6 +258,86 @@ class BaseDonationFormTestCase(DjangoFormAssertionsMixin, TestCase):
         self.assertEqual(address, donor.address)
         self.assertEqual(mailing_address, donor.mailing_address)
 
+    def test_reuses_billing_address_if_mailing_address_is_identical(self):
+        address_kwargs = self.random_address_kwargs
+        data = self.get_base_random_data()
+        data.update(self.prefix_data(address_kwargs, prefix="billing"))
+        data.update(self.prefix_data(address_kwargs, prefix="mailing"))
+        del data[constants.MAILING_SAME_AS_BILLING]
+
+        donation = forms.BaseDonationForm(data=data).save()
+        self.assertEqual(1, models.DonorAddress.objects.count())
+        self.assertEqual(donation.donor.address,
+                donation.donor.mailing_address)
+
+    def test_reuses_donor_with_the_same_email_and_name(self):
+        address_kwargs = self.random_address_kwargs
+        data = self.get_base_random_data(email=u"bob@example.com")
+        data.update(self.prefix_data(address_kwargs, prefix="billing"))
+        first = ReusingDonationForm(data=data).save()
+        second = ReusingDonationForm(data=data).save()
+        self.assertEqual(first.donor, second.donor)
+        self.assertEqual(1, models.Donor.objects.count())
+        self.assertEqual(1, models.DonorAddress.objects.count())
+
+    def test_reused_donor_gets_new_address(self):
+        data = self.get_base_random_data(email=u"bob@example.com")
+        data.update(self.prefix_data(self.random_address_kwargs,
+                prefix="billing"))
+        ReusingDonationForm(data=data).save()
+        address_kwargs = dict(self.random_address_kwargs,
+                address=u"1 New St")
+        data.update(self.prefix_data(address_kwargs, prefix="billing"))
+        donation = ReusingDonationForm(data=data).save()
+        self.assertEqual(1, models.Donor.objects.count())
+        self.assertEqual(u"1 New St", models.Donor.objects.get(
+                pk=donation.donor.pk).address.address)
+
+    def test_reused_donor_keeps_fields_a_later_donation_leaves_out(self):
+        user = self.random_user
+        data = self.get_base_random_data(email=u"bob@example.com",
+                phone=u"5555551234", user_pk=user.pk)
+        ReusingDonationForm(data=data).save()
+        del data["user_pk"]
+        data["phone"] = u""
+        donation = ReusingDonationForm(data=data).save()
+        donor = models.Donor.objects.get(pk=donation.donor.pk)
+        self.assertEqual(1, models.Donor.objects.count())
+        self.assertEqual(user.pk, donor.user.pk)
+        self.assertEqual(u"5555551234", donor.phone)
+
+    def test_reused_donor_is_not_moved_to_another_user(self):
+        user = self.random_user
+        data = self.get_base_random_data(email=u"bob@example.com",
+                user_pk=user.pk)
+        ReusingDonationForm(data=data).save()
+        data["user_pk"] = self.random_user.pk
+        donation = ReusingDonationForm(data=data).save()
+        self.assertEqual(user.pk, models.Donor.objects.get(
+                pk=donation.donor.pk).user.pk)
+
+    def test_does_not_reuse_donors_by_default(self):
+        data = self.get_base_random_data(email=u"bob@example.com")
+        forms.BaseDonationForm(data=data).save()
+        forms.BaseDonationForm(data=data).save()
+        self.assertEqual(2, models.Donor.objects.count())
+
+    def test_save_records_its_query_count(self):
+        promo_code = self.random_discount
+        donation_type = self.random_type
+        data = self.get_base_random_data(donation_type_pk=donation_type.pk,
+                promo_code=promo_code.code)
+        data.update(self.prefix_data(self.random_address_kwargs,
+                prefix="billing"))
+        forms.BaseDonationForm(data=data).save()
+
+        data = dict(data, first_name=self.random_donor_name)
+        form = forms.BaseDonationForm(data=data)
+        # One insert each for the address, donor and donation
+        with self.assertNumQueries(3):
+            form.save()
+        self.assertEqual(3, form.save_query_count)
+
     def test_is_valid_is_true_if_donation_type_provided_and_no_amount(self):
         donation_type = self.random_type
         address_kwargs = self.random_address_kwargs
@@ -337,6 +459,22 @@ class CreditCardDonationFormTestCase(TestCase):
         self.assertEqual("", form["card_number"].value())
         self.assertNotEqual("", form["ccv_code"].value())
 
+    def test_is_valid_stays_memoized_after_stripping(self):
+        form = self.get_invalid_form()
+        form.is_donation_valid = (fudge.Fake().expects_call().returns(False)
+                .times_called(1))
+        self.assertFalse(form.is_valid())
+        self.assertFalse(form.is_valid())
+        fudge.verify()
+
+    def test_strip_sensitive_fields_clears_cleaned_data(self):
+        form = self.get_form(data=self.get_base_random_data())
+        self.assertTrue(form.is_valid())
+        form.strip_sensitive_fields()
+        self.assertEqual("", form.cleaned_data["card_number"])
+        self.assertEqual("", form.cleaned_data["ccv_code"])
+        self.assertEqual("", form["card_number"].value())
+
 
 class AuthorizeDonationFormTestCase(CreditCardDonationFormTestCase):
     form_class = forms.AuthorizeDonationForm
@@ -0,0 +1,101 @@
+from django.http import QueryDict
+import random
+from urllib import urlencode
+
+from ._utils import TestCase
+
+from .. import forms
+from .. import idempotency
+from .. import models
+
+
+class GetSubmissionKeyTestCase(TestCase):
+    def setUp(self):
+        super(GetSubmissionKeyTestCase, self).setUp()
+        self.data = self.get_base_random_data(submission_token=u"a" * 32,
+                amount=u"10")
+
+    def get_form(self, **kwargs):
+        data = dict(self.data)
+        data.update(kwargs)
+        return forms.AuthorizeDonationForm(QueryDict(urlencode(data)))
+
+    def test_returns_none_without_a_token(self):
+        form = self.get_form(submission_token=u"")
+        self.assertEqual(None, idempotency.get_submission_key(form))
+
+    def test_same_submission_has_the_same_key(self):
+        data = self.get_base_random_data(submission_token=u"a" * 32)
+        first = forms.AuthorizeDonationForm(data)
+        second = forms.AuthorizeDonationForm(dict(data))
+        self.assertEqual(idempotency.get_submission_key(first),
+                idempotency.get_submission_key(second))
+
+    def test_changed_submission_has_a_different_key(self):
+        self.assertNotEqual(
+                idempotency.get_submission_key(self.get_form(amount=u"10")),
+                idempotency.get_submission_key(self.get_form(amount=u"20")))
+
+    def test_different_tokens_have_different_keys(self):
+        self.assertNotEqual(
+                idempotency.get_submission_key(self.get_form()),
+                idempotency.get_submission_key(self.get_form(
+                        submission_token=u"b" * 32)))
+
+    def test_sensitive_fields_are_not_part_of_the_key(self):
+        self.assertEqual(
+                idempotency.get_submission_key(self.get_form(
+                        card_number=u"4222222222222222", ccv_code=u"123")),
+                idempotency.get_submission_key(self.get_form(
+                        card_number=u"5555555555554444", ccv_code=u"456")))
+
+    def test_forms_issue_a_fresh_token_when_displayed(self):
+        first = forms.BaseDonationForm()["submission_token"].value()
+        second = forms.BaseDonationForm()["submission_token"].value()
+        self.assertEqual(32, len(first))
+        self.assertNotEqual(first, second)
+
+
+class SubmissionCacheTestMixin(object):
+    def get_key(self):
+        return "key-%d" % random.randint(1000, 2000)
+
+    def test_claim_returns_none_for_new_keys(self):
+        self.assertEqual(None, self.get_cache().claim(self.get_key()))
+
+    def test_claim_returns_pending_entry_while_processing(self):
+        cache, key = self.get_cache(), self.get_key()
+        cache.claim(key)
+        self.assertEqual({"location": None}, cache.claim(key))
+
+    def test_claim_returns_location_of_completed_submission(self):
+        cache, key = self.get_cache(), self.get_key()
+        cache.claim(key)
+        cache.complete(key, "/thanks/")
+        self.assertEqual({"location": "/thanks/"}, cache.claim(key))
+
+    def test_released_keys_can_be_claimed_again(self):
+        cache, key = self.get_cache(), self.get_key()
+        cache.claim(key)
+        cache.release(key)
+        self.assertEqual(None, cache.claim(key))
+
+    def test_expired_keys_can_be_claimed_again(self):
+        cache, key = self.get_cache(ttl=-1), self.get_key()
+        cache.claim(key)
+        self.assertEqual(None, cache.claim(key))
+
+
+class MemorySubmissionCacheTestCase(SubmissionCacheTestMixin, TestCase):
+    def get_cache(self, ttl=60):
+        return idempotency.MemorySubmissionCache(ttl=ttl)
+
+
+class DatabaseSubmissionCacheTestCase(SubmissionCacheTestMixin, TestCase):
+    def get_cache(self, ttl=60):
+        return idempotency.DatabaseSubmissionCache(ttl=ttl)
+
+    def test_stores_submissions_in_the_database(self):
+        key = self.get_key()
+        self.get_cache().claim(key)
+        self.assertEqual(1, models.Submission.objects.filter(key=key).count())
@@ -0,0 +1,150 @@
+import datetime
+from decimal import Decimal
+from django.core.management import call_command
+import os
+from StringIO import StringIO
+import tempfile
+
+from ._utils import TestCase
+
+from .. import exports
+from .. import imports
+from .. import models
+
+
+class ImportTestCase(TestCase):
+    def row(self, **kwargs):
+        row = {
+            "created": "2011-06-01T12:30:00",
+            "amount": "25.00",
+            "processed": "1",
+            "anonymous": "0",
+            "first_name": "Bob",
+            "last_name": "Example",
+            "email": "bob@example.com",
+            "address": "123 Some St",
+            "city": "Anytown",
+            "state": "TX",
+            "zipcode": "78701",
+        }
+        row.update(kwargs)
+        return row
+
+    def test_imports_donations_with_donors_and_addresses(self):
+        stats = imports.Importer().import_rows([self.row()])
+        donation = models.Donation.objects.with_related().get()
+        self.assertEqual(datetime.datetime(2011, 6, 1, 12, 30),
+                donation.created)
+        self.assertEqual(Decimal("25"), donation.amount)
+        self.assertTrue(donation.processed)
+        self.assertEqual("bob@example.com", donation.donor.email)
+        self.assertEqual("Anytown", donation.donor.address.city)
+        self.assertEqual(donation.donor.get_key(), donation.donor.key)
+        self.assertEqual(None, donation.donor.mailing_address)
+        self.assertEqual(1, stats["donations"])
+
+    def test_donors_and_addresses_are_deduplicated(self):
+        rows = [self.row(), self.row(email="BOB@example.com"),
+                self.row(first_name="Alice", email="alice@example.com"),
+                self.row(mailing_address="123 Some St.",
+                        mailing_city="Anytown", mailing_state="TX",
+                        mailing_zipcode="78701")]
+        stats = imports.Importer(batch_size=2).import_rows(rows)
+        self.assertEqual(4, models.Donation.objects.count())
+        self.assertEqual(2, models.Donor.objects.count())
+        self.assertEqual(1, models.DonorAddress.objects.count())
+        self.assertEqual({"rows": 4, "donations": 4, "donors": 2,
+                "addresses": 1, "skipped": 0},
+                dict((a, stats[a]) for a in ("rows", "donations", "donors",
+                        "addresses", "skipped")))
+
+    def test_existing_donors_are_reused(self):
+        donor = models.Donor.objects.create(first_name="Bob",
+                last_name="Example", email="bob@example.com")
+        imports.Importer().import_rows([self.row()])
+        self.assertEqual(donor, models.Donation.objects.get().donor)
+        self.assertEqual(1, models.Donor.objects.count())
+
+    def test_donors_without_email_are_never_merged(self):
+        imports.Importer().import_rows([self.row(email=""),
+                self.row(email="")])
+        self.assertEqual(2, models.Donor.objects.count())
+        self.assertEqual(2, models.Donor.objects.filter(
+                donation__isnull=False).distinct().count())
+
+    def test_batches_use_a_fixed_number_of_queries(self):
+        rows = [self.row(email="donor%d@example.com" % i) for i in range(50)]
+        # addresses: lookup, insert, lookup; donors: the same; donations
+        with self.assertQueryBudget(7):
+            imports.Importer(batch_size=50).import_rows(rows)
+        self.assertEqual(50, models.Donation.objects.count())
+
+    def test_amounts_are_not_discounted_again(self):
+        code = self.random_discount
+        imports.Importer().import_rows([self.row(promo_code=code.code)])
+        donation = models.Donation.objects.get()
+        self.assertEqual(Decimal("25"), donation.amount)
+        self.assertEqual(code, donation.code)
+
+    def test_option_amount_is_used_without_an_amount(self):
+        option = self.random_type
+        imports.Importer().import_rows([self.row(amount="",
+                donation_type_option_id=str(option.pk))])
+        self.assertEqual(option.amount, models.Donation.objects.get().amount)
+
+    def test_invalid_rows_raise(self):
+        with self.assertRaises(imports.InvalidRow) as cm:
+            imports.Importer().import_rows([self.row(),
+                    self.row(promo_code="unknown")])
+        self.assertEqual(2, cm.exception.number)
+
+    def test_invalid_rows_can_be_skipped(self):
+        stats = imports.Importer(skip_invalid=True).import_rows([
+                self.row(amount="lots"), self.row(created="yesterday"),
+                self.row()])
+        self.assertEqual(2, stats["skipped"])
+        self.assertEqual(1, models.Donation.objects.count())
+
+    def test_progress_is_reported_after_each_batch(self):
+        reports = []
+        imports.Importer(batch_size=2, progress=lambda stats: reports.append(
+                stats["donations"])).import_rows([self.row()] * 5)
+        self.assertEqual([2, 4, 5], reports)
+
+    def test_exports_can_be_imported(self):
+        option = self.random_type
+        donor = self.random_donor
+        donor.email = "bob@example.com"
+        donor.address = self.random_address
+        donor.save()
+        models.Donation.objects.create(donor=donor, amount=10,
+                donation_type=option)
+        data = "".join(exports.export("jsonl"))
+        models.Donation.objects.all().delete()
+        stats = imports.import_file(StringIO(data), format="jsonl")
+        self.assertEqual(1, stats["donations"])
+        self.assertEqual(0, stats["donors"])
+        self.assertEqual(option, models.Donation.objects.get().donation_type)
+
+    def test_command_imports_csv(self):
+        data = "first_name,last_name,email,amount,created\n" \
+                "Bob,Example,bob@example.com,10,2011-01-01\n" \
+                "Alice,Example,alice@example.com,20,2011-01-02\n"
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.write(fd, data)
+        os.close(fd)
+        try:
+            err = StringIO()
+            call_command("import_donations", path, batch_size=1, stderr=err)
+        finally:
+            os.unlink(path)
+        self.assertEqual(Decimal("30"),
+                models.Donation.objects.summarize()["total"])
+        self.assertTrue("rows/sec" in err.getvalue())
+
+    def test_command_requires_a_known_format(self):
+        err = StringIO()
+        # call_command reports a CommandError on stderr and exits
+        with self.assertRaises(SystemExit):
+            call_command("import_donations", "donations.txt", stderr=err)
+        self.assertTrue("--format" in err.getvalue())
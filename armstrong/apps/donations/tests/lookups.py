@@ -0,0 +1,91 @@
+from django.core.cache import get_cache
+
+from ._utils import TestCase
+
+from .. import lookups
+from .. import models
+
+
+class LookupCacheTestCase(TestCase):
+    def test_finds_donation_type_options_by_pk(self):
+        option = self.random_type
+        self.assertEqual(option,
+                lookups.get_donation_type_option(option.pk))
+
+    def test_accepts_string_primary_keys(self):
+        option = self.random_type
+        self.assertEqual(option,
+                lookups.get_donation_type_option(u"%d" % option.pk))
+
+    def test_finds_donation_types_by_pk(self):
+        option = self.random_type
+        self.assertEqual(option.donation_type,
+                lookups.get_donation_type(option.donation_type.pk))
+
+    def test_finds_promo_codes_by_code(self):
+        code = self.random_discount
+        self.assertEqual(code, lookups.get_promo_code(code.code))
+
+    def test_raises_does_not_exist_for_unknown_rows(self):
+        self.assertRaises(models.DonationTypeOption.DoesNotExist,
+                lookups.get_donation_type_option, 1000)
+        self.assertRaises(models.DonationTypeOption.DoesNotExist,
+                lookups.get_donation_type_option, u"foo")
+        self.assertRaises(models.PromoCode.DoesNotExist,
+                lookups.get_promo_code, u"unknown")
+
+    def test_repeated_lookups_do_not_query(self):
+        option = self.random_type
+        code = self.random_discount
+        lookups.get_promo_code(code.code)
+        with self.assertNumQueries(0):
+            found = lookups.get_donation_type_option(option.pk)
+            found.name
+            lookups.get_promo_code(code.code)
+
+    def test_saving_a_model_invalidates_the_cache(self):
+        code = self.random_discount
+        lookups.get_promo_code(code.code)
+        code.amount = 50
+        code.save()
+        self.assertEqual(50, lookups.get_promo_code(code.code).amount)
+
+    def test_deleting_a_model_invalidates_the_cache(self):
+        option = self.random_type
+        lookups.get_donation_type_option(option.pk)
+        pk = option.pk
+        option.delete()
+        self.assertRaises(models.DonationTypeOption.DoesNotExist,
+                lookups.get_donation_type_option, pk)
+
+    def test_reloads_after_ttl(self):
+        cache = lookups.LookupCache(ttl=0)
+        code = self.random_discount
+        cache.get_promo_code(code.code)
+        models.PromoCode.objects.filter(pk=code.pk).update(amount=50)
+        self.assertEqual(50, cache.get_promo_code(code.code).amount)
+
+
+class SharedLookupCacheTestCase(TestCase):
+    def get_cache(self):
+        cache = get_cache("django.core.cache.backends.locmem.LocMemCache")
+        cache.clear()
+        return cache
+
+    def test_processes_sharing_a_cache_only_load_the_tables_once(self):
+        cache = self.get_cache()
+        code = self.random_discount
+        lookups.LookupCache(cache=cache).get_promo_code(code.code)
+        with self.assertNumQueries(0):
+            found = lookups.LookupCache(cache=cache).get_promo_code(code.code)
+        self.assertEqual(code, found)
+
+    def test_invalidating_one_process_reloads_the_others(self):
+        cache = self.get_cache()
+        code = self.random_discount
+        first = lookups.LookupCache(cache=cache)
+        second = lookups.LookupCache(cache=cache)
+        second.get_promo_code(code.code)
+        models.PromoCode.objects.filter(pk=code.pk).update(amount=50)
+        first.invalidate()
+        self.assertEqual(50, second.get_promo_code(code.code).amount)
@@ -0,0 +1,169 @@
+import datetime
+from decimal import Decimal
+from django.db import connection
+
+from ._utils import TestCase
+
+from .. import models
+from .. import queries
+
+
+class DonationManagerTestCase(TestCase):
+    def create_donation(self, amount, created, processed=True, **kwargs):
+        donation = models.Donation.objects.create(donor=self.random_donor,
+                amount=amount, processed=processed, **kwargs)
+        models.Donation.objects.filter(pk=donation.pk).update(
+                created=created)
+        return donation
+
+    def test_reporting_indexes_are_created(self):
+        if connection.vendor != "sqlite":
+            return
+        index_names = [a[0] for a in connection.cursor().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertTrue("donations_donation_processed_created"
+                in index_names)
+
+    def test_summarize_returns_total_and_count(self):
+        self.create_donation(10, datetime.datetime(2012, 1, 1))
+        self.create_donation(15, datetime.datetime(2012, 1, 2))
+        self.assertEqual({"total": Decimal("25"), "count": 2},
+                models.Donation.objects.summarize())
+
+    def test_summarize_of_nothing_is_zero(self):
+        self.assertEqual({"total": 0, "count": 0},
+                models.Donation.objects.summarize())
+
+    def test_totals_by_day(self):
+        self.create_donation(10, datetime.datetime(2012, 1, 1, 9))
+        self.create_donation(15, datetime.datetime(2012, 1, 1, 18))
+        self.create_donation(20, datetime.datetime(2012, 1, 3, 12))
+        self.assertEqual([
+            {"period": datetime.date(2012, 1, 1), "total": Decimal("25"),
+                    "count": 2},
+            {"period": datetime.date(2012, 1, 3), "total": Decimal("20"),
+                    "count": 1},
+        ], models.Donation.objects.totals_by_period("day"))
+
+    def test_totals_by_week_start_on_monday(self):
+        # 2012-01-02 was a Monday
+        self.create_donation(10, datetime.datetime(2012, 1, 2))
+        self.create_donation(15, datetime.datetime(2012, 1, 8))
+        self.create_donation(20, datetime.datetime(2012, 1, 9))
+        rows = models.Donation.objects.totals_by_period("week")
+        self.assertEqual([datetime.date(2012, 1, 2),
+                datetime.date(2012, 1, 9)], [a["period"] for a in rows])
+        self.assertEqual([2, 1], [a["count"] for a in rows])
+
+    def test_totals_by_month_can_be_filtered(self):
+        self.create_donation(10, datetime.datetime(2012, 1, 2))
+        self.create_donation(15, datetime.datetime(2012, 2, 8))
+        self.create_donation(20, datetime.datetime(2012, 2, 9),
+                processed=False)
+        rows = models.Donation.objects.processed().totals_by_period("month")
+        self.assertEqual([
+            {"period": datetime.date(2012, 1, 1), "total": Decimal("10"),
+                    "count": 1},
+            {"period": datetime.date(2012, 2, 1), "total": Decimal("15"),
+                    "count": 1},
+        ], rows)
+
+    def test_rejects_unknown_periods(self):
+        self.assertRaises(ValueError,
+                models.Donation.objects.totals_by_period, "fortnight")
+
+    def test_totals_by_donation_type(self):
+        option = self.random_type
+        self.create_donation(10, datetime.datetime(2012, 1, 2),
+                donation_type=option)
+        self.create_donation(15, datetime.datetime(2012, 1, 2))
+        rows = list(models.Donation.objects.totals_by_donation_type())
+        self.assertEqual(2, len(rows))
+        self.assertTrue({
+            "donation_type__donation_type": option.donation_type.pk,
+            "donation_type__donation_type__name": option.donation_type.name,
+            "total": Decimal("10"),
+            "count": 1,
+        } in rows)
+
+    def test_totals_by_promo_code(self):
+        code = self.random_discount
+        self.create_donation(100, datetime.datetime(2012, 1, 2), code=code)
+        rows = list(models.Donation.objects.totals_by_promo_code())
+        self.assertEqual([code.code], [a["code__code"] for a in rows])
+
+    def test_totals_by_processed(self):
+        self.create_donation(10, datetime.datetime(2012, 1, 2))
+        self.create_donation(15, datetime.datetime(2012, 1, 2),
+                processed=False)
+        rows = dict((a["processed"], a["total"]) for a in
+                models.Donation.objects.totals_by_processed())
+        self.assertEqual({True: Decimal("10"), False: Decimal("15")}, rows)
+
+    def test_created_between_excludes_the_end(self):
+        self.create_donation(10, datetime.datetime(2012, 1, 1))
+        self.create_donation(15, datetime.datetime(2012, 2, 1))
+        self.assertEqual(1, models.Donation.objects.created_between(
+                datetime.date(2012, 1, 1), datetime.date(2012, 2, 1)).count())
+
+
+class RelatedManagersTestCase(TestCase):
+    def create_donations(self, count=3):
+        for i in range(count):
+            donor = self.random_donor
+            donor.address = self.random_address
+            donor.mailing_address = self.random_address
+            donor.save()
+            models.Donation.objects.create(donor=donor, amount=10,
+                    donation_type=self.random_type)
+
+    def follow(self, donation):
+        return (unicode(donation), donation.is_repeating,
+                donation.donation_type.name, donation.donor.address.city,
+                donation.donor.mailing_address.zipcode)
+
+    def test_donations_with_related_are_listed_in_one_query(self):
+        self.create_donations()
+        with self.assertQueryBudget(1):
+            for donation in models.Donation.objects.with_related():
+                self.follow(donation)
+
+    def test_with_related_can_follow_other_filters(self):
+        self.create_donations()
+        with self.assertQueryBudget(1):
+            donations = list(models.Donation.objects.unprocessed()
+                    .with_related())
+            [self.follow(a) for a in donations]
+        self.assertEqual(3, len(donations))
+
+    def test_donations_without_related_rows_are_still_listed(self):
+        models.Donation.objects.create(donor=self.random_donor, amount=10)
+        donations = list(models.Donation.objects.with_related())
+        self.assertEqual(1, len(donations))
+        self.assertEqual(None, donations[0].donation_type)
+        self.assertFalse(donations[0].is_repeating)
+
+    def test_donors_with_related_are_listed_in_one_query(self):
+        self.create_donations()
+        with self.assertQueryBudget(1):
+            for donor in models.Donor.objects.with_related():
+                unicode(donor.address)
+                unicode(donor.mailing_address)
+
+    def test_options_always_include_their_donation_type(self):
+        self.random_type
+        self.random_type
+        with self.assertQueryBudget(1):
+            [a.name for a in models.DonationTypeOption.objects.all()]
+
+    def test_following_a_donations_option_includes_its_type(self):
+        self.create_donations(1)
+        donation = models.Donation.objects.get()
+        with self.assertQueryBudget(1):
+            donation.donation_type.name
+
+    def test_query_budget_fails_when_exceeded(self):
+        self.create_donations(2)
+        with self.assertRaises(queries.QueryBudgetExceeded):
+            with self.assertQueryBudget(1):
+                [unicode(a) for a in models.Donation.objects.all()]
@@ -0,0 +1,125 @@
+from armstrong.dev.tests.utils.backports import override_settings
+import fudge
+from fudge.inspector import arg
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import metrics
+
+
+class HistogramTestCase(TestCase):
+    def test_cumulative_counts_end_with_infinity(self):
+        histogram = metrics.Histogram(buckets=(1, 5))
+        for value in (0.5, 2, 2, 10):
+            histogram.observe(value)
+        self.assertEqual([(1, 1), (5, 3), (float("inf"), 4)],
+                histogram.cumulative())
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(14.5, histogram.sum)
+
+
+class StatsSinkTestCase(TestCase):
+    def test_counts_calls_by_outcome(self):
+        sink = metrics.StatsSink()
+        sink.record("transaction", 0.2, "approved")
+        sink.record("transaction", 0.3, "approved")
+        sink.record("transaction", 0.1, "declined")
+        self.assertEqual([
+            {"call": "transaction", "outcome": "approved", "count": 2},
+            {"call": "transaction", "outcome": "declined", "count": 1},
+        ], sink.stats()["calls"])
+
+    def test_counts_result_and_reason_codes(self):
+        sink = metrics.StatsSink()
+        sink.record("transaction", 0.2, "declined", result_code=u"2",
+                reason_code=u"27")
+        self.assertEqual([{"call": "transaction", "result_code": u"2",
+                "reason_code": u"27", "count": 1}], sink.stats()["codes"])
+
+    def test_tracks_latency_per_call(self):
+        sink = metrics.StatsSink(buckets=(1, ))
+        sink.record("create_subscription", 0.5, "approved")
+        latency = sink.stats()["latency"]["create_subscription"]
+        self.assertEqual(1, latency["count"])
+        self.assertEqual([(1, 1), (float("inf"), 1)], latency["buckets"])
+
+
+class LoggingSinkTestCase(TestCase):
+    def test_logs_each_call(self):
+        logger = fudge.Fake().expects("info").with_args(arg.any(),
+                "transaction", "error", None, None, 1.5)
+        sink = metrics.LoggingSink()
+        with fudge.patched_context(sink, "logger", logger):
+            sink.record("transaction", 1.5, "error")
+        fudge.verify()
+
+
+class RecordTestCase(TestCase):
+    def test_uses_stats_sink_by_default(self):
+        self.assertIsA(metrics.get_stats_sink(), metrics.StatsSink)
+
+    def test_passes_calls_to_configured_sinks(self):
+        with override_settings(ARMSTRONG_DONATIONS_METRICS_SINKS=(
+                "armstrong.apps.donations.metrics.LoggingSink", )):
+            sinks = metrics.get_sinks()
+            self.assertEqual(1, len(sinks))
+            self.assertIsA(sinks[0], metrics.LoggingSink)
+            self.assertEqual(None, metrics.get_stats_sink())
+
+    def test_backend_records_transactions(self):
+        donation, donation_form = self.random_donation_and_form
+        api = fudge.Fake().provides("transaction").returns({
+            "code": u"2",
+            "reason_code": u"27",
+            "reason_text": u"Declined",
+        })
+        record = (fudge.Fake().expects_call()
+                .with_args("transaction", arg.any(), "declined",
+                        result_code=u"2", reason_code=u"27"))
+        backend = backends.AuthorizeNetBackend()
+        with fudge.patched_context(backend, "get_api",
+                fudge.Fake().is_callable().returns(api)):
+            with fudge.patched_context(metrics, "record", record):
+                backend.purchase(donation, donation_form)
+        fudge.verify()
+
+    def test_backend_records_gateway_errors(self):
+        donation, donation_form = self.random_donation_and_form
+        api = fudge.Fake().provides("transaction").raises(IOError())
+        record = (fudge.Fake().expects_call()
+                .with_args("transaction", arg.any(), "error",
+                        result_code=None, reason_code=None))
+        backend = backends.AuthorizeNetBackend()
+        with fudge.patched_context(backend, "get_api",
+                fudge.Fake().is_callable().returns(api)):
+            with fudge.patched_context(metrics, "record", record):
+                self.assertRaises(IOError, backend.purchase, donation,
+                        donation_form)
+        fudge.verify()
+
+
+class GatewayMetricsViewTestCase(TestCase):
+    def test_renders_prometheus_text_format(self):
+        sink = metrics.StatsSink(buckets=(1, ))
+        sink.record("transaction", 0.5, "approved", result_code=u"1",
+                reason_code=u"1")
+        text = metrics.render_prometheus(sink)
+        for line in [
+            u'armstrong_donations_gateway_calls_total'
+                    u'{call="transaction",outcome="approved"} 1',
+            u'armstrong_donations_gateway_responses_total'
+                    u'{call="transaction",reason_code="1",result_code="1"} 1',
+            u'armstrong_donations_gateway_call_seconds_bucket'
+                    u'{call="transaction",le="+Inf"} 1',
+            u'armstrong_donations_gateway_call_seconds_count'
+                    u'{call="transaction"} 1',
+        ]:
+            self.assertTrue(line in text.split(u"\n"),
+                    msg="%s not in output" % line)
+
+    def test_view_uses_prometheus_content_type(self):
+        view = metrics.GatewayMetricsView.as_view()
+        response = view(self.factory.get("/metrics"))
+        self.assertEqual(metrics.PROMETHEUS_CONTENT_TYPE,
+                response["Content-Type"])
@@ -1,7 +1,9 @@
 from decimal import Decimal
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 import fudge
 import random
+from StringIO import StringIO
 from ._utils import generate_random_user
 from ._utils import TestCase
 
@@ -24,8 +26,32 @@ class DonorAddressTestCase(TestCase):
         expected = "%s, %s, %s, %d" % (address, city, state, zipcode)
         self.assertEqual(expected, str(donor_address))
 
+    def test_key_ignores_case_spacing_and_punctuation(self):
+        first = models.DonorAddress(address=u"123 Main St.", city=u"Austin",
+                state=u"TX", zipcode=u"78701")
+        second = models.DonorAddress(address=u" 123  main st ",
+                city=u"AUSTIN", state=u"tx", zipcode=u"78701-1234")
+        self.assertEqual(first.get_key(), second.get_key())
+
+    def test_key_is_stored_on_save(self):
+        address = self.random_address
+        self.assertEqual(address.get_key(), address.key)
+
 
 class DonorTestCase(TestCase):
+    def test_key_is_empty_without_an_email_address(self):
+        donor = Donor.objects.create(first_name=u"Bob", last_name=u"Example")
+        self.assertEqual(u"", donor.key)
+
+    def test_key_matches_normalized_email_and_name(self):
+        first = Donor(first_name=u"Bob", last_name=u"Example",
+                email=u"bob@example.com")
+        second = Donor(first_name=u"bob ", last_name=u"EXAMPLE",
+                email=u"Bob@Example.com")
+        self.assertEqual(first.get_key(), second.get_key())
+        second.first_name = u"Alice"
+        self.assertNotEqual(first.get_key(), second.get_key())
+
     def test_can_be_created_from_user_with_profile(self):
         user = generate_random_user()
         donor = Donor.objects.create(user=user)
@@ -234,3 +260,49 @@ class DonationWorkFlowTestCase(TestCase):
             code=discount
         )
         self.assertEqual(discount.calculate(donation_type), d.amount)
+
+
+class MergeDuplicateDonorsTestCase(TestCase):
+    def create_donor(self, address_kwargs):
+        address = models.DonorAddress.objects.create(**address_kwargs)
+        donor = Donor.objects.create(first_name=u"Bob", last_name=u"Example",
+                email=u"bob@example.com", address=address,
+                mailing_address=address)
+        Donation.objects.create(donor=donor, amount=10)
+        return donor
+
+    def test_merges_donors_and_their_addresses(self):
+        address_kwargs = self.random_address_kwargs
+        first = self.create_donor(address_kwargs)
+        self.create_donor(address_kwargs)
+        call_command("merge_duplicate_donors", batch_size=1,
+                stdout=StringIO())
+        self.assertEqual([first], list(Donor.objects.all()))
+        self.assertEqual([first.address],
+                list(models.DonorAddress.objects.all()))
+        self.assertEqual(2, first.donation_set.count())
+
+    def test_keeps_user_and_phone_only_set_on_a_duplicate(self):
+        address_kwargs = self.random_address_kwargs
+        first = self.create_donor(address_kwargs)
+        second = self.create_donor(address_kwargs)
+        user = generate_random_user()
+        Donor.objects.filter(pk=second.pk).update(user=user,
+                phone=u"5555551234")
+        call_command("merge_duplicate_donors", stdout=StringIO())
+        donor = Donor.objects.get()
+        self.assertEqual(first.pk, donor.pk)
+        self.assertEqual(user, donor.user)
+        self.assertEqual(u"5555551234", donor.phone)
+
+    def test_fills_in_missing_keys(self):
+        donor = self.create_donor(self.random_address_kwargs)
+        Donor.objects.filter(pk=donor.pk).update(key=u"")
+        call_command("merge_duplicate_donors", stdout=StringIO())
+        self.assertEqual(donor.get_key(), Donor.objects.get(pk=donor.pk).key)
+
+    def test_leaves_donors_without_email_alone(self):
+        for i in range(2):
+            Donor.objects.create(first_name=u"Bob", last_name=u"Example")
+        call_command("merge_duplicate_donors", stdout=StringIO())
+        self.assertEqual(2, Donor.objects.count())
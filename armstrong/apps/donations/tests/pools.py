@@ -0,0 +1,242 @@
+from authorize import aim
+import errno
+import fudge
+import httplib
+import random
+import socket
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import pools
+
+
+class GatewayClientPoolTestCase(TestCase):
+    def get_factory(self):
+        counter = {"count": 0}
+
+        def factory():
+            counter["count"] += 1
+            return "client %d" % counter["count"]
+        return factory
+
+    def test_acquire_builds_a_client_with_the_factory(self):
+        pool = pools.GatewayClientPool(self.get_factory())
+        self.assertEqual("client 1", pool.acquire())
+
+    def test_released_clients_are_reused(self):
+        pool = pools.GatewayClientPool(self.get_factory())
+        client = pool.acquire()
+        pool.release(client)
+        self.assertEqual(client, pool.acquire())
+
+    def test_checked_out_clients_are_not_handed_out_twice(self):
+        pool = pools.GatewayClientPool(self.get_factory())
+        self.assertNotEqual(pool.acquire(), pool.acquire())
+
+    def test_only_keeps_size_idle_clients(self):
+        pool = pools.GatewayClientPool(self.get_factory(), size=1)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(1, len(pool.idle))
+
+    def test_discards_clients_idle_longer_than_idle_timeout(self):
+        pool = pools.GatewayClientPool(self.get_factory(), idle_timeout=-1)
+        client = pool.acquire()
+        pool.release(client)
+        self.assertNotEqual(client, pool.acquire())
+
+    def test_discards_clients_that_fail_the_health_check(self):
+        health_check = (fudge.Fake().expects_call().with_args("client 1")
+                .returns(False))
+        pool = pools.GatewayClientPool(self.get_factory(),
+                health_check=health_check)
+        pool.release(pool.acquire())
+        self.assertEqual("client 2", pool.acquire())
+        fudge.verify()
+
+    def test_ignores_clients_it_did_not_create(self):
+        pool = pools.GatewayClientPool(self.get_factory())
+        pool.release("some random client %d" % random.randint(100, 200))
+        self.assertEqual(0, len(pool.idle))
+
+    def test_authorize_clients_keep_their_connection_alive(self):
+        factory = lambda: aim.Api(u"login", u"key", is_test=True)
+        pool = pools.GatewayClientPool(factory)
+        client = pool.acquire()
+        self.assertIsA(client.keep_alive, pools.KeepAliveConnection)
+        self.assertEqual(client.keep_alive.request, client.request)
+
+    def test_authorize_clients_connect_with_the_pool_timeout(self):
+        factory = lambda: aim.Api(u"login", u"key", is_test=True)
+        pool = pools.GatewayClientPool(factory, timeout=7)
+        connection = pool.acquire().keep_alive.connect()
+        self.assertEqual(7, connection.timeout)
+
+
+class KeepAliveConnectionTestCase(TestCase):
+    def get_api(self, connect=None, status=200):
+        response = fudge.Fake().provides("read").returns("").has_attr(
+                status=status)
+        connection = fudge.Fake()
+        if connect is None:
+            connection.provides("connect")
+        else:
+            connection.provides("connect").raises(connect)
+        connection.provides("request").provides("close")
+        connection.provides("getresponse").returns(response)
+        api = aim.Api(u"login", u"key", is_test=True)
+        api.connection_class = fudge.Fake().is_callable().returns(connection)
+        api.parse_response = lambda content: {}
+        return pools.keep_alive(api)
+
+    def test_failed_connections_raise_gateway_unreachable(self):
+        api = self.get_api(connect=socket.error(errno.ECONNREFUSED,
+                "Connection refused"))
+        self.assertRaises(pools.GatewayUnreachable, api.request, "<xml/>")
+
+    def test_requests_are_not_sent_again_if_the_connection_fails(self):
+        api = self.get_api()
+        connection = ConnectionDroppedAfterFirstRequest()
+        api.connection_class = fudge.Fake().is_callable().returns(connection)
+        api.request("<xml/>")
+        self.assertRaises(httplib.BadStatusLine, api.request, "<xml/>")
+        self.assertEqual(2, connection.requests)
+        self.assertEqual(None, api.keep_alive.connection)
+        self.assertFalse(backends.is_transient_error(
+                httplib.BadStatusLine("")))
+
+    def test_connections_closed_while_idle_are_replaced_before_sending(self):
+        api = self.get_api()
+        api.request("<xml/>")
+        stale = api.keep_alive.connection
+        ours, theirs = socket.socketpair()
+        theirs.close()
+        stale.has_attr(sock=ours).expects("close")
+        replacement = fudge.Fake().provides("connect").expects("request") \
+                .provides("getresponse").returns(fudge.Fake().provides("read")
+                        .returns("").has_attr(status=200))
+        api.connection_class = fudge.Fake().is_callable().returns(
+                replacement)
+        api.request("<xml/>")
+        ours.close()
+        fudge.verify()
+        self.assertTrue(api.keep_alive.connection is replacement)
+
+    def test_idle_connections_with_nothing_to_read_are_reused(self):
+        api = self.get_api()
+        api.request("<xml/>")
+        connection = api.keep_alive.connection
+        ours, theirs = socket.socketpair()
+        connection.has_attr(sock=ours)
+        api.request("<xml/>")
+        ours.close()
+        theirs.close()
+        self.assertTrue(api.keep_alive.connection is connection)
+
+    def test_server_errors_raise_gateway_http_error(self):
+        api = self.get_api(status=503)
+        try:
+            api.request("<xml/>")
+        except pools.GatewayHTTPError as e:
+            self.assertEqual(503, e.status)
+        else:
+            self.fail("GatewayHTTPError not raised")
+
+
+class ConnectionDroppedAfterFirstRequest(object):
+    """A connection the gateway drops without answering its second request"""
+    def __init__(self):
+        self.requests = 0
+
+    def connect(self):
+        pass
+
+    def request(self, method, path, body, headers=None):
+        self.requests += 1
+
+    def getresponse(self):
+        if self.requests > 1:
+            raise httplib.BadStatusLine("")
+        return fudge.Fake().provides("read").returns("").has_attr(status=200)
+
+    def close(self):
+        pass
+
+
+class GetPoolTestCase(TestCase):
+    def setUp(self):
+        super(GetPoolTestCase, self).setUp()
+        pools.clear_pools()
+
+    def tearDown(self):
+        super(GetPoolTestCase, self).tearDown()
+        pools.clear_pools()
+
+    def get_settings(self, **config):
+        return fudge.Fake().has_attr(ARMSTRONG_DONATIONS_GATEWAY_POOL=config,
+                AUTHORIZE={"LOGIN": u"login", "KEY": u"key"})
+
+    def test_returns_the_same_pool_for_the_same_key(self):
+        settings = self.get_settings()
+        pool = pools.get_pool(("key", ), None, settings=settings)
+        self.assertTrue(pool is pools.get_pool(("key", ), None,
+                settings=settings))
+
+    def test_returns_none_if_size_is_zero(self):
+        settings = self.get_settings(SIZE=0)
+        self.assertEqual(None, pools.get_pool(("key", ), None,
+                settings=settings))
+
+    def test_uses_configured_size_and_idle_timeout(self):
+        settings = self.get_settings(SIZE=10, IDLE_TIMEOUT=5)
+        pool = pools.get_pool(("key", ), None, settings=settings)
+        self.assertEqual(10, pool.size)
+        self.assertEqual(5, pool.idle_timeout)
+
+    def test_pools_with_different_timeouts_are_separate(self):
+        settings = self.get_settings()
+        pool = pools.get_pool(("key", ), None, settings=settings, timeout=5)
+        self.assertEqual(5, pool.timeout)
+        self.assertFalse(pool is pools.get_pool(("key", ), None,
+                settings=settings, timeout=10))
+
+    def test_backend_reuses_api_between_purchases(self):
+        api_class = fudge.Fake().expects_call().times_called(1).returns(
+                fudge.Fake())
+        backend = backends.AuthorizeNetBackend(api_class=api_class,
+                settings=self.get_settings())
+        api = backend.get_api()
+        backend.release_api(api)
+        self.assertTrue(api is backend.get_api())
+        fudge.verify()
+
+    def test_backend_gives_unpooled_api_a_socket_timeout(self):
+        api_class = fudge.Fake().expects_call().returns(
+                aim.Api(u"login", u"key", is_test=True))
+        settings = self.get_settings(SIZE=0)
+        settings.has_attr(ARMSTRONG_DONATIONS_CIRCUIT_BREAKER={"TIMEOUT": 7})
+        backend = backends.AuthorizeNetBackend(api_class=api_class,
+                settings=settings)
+        api = backend.get_api()
+        self.assertIsA(api.keep_alive, pools.KeepAliveConnection)
+        self.assertEqual(7, api.keep_alive.timeout)
+
+    def test_backend_closes_unpooled_api_when_released(self):
+        api = pools.keep_alive(aim.Api(u"login", u"key", is_test=True))
+        api.keep_alive.connection = fudge.Fake().expects("close")
+        backend = backends.AuthorizeNetBackend(
+                settings=self.get_settings(SIZE=0))
+        backend.release_api(api)
+        self.assertEqual(None, api.keep_alive.connection)
+        fudge.verify()
+
+    def test_backend_builds_new_api_when_pooling_is_disabled(self):
+        api_class = fudge.Fake().expects_call().times_called(2).returns(
+                fudge.Fake())
+        backend = backends.AuthorizeNetBackend(api_class=api_class,
+                settings=self.get_settings(SIZE=0))
+        backend.release_api(backend.get_api())
+        backend.get_api()
+        fudge.verify()
@@ -0,0 +1,169 @@
+from armstrong.dev.tests.utils.backports import override_settings
+import datetime
+from decimal import Decimal
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.template import Context
+from django.template import Template
+from django.template import TemplateSyntaxError
+import json
+from StringIO import StringIO
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import models
+from .. import progress
+
+
+class CampaignProgressTestCase(TestCase):
+    def setUp(self):
+        super(CampaignProgressTestCase, self).setUp()
+        progress.clear()
+        self.campaign = models.Campaign.objects.create(name="Pledge Drive",
+                slug="pledge-drive", goal=100,
+                start=datetime.datetime.now() - datetime.timedelta(days=1))
+
+    def create_donation(self, amount, **kwargs):
+        return models.Donation.objects.create(donor=self.random_donor,
+                amount=amount, processed=True, **kwargs)
+
+    def reload(self, campaign):
+        return models.Campaign.objects.get(pk=campaign.pk)
+
+    def test_record_donation_increments_the_counters(self):
+        for amount in (10, 15):
+            progress.record_donation(self.create_donation(amount))
+        campaign = self.reload(self.campaign)
+        self.assertEqual(Decimal("25"), campaign.raised)
+        self.assertEqual(2, campaign.donations)
+
+    def test_donations_outside_the_campaign_are_not_counted(self):
+        self.campaign.end = datetime.datetime.now() - datetime.timedelta(
+                hours=1)
+        self.campaign.save()
+        progress.record_donation(self.create_donation(10))
+        self.assertEqual(0, self.reload(self.campaign).donations)
+
+    def test_campaigns_limited_to_a_donation_type(self):
+        option = self.random_type
+        other = self.random_type
+        self.campaign.donation_type = option.donation_type
+        self.campaign.save()
+        progress.record_donation(self.create_donation(10,
+                donation_type=other))
+        progress.record_donation(self.create_donation(10))
+        self.assertEqual(0, self.reload(self.campaign).donations)
+        progress.record_donation(self.create_donation(10,
+                donation_type=option))
+        self.assertEqual(1, self.reload(self.campaign).donations)
+
+    def test_successful_purchase_updates_campaigns(self):
+        donation = self.create_donation(10)
+        backends.Backend().send_successful_purchase(donation, None, {})
+        self.assertEqual(Decimal("10"), self.reload(self.campaign).raised)
+
+    def test_campaign_errors_do_not_fail_the_purchase(self):
+        backends.Backend().send_successful_purchase(object(), None, {})
+        self.assertEqual(0, self.reload(self.campaign).donations)
+
+    def test_get_progress_reports_percent_of_goal(self):
+        models.Campaign.objects.filter(pk=self.campaign.pk).update(
+                raised=25, donations=2)
+        result = progress.get_progress("pledge-drive")
+        self.assertEqual(Decimal("25"), result["raised"])
+        self.assertEqual(Decimal("75"), result["remaining"])
+        self.assertEqual(25.0, result["percent"])
+        self.assertEqual(2, result["donations"])
+
+    def test_percent_is_capped_at_one_hundred(self):
+        models.Campaign.objects.filter(pk=self.campaign.pk).update(raised=250)
+        result = progress.get_progress("pledge-drive")
+        self.assertEqual(100.0, result["percent"])
+        self.assertEqual(Decimal("0"), result["remaining"])
+
+    def test_get_progress_is_cached(self):
+        progress.get_progress("pledge-drive")
+        with self.assertNumQueries(0):
+            progress.get_progress("pledge-drive")
+
+    def test_cached_progress_expires_after_ttl(self):
+        with override_settings(ARMSTRONG_DONATIONS_PROGRESS_TTL=0):
+            progress.get_progress("pledge-drive")
+            with self.assertNumQueries(1):
+                progress.get_progress("pledge-drive")
+
+    def test_recording_a_donation_refreshes_the_cache(self):
+        progress.get_progress("pledge-drive")
+        progress.record_donation(self.create_donation(10))
+        self.assertEqual(Decimal("10"),
+                progress.get_progress("pledge-drive")["raised"])
+
+    def test_can_use_a_shared_cache(self):
+        with override_settings(ARMSTRONG_DONATIONS_PROGRESS_CACHE="default"):
+            progress.get_progress("pledge-drive")
+            progress.clear()
+            with self.assertNumQueries(0):
+                progress.get_progress("pledge-drive")
+            progress.record_donation(self.create_donation(10))
+            self.assertEqual(Decimal("10"),
+                    progress.get_progress("pledge-drive")["raised"])
+
+    def test_unknown_campaigns_raise_does_not_exist(self):
+        with self.assertRaises(models.Campaign.DoesNotExist):
+            progress.get_progress("unknown")
+
+    def test_reconcile_recomputes_from_donations(self):
+        self.create_donation(10)
+        self.create_donation(20)
+        models.Donation.objects.create(donor=self.random_donor, amount=50,
+                processed=False)
+        models.Campaign.objects.filter(pk=self.campaign.pk).update(
+                raised=1000, donations=99)
+        progress.reconcile(self.campaign)
+        campaign = self.reload(self.campaign)
+        self.assertEqual(Decimal("30"), campaign.raised)
+        self.assertEqual(2, campaign.donations)
+        self.assertTrue(campaign.reconciled is not None)
+
+    def test_reconcile_command(self):
+        self.create_donation(10)
+        out = StringIO()
+        call_command("reconcile_campaigns", "pledge-drive", stdout=out)
+        self.assertEqual(1, self.reload(self.campaign).donations)
+        self.assertTrue("pledge-drive" in out.getvalue())
+
+    def test_view_returns_json(self):
+        models.Campaign.objects.filter(pk=self.campaign.pk).update(
+                raised=25, donations=2)
+        response = self.client.get(reverse("donations_campaign_progress",
+                kwargs={"slug": "pledge-drive"}))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue("max-age" in response["Cache-Control"])
+        data = json.loads(response.content)
+        self.assertEqual(25.0, data["raised"])
+        self.assertEqual(100.0, data["goal"])
+        self.assertEqual(25.0, data["percent"])
+
+    def test_view_returns_404_for_unknown_campaigns(self):
+        response = self.client.get(reverse("donations_campaign_progress",
+                kwargs={"slug": "unknown"}))
+        self.assertEqual(404, response.status_code)
+
+    def test_template_tag_adds_progress_to_context(self):
+        models.Campaign.objects.filter(pk=self.campaign.pk).update(raised=25)
+        template = Template('{% load donation_tags %}'
+                '{% get_campaign_progress slug as p %}{{ p.percent }}')
+        self.assertEqual("25.0",
+                template.render(Context({"slug": "pledge-drive"})))
+
+    def test_template_tag_sets_none_for_unknown_campaigns(self):
+        template = Template('{% load donation_tags %}'
+                '{% get_campaign_progress "unknown" as p %}'
+                '{% if p %}found{% else %}missing{% endif %}')
+        self.assertEqual("missing", template.render(Context()))
+
+    def test_template_tag_requires_as(self):
+        with self.assertRaises(TemplateSyntaxError):
+            Template('{% load donation_tags %}'
+                    '{% get_campaign_progress "pledge-drive" %}')
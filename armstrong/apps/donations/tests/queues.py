@@ -0,0 +1,92 @@
+import datetime
+from django.core.management import call_command
+import fudge
+import random
+from StringIO import StringIO
+
+from ._utils import TestCase
+
+from .. import models
+from .. import queues
+
+
+class PurchaseQueueTestCase(TestCase):
+    def get_backend(self, successful=True, reason="Foobar"):
+        backend = fudge.Fake()
+        backend.provides("purchase").returns({
+            "status": successful,
+            "reason": reason,
+        })
+        return backend
+
+    def test_enqueue_records_a_job_for_the_donation(self):
+        donation, form = self.random_donation_and_form
+        queue = queues.PurchaseQueue(workers=0)
+        job = queue.enqueue(donation, form, backend=self.get_backend())
+        self.assertEqual(donation, models.PurchaseJob.objects.get(
+                pk=job.pk).donation)
+
+    def test_jobs_have_unguessable_tokens(self):
+        donation, form = self.random_donation_and_form
+        queue = queues.PurchaseQueue(workers=0)
+        first = queue.enqueue(donation, form, backend=self.get_backend())
+        second = queue.enqueue(donation, form, backend=self.get_backend())
+        self.assertEqual(32, len(first.token))
+        self.assertNotEqual(first.token, second.token)
+
+    def test_passes_donation_and_form_to_backend(self):
+        donation, form = self.random_donation_and_form
+        backend = fudge.Fake()
+        backend.expects("purchase").with_args(donation, form).returns({
+            "status": True,
+        })
+        queues.PurchaseQueue(workers=0).enqueue(donation, form,
+                backend=backend)
+        fudge.verify()
+
+    def test_marks_job_as_succeeded_on_successful_purchase(self):
+        donation, form = self.random_donation_and_form
+        job = queues.PurchaseQueue(workers=0).enqueue(donation, form,
+                backend=self.get_backend())
+        self.assertEqual(models.PurchaseJob.SUCCEEDED, job.status)
+        self.assertTrue(job.is_finished)
+
+    def test_marks_job_as_failed_with_reason_on_failed_purchase(self):
+        random_text = "Some Random Text (%d)" % random.randint(1000, 2000)
+        donation, form = self.random_donation_and_form
+        job = queues.PurchaseQueue(workers=0).enqueue(donation, form,
+                backend=self.get_backend(successful=False,
+                        reason=random_text))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+        self.assertEqual(random_text, job.reason)
+
+    def test_marks_job_as_failed_if_backend_raises(self):
+        donation, form = self.random_donation_and_form
+        backend = fudge.Fake().provides("purchase").raises(
+                IOError("gateway unavailable"))
+        job = queues.PurchaseQueue(workers=0).enqueue(donation, form,
+                backend=backend)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+        self.assertEqual(u"gateway unavailable", job.reason)
+
+    def test_get_queue_returns_the_same_queue(self):
+        self.assertTrue(queues.get_queue() is queues.get_queue())
+
+
+class ExpirePurchaseJobsTestCase(TestCase):
+    def test_fails_unfinished_jobs_older_than_cutoff(self):
+        job = models.PurchaseJob.objects.create(
+                donation=self.random_donation)
+        models.PurchaseJob.objects.filter(pk=job.pk).update(
+                created=datetime.datetime.now() - datetime.timedelta(hours=1))
+        call_command("expire_purchase_jobs", minutes=30, stdout=StringIO())
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+
+    def test_leaves_recent_jobs_alone(self):
+        job = models.PurchaseJob.objects.create(
+                donation=self.random_donation)
+        call_command("expire_purchase_jobs", minutes=30, stdout=StringIO())
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.PENDING, job.status)
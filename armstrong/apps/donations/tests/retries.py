@@ -0,0 +1,356 @@
+from armstrong.dev.tests.utils.backports import override_settings
+import datetime
+import errno
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseRedirect
+import fudge
+import socket
+from StringIO import StringIO
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import breakers
+from .. import models
+from .. import pools
+from .. import queues
+from .. import retries
+from .. import views
+
+
+def failed_result(code=u"3", reason_code=u"19", reason="Try again"):
+    return {
+        "status": False,
+        "reason": reason,
+        "response": {"code": code, "reason_code": reason_code},
+    }
+
+
+class ClassifyFailureTestCase(TestCase):
+    def test_gateway_errors_asking_for_a_retry_are_transient(self):
+        for reason_code in (u"19", u"23", u"25", u"57", u"63"):
+            self.assertEqual(backends.TRANSIENT, backends.classify_failure(
+                    failed_result(reason_code=reason_code)))
+
+    def test_declines_are_hard(self):
+        self.assertEqual(backends.HARD, backends.classify_failure(
+                failed_result(code=u"2", reason_code=u"2")))
+
+    def test_other_gateway_errors_are_hard(self):
+        self.assertEqual(backends.HARD, backends.classify_failure(
+                failed_result(reason_code=u"6")))
+
+    def test_results_without_a_response_are_hard(self):
+        self.assertEqual(backends.HARD, backends.classify_failure(
+                {"status": False, "reason": "Foobar"}))
+
+
+class IsTransientErrorTestCase(TestCase):
+    def test_errors_before_reaching_the_gateway_are_transient(self):
+        for e in (breakers.CircuitOpen("open"),
+                pools.GatewayUnreachable("refused"),
+                pools.GatewayHTTPError(503),
+                socket.gaierror(-2, "Name or service not known"),
+                socket.error(errno.ECONNREFUSED, "Connection refused")):
+            self.assertTrue(backends.is_transient_error(e), repr(e))
+
+    def test_server_errors_that_may_follow_a_charge_are_not_transient(self):
+        self.assertTrue(backends.is_transient_error(
+                pools.GatewayHTTPError(502)))
+        for status in (500, 504):
+            self.assertFalse(backends.is_transient_error(
+                    pools.GatewayHTTPError(status)), status)
+
+    def test_timeouts_are_not_transient(self):
+        self.assertFalse(backends.is_transient_error(
+                socket.timeout("timed out")))
+
+    def test_other_errors_are_not_transient(self):
+        self.assertFalse(backends.is_transient_error(IOError("Foobar")))
+        self.assertFalse(backends.is_transient_error(
+                socket.error(errno.ECONNRESET, "Connection reset")))
+
+
+class RetryTestCase(TestCase):
+    def get_queue(self, **kwargs):
+        kwargs.setdefault("workers", 0)
+        kwargs.setdefault("poll", None)
+        kwargs.setdefault("random", lambda: 1.0)
+        return retries.RetryQueue(**kwargs)
+
+    def get_job(self):
+        return models.PurchaseJob.objects.create(
+                donation=self.random_donation,
+                status=models.PurchaseJob.PROCESSING)
+
+    def get_backend(self, *results):
+        backend = fudge.Fake()
+        purchase = backend.provides("purchase")
+        for result in results:
+            if isinstance(result, Exception):
+                purchase = purchase.raises(result)
+            else:
+                purchase = purchase.returns(result)
+            purchase = purchase.next_call()
+        return backend
+
+    def schedule_and_drain(self, queue, job, backend):
+        queue.schedule(job, None, backend=backend, reason=u"Try again")
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        return queue.drain(now=later)
+
+
+class RetryQueueTestCase(RetryTestCase):
+    def test_delay_doubles_up_to_max_delay(self):
+        queue = self.get_queue(base_delay=2, max_delay=10)
+        self.assertEqual([2, 4, 8, 10, 10],
+                [queue.get_delay(a) for a in range(1, 6)])
+
+    def test_jitter_takes_off_up_to_half_the_delay(self):
+        queue = self.get_queue(base_delay=4, random=lambda: 0.0)
+        self.assertEqual(2, queue.get_delay(1))
+
+    def test_schedule_records_the_attempt_and_next_attempt(self):
+        job = self.get_job()
+        now = datetime.datetime(2012, 1, 1, 12, 0, 0)
+        self.assertTrue(self.get_queue(base_delay=3).schedule(job, None,
+                reason=u"Gateway down", now=now))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.RETRYING, job.status)
+        self.assertEqual(1, job.attempts)
+        self.assertEqual(u"Gateway down", job.reason)
+        self.assertEqual(now + datetime.timedelta(seconds=3),
+                job.next_attempt)
+        self.assertFalse(job.is_finished)
+
+    def test_schedule_fails_the_job_once_out_of_attempts(self):
+        job = self.get_job()
+        job.attempts = 2
+        self.assertFalse(self.get_queue(max_attempts=3).schedule(job, None,
+                reason=u"Gateway down"))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+        self.assertEqual(None, job.next_attempt)
+
+    def test_drain_skips_retries_that_are_not_due(self):
+        queue = self.get_queue()
+        queue.schedule(self.get_job(), None, backend=self.get_backend())
+        self.assertEqual(0, queue.drain())
+
+    def test_drain_passes_donation_and_form_to_backend(self):
+        job = self.get_job()
+        form = object()
+        backend = fudge.Fake()
+        backend.expects("purchase").with_args(job.donation, form).returns({
+            "status": True,
+        })
+        queue = self.get_queue()
+        queue.schedule(job, form, backend=backend)
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(1, queue.drain(now=later))
+        fudge.verify()
+
+    def test_drain_marks_successful_retries_as_succeeded(self):
+        job = self.get_job()
+        queue = self.get_queue()
+        self.schedule_and_drain(queue, job, self.get_backend({
+            "status": True,
+            "reason": u"Approved",
+        }))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.SUCCEEDED, job.status)
+        self.assertEqual(0, len(queue.waiting))
+
+    def test_drain_only_claims_batch_size_jobs(self):
+        queue = self.get_queue()
+        for i in range(3):
+            queue.schedule(self.get_job(), None, backend=self.get_backend({
+                "status": True,
+            }))
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(2, queue.drain(batch_size=2, now=later))
+        self.assertEqual(1, queue.drain(batch_size=2, now=later))
+
+    def test_drain_leaves_jobs_failed_in_the_meantime_alone(self):
+        job = self.get_job()
+        queue = self.get_queue()
+        queue.schedule(job, None, backend=fudge.Fake())
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        models.PurchaseJob.objects.filter(pk=job.pk).update(
+                status=models.PurchaseJob.FAILED)
+        self.assertEqual(0, queue.drain(now=later))
+
+    def test_drain_forgets_jobs_that_are_no_longer_retrying(self):
+        job = self.get_job()
+        form = fudge.Fake().expects("strip_sensitive_fields")
+        queue = self.get_queue()
+        queue.schedule(job, form, backend=fudge.Fake())
+        models.PurchaseJob.objects.filter(pk=job.pk).update(
+                status=models.PurchaseJob.FAILED)
+        self.assertEqual(0, queue.drain())
+        self.assertEqual({}, queue.waiting)
+        fudge.verify()
+
+    def test_settled_jobs_strip_the_card_data_of_their_form(self):
+        for result in ({"status": True}, failed_result(code=u"2",
+                reason_code=u"2", reason=u"Declined")):
+            form = fudge.Fake().expects("strip_sensitive_fields")
+            self.get_queue().attempt(self.get_job(), form,
+                    backend=self.get_backend(result))
+        fudge.verify()
+
+    def test_deferred_subscriptions_keep_the_card_data(self):
+        job = self.get_job()
+        job.donation.donation_type = self.random_monthly_type
+        form = fudge.Fake().provides("strip_sensitive_fields") \
+                .times_called(0)
+        backend = self.get_backend({"status": True}).has_attr(
+                defer_recurring=True)
+        self.get_queue().attempt(job, form, backend=backend)
+        fudge.verify()
+
+    def test_transient_failures_are_scheduled_again(self):
+        job = self.get_job()
+        queue = self.get_queue()
+        self.schedule_and_drain(queue, job, self.get_backend(
+                pools.GatewayHTTPError(502)))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.RETRYING, job.status)
+        self.assertEqual(2, job.attempts)
+        self.assertEqual(u"Gateway responded with HTTP 502", job.reason)
+
+    def test_transient_results_are_scheduled_again(self):
+        job = self.get_job()
+        queue = self.get_queue()
+        self.schedule_and_drain(queue, job, self.get_backend(
+                failed_result()))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.RETRYING, job.status)
+
+    def test_declines_fail_the_job(self):
+        job = self.get_job()
+        self.schedule_and_drain(self.get_queue(), job, self.get_backend(
+                failed_result(code=u"2", reason_code=u"2",
+                        reason=u"Declined")))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+        self.assertEqual(u"Declined", job.reason)
+
+    def test_other_errors_fail_the_job(self):
+        job = self.get_job()
+        self.schedule_and_drain(self.get_queue(), job, self.get_backend(
+                socket.timeout("timed out")))
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+
+    def test_gives_up_after_max_attempts(self):
+        job = self.get_job()
+        queue = self.get_queue(max_attempts=3)
+        backend = self.get_backend(pools.GatewayUnreachable("refused"),
+                pools.GatewayUnreachable("refused"))
+        self.schedule_and_drain(queue, job, backend)
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        queue.drain(now=later)
+        job = models.PurchaseJob.objects.get(pk=job.pk)
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+        self.assertEqual(3, job.attempts)
+
+    def test_get_queue_returns_the_same_queue(self):
+        self.assertTrue(retries.get_queue() is retries.get_queue())
+
+    def test_retries_are_disabled_by_default(self):
+        self.assertFalse(retries.is_enabled())
+
+
+class PurchaseQueueRetryTestCase(RetryTestCase):
+    def setUp(self):
+        super(PurchaseQueueRetryTestCase, self).setUp()
+        self.queue = self.get_queue()
+        self.patches = [
+            fudge.patch_object(retries, "get_queue", fudge.Fake()
+                    .is_callable().returns(self.queue)),
+        ]
+
+    def process(self, backend):
+        donation, form = self.random_donation_and_form
+        return queues.PurchaseQueue(workers=0).enqueue(donation, form,
+                backend=backend)
+
+    def test_transient_failures_are_retried_when_enabled(self):
+        with override_settings(ARMSTRONG_DONATIONS_RETRIES={
+                "ENABLED": True}):
+            job = self.process(self.get_backend(failed_result()))
+        self.assertEqual(models.PurchaseJob.RETRYING, job.status)
+        self.assertTrue(job.pk in self.queue.waiting)
+
+    def test_transient_errors_fail_when_disabled(self):
+        job = self.process(self.get_backend(
+                pools.GatewayUnreachable("refused")))
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+
+    def test_declines_are_not_retried(self):
+        with override_settings(ARMSTRONG_DONATIONS_RETRIES={
+                "ENABLED": True}):
+            job = self.process(self.get_backend(failed_result(code=u"2",
+                    reason_code=u"2")))
+        self.assertEqual(models.PurchaseJob.FAILED, job.status)
+
+
+class DonationFormViewRetryTestCase(PurchaseQueueRetryTestCase):
+    def post(self, backend):
+        donation, form = self.random_donation_and_form
+        form.save = fudge.Fake().is_callable().returns(donation)
+        view = views.DonationFormView()
+        get_backend = fudge.Fake().is_callable().returns(backend)
+        with override_settings(ARMSTRONG_DONATIONS_RETRIES={
+                "ENABLED": True}):
+            with fudge.patched_context(views.backends, "get_backend",
+                    get_backend):
+                return donation, view.process_donation(form)
+
+    def test_transient_errors_redirect_to_the_status_page(self):
+        donation, response = self.post(self.get_backend(
+                breakers.CircuitOpen("open")))
+        job = models.PurchaseJob.objects.get(donation=donation)
+        self.assertEqual(models.PurchaseJob.RETRYING, job.status)
+        self.assertIsA(response, HttpResponseRedirect)
+        self.assertEqual(reverse("donations_status",
+                kwargs={"token": job.token}), response["Location"])
+
+    def test_transient_results_redirect_to_the_status_page(self):
+        donation, response = self.post(self.get_backend(failed_result()))
+        job = models.PurchaseJob.objects.get(donation=donation)
+        self.assertEqual(1, job.attempts)
+        self.assertIsA(response, HttpResponseRedirect)
+
+    def test_other_errors_are_raised(self):
+        self.assertRaises(socket.timeout, self.post, self.get_backend(
+                socket.timeout("timed out")))
+
+
+class DrainPurchaseRetriesTestCase(TestCase):
+    def get_job(self, minutes_overdue):
+        return models.PurchaseJob.objects.create(
+                donation=self.random_donation,
+                status=models.PurchaseJob.RETRYING,
+                next_attempt=datetime.datetime.now() -
+                        datetime.timedelta(minutes=minutes_overdue))
+
+    def test_fails_retries_overdue_by_more_than_grace(self):
+        abandoned = self.get_job(minutes_overdue=10)
+        live = self.get_job(minutes_overdue=1)
+        out = StringIO()
+        call_command("expire_purchase_retries", grace=5, stdout=out)
+        self.assertEqual(models.PurchaseJob.FAILED,
+                models.PurchaseJob.objects.get(pk=abandoned.pk).status)
+        self.assertEqual(models.PurchaseJob.RETRYING,
+                models.PurchaseJob.objects.get(pk=live.pk).status)
+        self.assertTrue("Failed 1 abandoned" in out.getvalue())
+
+    def test_works_through_every_batch(self):
+        for i in range(5):
+            self.get_job(minutes_overdue=10)
+        self.assertEqual(5, retries.expire_abandoned(grace=5, batch_size=2))
+        self.assertEqual(0, models.PurchaseJob.objects.filter(
+                status=models.PurchaseJob.RETRYING).count())
@@ -0,0 +1,132 @@
+import datetime
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import IntegrityError
+import fudge
+from StringIO import StringIO
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import models
+from .. import rollups
+
+
+class RollupsTestCase(TestCase):
+    def create_donation(self, amount, created=None, processed=True,
+            **kwargs):
+        donation = models.Donation.objects.create(donor=self.random_donor,
+                amount=amount, processed=processed, **kwargs)
+        if created is not None:
+            models.Donation.objects.filter(pk=donation.pk).update(
+                    created=created)
+            donation = models.Donation.objects.get(pk=donation.pk)
+        return donation
+
+    def test_record_donation_creates_a_rollup(self):
+        donation = self.create_donation(10)
+        rollups.record_donation(donation)
+        rollup = models.DailyDonationRollup.objects.get()
+        self.assertEqual(donation.created.date(), rollup.date)
+        self.assertEqual(Decimal("10"), rollup.total)
+        self.assertEqual(1, rollup.count)
+
+    def test_record_donation_adds_to_an_existing_rollup(self):
+        for amount in (10, 15):
+            rollups.record_donation(self.create_donation(amount))
+        rollup = models.DailyDonationRollup.objects.get()
+        self.assertEqual(Decimal("25"), rollup.total)
+        self.assertEqual(2, rollup.count)
+
+    def test_rollups_are_split_by_donation_type_and_code(self):
+        option = self.random_type
+        code = self.random_discount
+        rollups.record_donation(self.create_donation(10))
+        rollups.record_donation(self.create_donation(10,
+                donation_type=option))
+        rollups.record_donation(self.create_donation(100, code=code))
+        self.assertEqual(3, models.DailyDonationRollup.objects.count())
+        self.assertEqual(1, models.DailyDonationRollup.objects.get(
+                donation_type=option.donation_type).count)
+
+    def test_successful_purchase_updates_rollups(self):
+        donation = self.create_donation(10)
+        backends.Backend().send_successful_purchase(donation, None, {})
+        self.assertEqual({"total": Decimal("10"), "count": 1},
+                models.DailyDonationRollup.objects.summarize())
+
+    def test_rollup_errors_do_not_fail_the_purchase(self):
+        backends.Backend().send_successful_purchase(object(), None, {})
+        self.assertEqual(0, models.DailyDonationRollup.objects.count())
+
+    def test_rebuild_recomputes_a_date_range(self):
+        self.create_donation(10, created=datetime.datetime(2012, 1, 1, 9))
+        self.create_donation(15, created=datetime.datetime(2012, 1, 1, 18))
+        self.create_donation(20, created=datetime.datetime(2012, 1, 2, 12))
+        self.create_donation(50, created=datetime.datetime(2012, 1, 1, 12),
+                processed=False)
+        models.DailyDonationRollup.objects.create(
+                date=datetime.date(2012, 1, 1), total=1000, count=100)
+        written = rollups.rebuild(datetime.date(2012, 1, 1),
+                datetime.date(2012, 1, 2))
+        self.assertEqual(1, written)
+        rollup = models.DailyDonationRollup.objects.get()
+        self.assertEqual(Decimal("25"), rollup.total)
+        self.assertEqual(2, rollup.count)
+
+    def test_between_and_summarize_read_totals(self):
+        for day in (1, 2, 3):
+            models.DailyDonationRollup.objects.create(
+                    date=datetime.date(2012, 1, day), total=10, count=1)
+        self.assertEqual({"total": Decimal("20"), "count": 2},
+                models.DailyDonationRollup.objects.between(
+                        datetime.date(2012, 1, 2),
+                        datetime.date(2012, 1, 4)).summarize())
+
+    def test_command_rebuilds_everything_by_default(self):
+        self.create_donation(10, created=datetime.datetime(2012, 1, 1))
+        self.create_donation(10)
+        call_command("rebuild_donation_rollups", stdout=StringIO())
+        self.assertEqual(2, models.DailyDonationRollup.objects.count())
+
+    def test_command_accepts_a_date_range(self):
+        self.create_donation(10, created=datetime.datetime(2012, 1, 1))
+        self.create_donation(10, created=datetime.datetime(2012, 1, 5))
+        call_command("rebuild_donation_rollups", start="2012-01-01",
+                end="2012-01-01", stdout=StringIO())
+        self.assertEqual([datetime.date(2012, 1, 1)], [a.date for a in
+                models.DailyDonationRollup.objects.all()])
+
+    def test_rollups_without_a_donation_type_or_code_are_unique(self):
+        date = datetime.date(2012, 1, 1)
+        models.DailyDonationRollup.objects.create(date=date, total=10,
+                count=1)
+        self.assertRaises(IntegrityError,
+                models.DailyDonationRollup.objects.create, date=date,
+                total=10, count=1)
+
+    def test_add_to_rollup_uses_the_row_another_process_created(self):
+        date = datetime.date(2012, 1, 1)
+        rollups.add_to_rollup(date, None, None, 10, 1)
+        rows = RowsCreatedByAnotherProcess(
+                models.DailyDonationRollup.objects.all())
+        filter = fudge.Fake().is_callable().returns(rows)
+        with fudge.patched_context(models.DailyDonationRollup.objects,
+                "filter", filter):
+            rollups.add_to_rollup(date, None, None, 15, 1)
+        rollup = models.DailyDonationRollup.objects.get()
+        self.assertEqual(Decimal("25"), rollup.total)
+        self.assertEqual(2, rollup.count)
+
+
+class RowsCreatedByAnotherProcess(object):
+    """Rows that only exist once the first ``update`` has missed them"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.missed = False
+
+    def update(self, **kwargs):
+        if not self.missed:
+            self.missed = True
+            return 0
+        return self.rows.update(**kwargs)
@@ -0,0 +1,200 @@
+from armstrong.dev.tests.utils.backports import override_settings
+from django.core.exceptions import ImproperlyConfigured
+import fudge
+import random
+import socket
+
+from ._utils import TestCase
+
+from .. import backends
+from .. import breakers
+from .. import forms
+from .. import pools
+from .. import routing
+
+
+class FakeBackend(backends.Backend):
+    def __init__(self, *results, **kwargs):
+        self.results = list(results)
+        self.settings = kwargs.get("settings", None)
+        self.calls = 0
+
+    def get_form_class(self):
+        return forms.AuthorizeDonationForm
+
+    def purchase(self, donation, form):
+        self.calls += 1
+        result = self.results.pop(0) if self.results else {"status": True}
+        if isinstance(result, Exception):
+            raise result
+        return dict(result)
+
+
+def get_route(name, *results, **kwargs):
+    return routing.Route(name, FakeBackend(*results), **kwargs)
+
+
+def transient_result():
+    return {
+        "status": False,
+        "reason": u"Try again",
+        "response": {"code": u"3", "reason_code": u"19"},
+    }
+
+
+class RoutingBackendTestCase(TestCase):
+    def purchase(self, backend, times=1):
+        donation, form = self.random_donation_and_form
+        return [backend.purchase(donation, form)["route"]
+                for i in range(times)]
+
+    def test_weighted_routes_share_purchases_by_weight(self):
+        backend = routing.RoutingBackend([get_route("a", weight=3),
+                get_route("b", weight=1)], strategy="weighted")
+        routes = self.purchase(backend, times=8)
+        self.assertEqual(6, routes.count("a"))
+        self.assertEqual(2, routes.count("b"))
+
+    def test_weighted_routes_are_interleaved(self):
+        backend = routing.RoutingBackend([get_route("a"), get_route("b")],
+                strategy="weighted")
+        self.assertEqual(["a", "b", "a", "b"], self.purchase(backend,
+                times=4))
+
+    def test_latency_tries_unmeasured_routes_then_the_fastest(self):
+        slow, fast = get_route("slow"), get_route("fast")
+        backend = routing.RoutingBackend([slow, fast], strategy="latency")
+        self.assertEqual(["slow", "fast"], self.purchase(backend, times=2))
+        slow.latency, fast.latency = 2.0, 0.5
+        self.assertEqual(["fast"], self.purchase(backend))
+
+    def test_latency_is_a_moving_average(self):
+        route = get_route("a")
+        route.record_latency(1.0, 0.5)
+        route.record_latency(2.0, 0.5)
+        self.assertEqual(1.5, route.latency)
+
+    def test_health_uses_the_first_healthy_route(self):
+        backend = routing.RoutingBackend([get_route("a"), get_route("b")],
+                strategy="health")
+        self.assertEqual(["a", "a"], self.purchase(backend, times=2))
+
+    def test_routes_with_an_open_circuit_go_last(self):
+        breaker = breakers.CircuitBreaker(failure_threshold=1)
+        breaker.record_failure()
+        unhealthy = get_route("unhealthy")
+        unhealthy.backend.get_circuit_breaker = lambda: breaker
+        backend = routing.RoutingBackend([unhealthy, get_route("b")],
+                strategy="health")
+        self.assertFalse(unhealthy.is_healthy)
+        self.assertEqual(["b", "unhealthy"],
+                [a.name for a in backend.get_routes()])
+
+    def test_is_available_while_any_route_is_healthy(self):
+        breaker = breakers.CircuitBreaker(failure_threshold=1)
+        breaker.record_failure()
+        unhealthy = get_route("unhealthy")
+        unhealthy.backend.get_circuit_breaker = lambda: breaker
+        self.assertTrue(routing.RoutingBackend([unhealthy,
+                get_route("b")]).is_available())
+        self.assertFalse(routing.RoutingBackend([unhealthy]).is_available())
+
+    def test_fails_over_on_transient_errors(self):
+        first = get_route("a", pools.GatewayUnreachable("refused"))
+        backend = routing.RoutingBackend([first, get_route("b")],
+                strategy="health")
+        self.assertEqual(["b"], self.purchase(backend))
+        self.assertEqual(1, first.backend.calls)
+
+    def test_fails_over_on_transient_results(self):
+        backend = routing.RoutingBackend([
+            get_route("a", transient_result()),
+            get_route("b"),
+        ], strategy="health")
+        self.assertEqual(["b"], self.purchase(backend))
+
+    def test_declines_do_not_fail_over(self):
+        second = get_route("b")
+        backend = routing.RoutingBackend([get_route("a", {
+            "status": False,
+            "reason": u"Declined",
+            "response": {"code": u"2", "reason_code": u"2"},
+        }), second], strategy="health")
+        donation, form = self.random_donation_and_form
+        result = backend.purchase(donation, form)
+        self.assertFalse(result["status"])
+        self.assertEqual("a", result["route"])
+        self.assertEqual(0, second.backend.calls)
+
+    def test_errors_that_may_have_charged_the_card_are_raised(self):
+        second = get_route("b")
+        backend = routing.RoutingBackend([
+            get_route("a", socket.timeout("timed out")),
+            second,
+        ], strategy="health")
+        self.assertRaises(socket.timeout, self.purchase, backend)
+        self.assertEqual(0, second.backend.calls)
+
+    def test_raises_the_last_error_if_every_route_fails(self):
+        backend = routing.RoutingBackend([
+            get_route("a", breakers.CircuitOpen("open")),
+            get_route("b", pools.GatewayHTTPError(502)),
+        ], strategy="health")
+        self.assertRaises(pools.GatewayHTTPError, self.purchase, backend)
+
+    def test_returns_the_last_result_if_every_route_fails(self):
+        backend = routing.RoutingBackend([
+            get_route("a", transient_result()),
+            get_route("b", transient_result()),
+        ], strategy="health")
+        self.assertEqual(["b"], self.purchase(backend))
+
+    def test_get_form_class_comes_from_the_routes(self):
+        backend = routing.RoutingBackend([get_route("a")])
+        self.assertEqual(forms.AuthorizeDonationForm,
+                backend.get_form_class())
+
+    def test_requires_the_same_form_class_on_every_route(self):
+        other = get_route("b")
+        other.backend.get_form_class = lambda: forms.CreditCardDonationForm
+        self.assertRaises(ImproperlyConfigured, routing.RoutingBackend,
+                [get_route("a"), other])
+
+    def test_requires_a_route(self):
+        with override_settings(ARMSTRONG_DONATIONS_ROUTING={}):
+            self.assertRaises(ImproperlyConfigured, routing.RoutingBackend)
+
+    def test_rejects_unknown_strategies(self):
+        self.assertRaises(ImproperlyConfigured, routing.RoutingBackend,
+                [get_route("a")], strategy="random")
+
+
+class BuildRouteTestCase(TestCase):
+    def test_builds_authorize_backends_with_route_settings(self):
+        login = u"login%d" % random.randint(100, 200)
+        with override_settings(ARMSTRONG_DONATIONS_ROUTING={"ROUTES": [
+            {"NAME": "a", "SETTINGS": {"AUTHORIZE": {"LOGIN": login,
+                    "KEY": u"key"}}},
+            {"NAME": "b", "WEIGHT": 2},
+        ]}):
+            backend = routing.RoutingBackend()
+        first, second = backend.routes
+        self.assertIsA(first.backend, backends.AuthorizeNetBackend)
+        self.assertEqual(login, first.backend.settings.AUTHORIZE["LOGIN"])
+        self.assertEqual(2, second.weight)
+        self.assertNotEqual(first.backend.get_circuit_breaker(),
+                second.backend.get_circuit_breaker())
+
+    def test_builds_the_configured_backend_class(self):
+        route = routing.build_route({
+            "NAME": "fake",
+            "BACKEND": "armstrong.apps.donations.tests.routing.FakeBackend",
+        }, settings=fudge.Fake())
+        self.assertIsA(route.backend, FakeBackend)
+
+    def test_route_settings_fall_back_to_the_project_settings(self):
+        settings = routing.RouteSettings({"AUTHORIZE": "route"},
+                fudge.Fake().has_attr(AUTHORIZE="project", OTHER="other"))
+        self.assertEqual("route", settings.AUTHORIZE)
+        self.assertEqual("other", settings.OTHER)
+        self.assertEqual(None, getattr(settings, "MISSING", None))
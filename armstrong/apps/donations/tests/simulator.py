@@ -0,0 +1,76 @@
+from armstrong.dev.tests.utils.backports import override_settings
+import random
+
+from ._utils import TestCase
+
+from .. import pools
+from .. import simulator
+
+
+class ParseLatencyTestCase(TestCase):
+    def test_plain_numbers_are_fixed_delays(self):
+        latency = simulator.parse_latency("0.25")
+        self.assertEqual(0.25, latency(random.Random()))
+
+    def test_supports_uniform_distributions(self):
+        latency = simulator.parse_latency("uniform:0.1,0.2")
+        for i in range(10):
+            self.assertTrue(0.1 <= latency(random.Random(i)) <= 0.2)
+
+    def test_negative_samples_become_zero(self):
+        latency = simulator.parse_latency("normal:-10,0.1")
+        self.assertEqual(0.0, latency(random.Random()))
+
+    def test_rejects_unknown_distributions(self):
+        self.assertRaises(ValueError, simulator.parse_latency, "pareto:1")
+
+
+class GatewaySimulatorTestCase(TestCase):
+    def setUp(self):
+        super(GatewaySimulatorTestCase, self).setUp()
+        pools.clear_pools()
+        self.simulators = []
+
+    def tearDown(self):
+        super(GatewaySimulatorTestCase, self).tearDown()
+        pools.clear_pools()
+        for a in self.simulators:
+            a.stop()
+
+    def purchase(self, donation_type=None, **kwargs):
+        gateway = simulator.GatewaySimulator(port=0, seed=1, **kwargs).start()
+        self.simulators.append(gateway)
+        donation, donation_form = self.random_donation_and_form
+        donation.donation_type = donation_type
+        backend = simulator.SimulatedAuthorizeNetBackend()
+        with override_settings(ARMSTRONG_DONATIONS_SIMULATOR=gateway.address):
+            return backend.purchase(donation, donation_form)
+
+    def test_approves_transactions_by_default(self):
+        result = self.purchase()
+        self.assertTrue(result["status"])
+        self.assertEqual(u"This transaction has been approved.",
+                result["reason"])
+
+    def test_declines_at_the_configured_rate(self):
+        result = self.purchase(decline_rate=1.0)
+        self.assertFalse(result["status"])
+        self.assertEqual(u"2", result["response"]["code"])
+
+    def test_injects_gateway_errors(self):
+        result = self.purchase(error_rate=1.0)
+        self.assertFalse(result["status"])
+        self.assertEqual(u"3", result["response"]["code"])
+
+    def test_can_inject_http_errors(self):
+        self.assertRaises(pools.GatewayHTTPError, self.purchase,
+                error_rate=1.0, error_mode="http")
+
+    def test_creates_subscriptions_for_repeating_donations(self):
+        result = self.purchase(donation_type=self.random_monthly_type)
+        self.assertTrue(result["status"])
+        self.assertTrue(result["recurring_response"]["status"])
+
+    def test_rejects_unknown_error_modes(self):
+        self.assertRaises(ValueError, simulator.GatewaySimulator, port=0,
+                error_mode="unknown")
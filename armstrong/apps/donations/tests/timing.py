@@ -0,0 +1,99 @@
+from armstrong.dev.tests.utils.backports import override_settings
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+import fudge
+import os
+
+from ._utils import TestCase
+
+from .. import benchmarks
+from .. import models
+from .. import timing
+
+
+class TimingsTestCase(TestCase):
+    def test_stages_record_duration_and_queries(self):
+        timings = timing.Timings()
+        with timings.stage("save"):
+            models.DonationType.objects.count()
+        self.assertEqual(["save"], [a["name"] for a in timings.stages])
+        self.assertEqual(1, timings.stages[0]["queries"])
+        self.assertTrue(timings.stages[0]["duration"] > 0)
+
+    def test_repeated_stages_are_added_together(self):
+        timings = timing.Timings()
+        timings.add("gateway", 0.1, 0)
+        timings.add("gateway", 0.2, 1)
+        self.assertEqual(1, len(timings.stages))
+        self.assertAlmostEqual(0.3, timings.stages[0]["duration"])
+        self.assertEqual(2, timings.stages[0]["count"])
+
+    def test_as_header(self):
+        timings = timing.Timings()
+        timings.add("form", 0.0012, 0)
+        timings.total, timings.queries = 0.01, 3
+        self.assertEqual('form;dur=1.2;desc="0 queries", '
+                'total;dur=10.0;desc="3 queries"', timings.as_header())
+
+    def test_stage_does_nothing_without_a_timed_request(self):
+        with timing.stage("save"):
+            pass
+        self.assertEqual(None, timing.get_current())
+
+    def test_requests_are_not_sampled_by_default(self):
+        request = self.factory.get("/")
+        with timing.timed_request(request) as timings:
+            self.assertEqual(None, timings)
+        self.assertFalse(hasattr(request, "donation_timings"))
+
+    def test_sample_rate_decides_which_requests_are_timed(self):
+        fake_random = fudge.Fake().provides("random").returns(0.5)
+        self.patches = [fudge.patch_object(timing, "random", fake_random)]
+        with override_settings(ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE=0.4):
+            self.assertFalse(timing.is_sampled())
+        with override_settings(ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE=0.6):
+            self.assertTrue(timing.is_sampled())
+
+    def test_timed_request_collects_stages(self):
+        request = self.factory.get("/")
+        with override_settings(ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE=1):
+            with timing.timed_request(request) as timings:
+                with timing.stage("form"):
+                    pass
+        self.assertEqual(timings, request.donation_timings)
+        self.assertEqual(["form"], [a["name"] for a in timings.stages])
+        self.assertTrue(timings.total > 0)
+        self.assertEqual(None, timing.get_current())
+
+
+class DonationFormViewTimingTestCase(TestCase):
+    def setUp(self):
+        super(DonationFormViewTimingTestCase, self).setUp()
+        self.client = Client()
+
+    def get_stage_names(self, response):
+        return [a.split(";")[0] for a in
+                response[timing.HEADER].split(", ")]
+
+    def test_post_reports_every_stage(self):
+        with override_settings(
+                ARMSTRONG_DONATIONS_BACKEND=benchmarks.STUB_BACKEND,
+                ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE=1):
+            response = self.client.post(reverse("donations_form"),
+                    benchmarks.get_form_data())
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(["form", "validate", "save", "gateway",
+                "receivers", "purchase", "total"],
+                self.get_stage_names(response))
+
+    def test_get_reports_rendering(self):
+        with override_settings(ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE=1,
+                TEMPLATE_DIRS=(os.path.join(os.path.dirname(__file__),
+                        "_templates"), )):
+            response = self.client.get(reverse("donations_form"))
+        self.assertEqual(["form", "render", "total"],
+                self.get_stage_names(response))
+
+    def test_unsampled_responses_have_no_header(self):
+        response = self.client.get(reverse("donations_form"))
+        self.assertFalse(response.has_header(timing.HEADER))
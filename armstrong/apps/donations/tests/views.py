@@ -6,11 +6,14 @@ from django.template.response import TemplateResponse
 from django.test.client import Client
 from functools import wraps
 import fudge
+from fudge.inspector import arg
+import json
 import os
 import random
 
 from ._utils import TestCase
 
+from .. import breakers
 from .. import constants
 from .. import forms
 from .. import models
@@ -21,6 +24,8 @@ def failed_purchase(func):
     def inner(self):
         random_text = "Some Random Text (%d)" % random.randint(1000, 2000)
         backend = self.get_backend_stub(successful=False, reason=random_text)
+        # Undo the patches from setUp first so they don't outlive the test
+        self.restore_patched_objects()
         self.patches = [
             fudge.patch_object(views, "backends", backend),
         ]
@@ -347,6 +352,29 @@ class DonationFormViewPostWithConfirmTestCase(BaseDonationFormViewTestCase):
 
         fudge.verify()
 
+    def test_form_is_invalid_renders_the_form_built_by_post(self):
+        donation_form = forms.CreditCardDonationForm(data={})
+        get_donation_form = (fudge.Fake().expects_call().times_called(1)
+                .returns(donation_form))
+        view = self.post_view
+        with fudge.patched_context(view, "get_donation_form",
+                get_donation_form):
+            response = view.post({})
+        fudge.verify()
+        self.assertTrue(response.context_data["donation_form"] is
+                donation_form)
+
+    def test_confirmation_renders_the_validated_form(self):
+        donation, donation_form = self.random_donation_and_form
+        view = self.post_view
+        get_donation_form = fudge.Fake().is_callable().times_called(0)
+        with fudge.patched_context(view, "get_donation_form",
+                get_donation_form):
+            response = view.form_is_valid(donation_form)
+        fudge.verify()
+        self.assertTrue(response.context_data["donation_form"] is
+                donation_form)
+
     def test_post_passes_kwargs_to_form_is_valid(self):
         r = lambda: random.randint(100, 200)
         random_kwargs = {
@@ -483,6 +511,36 @@ class DonationFormViewPostTestCase(BaseDonationFormViewTestCase):
                 last_name=data["last_name"])
         self.assertEqual(donor.address, donor.mailing_address)
 
+    def test_duplicate_submissions_are_only_charged_once(self):
+        purchase = fudge.Fake().expects_call().times_called(1).returns({
+            "status": True,
+            "reason": "Foobar",
+            "response": "Foobar",
+        })
+        backend = fudge.Fake().has_attr(purchase=purchase)
+        backend.provides("get_form_class").returns(
+                forms.CreditCardDonationForm)
+        backends = fudge.Fake().provides("get_backend").returns(backend)
+        data = self.random_post_data
+        data["submission_token"] = u"%032d" % random.randint(1000, 2000)
+        with fudge.patched_context(views, "backends", backends):
+            first = self.client.post(self.url, data)
+            second = self.client.post(self.url, data)
+        fudge.verify()
+        self.assertRedirects(first, reverse("donations_thanks"))
+        self.assertRedirects(second, reverse("donations_thanks"))
+        self.assertEqual(1, models.Donation.objects.count())
+
+    def test_failed_submissions_can_be_retried(self):
+        data = self.random_post_data
+        data["submission_token"] = u"%032d" % random.randint(1000, 2000)
+        with fudge.patched_context(views, "backends",
+                self.get_backend_stub(successful=False)):
+            self.client.post(self.url, data)
+        response = self.client.post(self.url, data)
+        self.assertRedirects(response, reverse("donations_thanks"))
+        self.assertEqual(2, models.Donation.objects.count())
+
     def test_redirects_to_success_url_after_successful_save(self):
         data = self.random_post_data
         response = self.client.post(self.url, data)
@@ -534,3 +592,100 @@ class DonationFormViewPostTestCase(BaseDonationFormViewTestCase):
     def test_response_in_context_on_failed_purchase(self, response,
             backend_response, **kwargs):
         self.assert_value_in_context(response, "response", backend_response)
+
+
+    def test_open_circuit_renders_try_again_shortly(self):
+        purchase = fudge.Fake().is_callable().raises(
+                breakers.CircuitOpen("open"))
+        backend = fudge.Fake().has_attr(purchase=purchase)
+        backend.provides("get_form_class").returns(
+                forms.CreditCardDonationForm)
+        backends = fudge.Fake().provides("get_backend").returns(backend)
+        with fudge.patched_context(views, "backends", backends):
+            response = self.client.post(self.url, self.random_post_data)
+        self.assertEqual(503, response.status_code)
+        self.assert_template("armstrong/donations/donation.html", response)
+        self.assertTrue("try again shortly" in
+                response.context["error_msg"])
+
+    def test_open_circuit_leaves_nothing_saved(self):
+        purchase = fudge.Fake().is_callable().raises(
+                breakers.CircuitOpen("open"))
+        backend = fudge.Fake().has_attr(purchase=purchase)
+        backend.provides("get_form_class").returns(
+                forms.CreditCardDonationForm)
+        backends = fudge.Fake().provides("get_backend").returns(backend)
+        with fudge.patched_context(views, "backends", backends):
+            self.client.post(self.url, self.random_post_data)
+        self.assertEqual(0, models.Donation.objects.count())
+        self.assertEqual(0, models.Donor.objects.count())
+        self.assertEqual(0, models.DonorAddress.objects.count())
+
+    def test_unavailable_backend_is_not_sent_the_purchase(self):
+        backend = fudge.Fake().provides("is_available").returns(False)
+        backend.provides("get_form_class").returns(
+                forms.CreditCardDonationForm)
+        backends = fudge.Fake().provides("get_backend").returns(backend)
+        with fudge.patched_context(views, "backends", backends):
+            response = self.client.post(self.url, self.random_post_data)
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(0, models.Donation.objects.count())
+
+
+class DonationFormViewQueuedPurchaseTestCase(BaseDonationFormViewTestCase):
+    def get_queued_view(self):
+        v = views.DonationFormView(queue_purchase=True)
+        v.request = self.get_fake_post_request()
+        return v
+
+    def test_queue_purchase_is_off_by_default(self):
+        self.assertFalse(views.DonationFormView().queue_purchase)
+
+    def test_enqueues_donation_instead_of_purchasing(self):
+        donation, donation_form = self.random_donation_and_form
+        donation_form.save = fudge.Fake().is_callable().returns(donation)
+        job = models.PurchaseJob.objects.create(donation=donation)
+        queue = fudge.Fake()
+        queue.expects("enqueue").with_args(donation, donation_form,
+                backend=arg.any()).returns(job)
+        get_queue = fudge.Fake().is_callable().returns(queue)
+
+        with fudge.patched_context(views.queues, "get_queue", get_queue):
+            response = self.get_queued_view().form_is_valid(donation_form)
+        fudge.verify()
+        self.assertIsA(response, HttpResponseRedirect)
+        self.assertEqual(reverse("donations_status",
+                kwargs={"token": job.token}), response["Location"])
+
+
+class PurchaseStatusViewTestCase(BaseDonationFormViewTestCase):
+    def get_job(self, status=models.PurchaseJob.PENDING):
+        return models.PurchaseJob.objects.create(
+                donation=self.random_donation, status=status)
+
+    def get_status_url(self, job):
+        return reverse("donations_status", kwargs={"token": job.token})
+
+    def test_renders_status_template_while_pending(self):
+        job = self.get_job()
+        response = self.client.get(self.get_status_url(job))
+        self.assertEqual(200, response.status_code)
+        self.assert_template("armstrong/donations/status.html", response)
+        self.assert_value_in_context(response, "job", job)
+
+    def test_returns_status_as_json_to_ajax_requests(self):
+        job = self.get_job(status=models.PurchaseJob.FAILED)
+        response = self.client.get(self.get_status_url(job),
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual("application/json", response["Content-Type"])
+        self.assertEqual(job.as_dict(), json.loads(response.content))
+
+    def test_redirects_to_thanks_once_succeeded(self):
+        job = self.get_job(status=models.PurchaseJob.SUCCEEDED)
+        response = self.client.get(self.get_status_url(job))
+        self.assertRedirects(response, reverse("donations_thanks"))
+
+    def test_unknown_tokens_are_not_found(self):
+        response = self.client.get(reverse("donations_status",
+                kwargs={"token": "0" * 32}))
+        self.assertEqual(404, response.status_code)
@@ -0,0 +1,30 @@
+import fudge
+
+from ._utils import TestCase
+
+from .. import workers
+
+
+class WorkerPoolTestCase(TestCase):
+    def test_runs_tasks_inline_if_size_is_zero(self):
+        task = fudge.Fake().expects_call().with_args(1, foo="bar")
+        pool = workers.WorkerPool(0)
+        pool.submit(task, 1, foo="bar")
+        fudge.verify()
+
+    def test_runs_tasks_on_background_threads(self):
+        ran = []
+        pool = workers.WorkerPool(2)
+        for i in range(5):
+            pool.submit(ran.append, i)
+        pool.join()
+        self.assertEqual(range(5), sorted(ran))
+        self.assertTrue(len(pool.threads) <= 2)
+
+    def test_failing_tasks_do_not_raise(self):
+        task = fudge.Fake().is_callable().raises(ValueError("boom"))
+        workers.WorkerPool(0).submit(task)
+
+    def test_get_pool_returns_the_same_pool_for_a_name(self):
+        self.assertTrue(workers.get_pool("testing", 0)
+                is workers.get_pool("testing", 0))
@@ -0,0 +1,144 @@
+"""
+Per-stage timing of donation requests
+
+A fraction of the requests to ``DonationFormView`` can be timed stage by
+stage.  The fraction is set with ``ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE``,
+a number from ``0`` (the default, off) to ``1`` (every request)::
+
+    ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE = 0.01
+
+The stages are:
+
+* ``form``: building the donation form
+* ``validate``: its ``is_valid``
+* ``save``: ``BaseDonationForm.save()``
+* ``purchase``: ``Backend.purchase``, which includes ``gateway`` (each call
+  to the payment gateway) and ``receivers`` (``successful_purchase``)
+* ``render``: rendering the template
+
+Each stage has its wall time and the number of queries it ran.  A sampled
+request gets the breakdown as ``request.donation_timings``.  The response
+gets it as a ``Server-Timing`` header, and it is logged at info level on
+the ``armstrong.apps.donations.timing`` logger.  Requests that aren't
+sampled only pay for one random number.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+import logging
+import random
+import threading
+from timeit import default_timer
+
+from .queries import QueryCounter
+
+HEADER = "Server-Timing"
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Timings(object):
+    """Wall time and queries of each stage of one request"""
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.stages = []
+        self.by_name = {}
+        self.total = None
+        self.queries = None
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the time and queries of a ``with`` block to stage ``name``"""
+        started = default_timer()
+        try:
+            with QueryCounter(self.using) as counter:
+                yield
+        finally:
+            self.add(name, default_timer() - started, counter.count or 0)
+
+    def add(self, name, duration, queries=0):
+        if name not in self.by_name:
+            self.by_name[name] = {"name": name, "duration": 0.0,
+                    "queries": 0, "count": 0}
+            self.stages.append(self.by_name[name])
+        stage = self.by_name[name]
+        stage["duration"] += duration
+        stage["queries"] += queries
+        stage["count"] += 1
+
+    def as_header(self):
+        """Returns the stages in the ``Server-Timing`` header format"""
+        entries = ['%s;dur=%.1f;desc="%d queries"' % (a["name"],
+                a["duration"] * 1000, a["queries"]) for a in self.stages]
+        if self.total is not None:
+            entries.append('total;dur=%.1f;desc="%d queries"' % (
+                    self.total * 1000, self.queries))
+        return ", ".join(entries)
+
+    def as_log(self):
+        parts = ["%s=%.1fms/%dq" % (a["name"], a["duration"] * 1000,
+                a["queries"]) for a in self.stages]
+        if self.total is not None:
+            parts.append("total=%.1fms/%dq" % (self.total * 1000,
+                    self.queries))
+        return " ".join(parts)
+
+
+def get_sample_rate():
+    return getattr(settings, "ARMSTRONG_DONATIONS_TIMING_SAMPLE_RATE", 0)
+
+
+def is_sampled():
+    rate = get_sample_rate()
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def get_current():
+    """Returns the ``Timings`` of the request this thread is timing"""
+    return getattr(_local, "timings", None)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a ``with`` block as stage ``name`` of the current request
+
+    Does nothing if this thread isn't timing a request.
+    """
+    timings = get_current()
+    if timings is None:
+        yield
+        return
+    with timings.stage(name):
+        yield
+
+
+@contextmanager
+def timed_request(request):
+    """
+    Times the stages of ``request`` if it is sampled
+
+    Yields the ``Timings``, or ``None`` if the request isn't sampled.
+    """
+    if not is_sampled() or get_current() is not None:
+        yield None
+        return
+    timings = _local.timings = request.donation_timings = Timings()
+    started = default_timer()
+    try:
+        with QueryCounter(timings.using) as counter:
+            yield timings
+    finally:
+        _local.timings = None
+        timings.total = default_timer() - started
+        timings.queries = counter.count or 0
+
+
+def report(request, response, timings):
+    """Adds ``timings`` to ``response`` and logs them"""
+    response[HEADER] = timings.as_header()
+    logger.info("donation timing method=%s path=%s status=%s %s",
+            request.method, request.path, response.status_code,
+            timings.as_log())
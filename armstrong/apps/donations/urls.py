@@ -1,7 +1,13 @@
 from django.conf.urls.defaults import patterns, url
+from . import progress
 from . import views
 
 urlpatterns = patterns('',
     url(r"^/?$", views.DonationFormView.as_view(), name="donations_form"),
     url(r"^thanks/?$", views.ThanksView.as_view(), name="donations_thanks"),
+    url(r"^status/(?P<token>[0-9a-f]{32})/?$",
+            views.PurchaseStatusView.as_view(), name="donations_status"),
+    url(r"^campaigns/(?P<slug>[-\w]+)/progress/?$",
+            progress.CampaignProgressView.as_view(),
+            name="donations_campaign_progress"),
 )
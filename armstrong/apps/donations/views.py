@@ -1,8 +1,17 @@
 from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.http import HttpResponseRedirect
+from django.shortcuts import get_object_or_404
 from django.views.generic import TemplateView
+import json
 
 from . import backends
+from .breakers import CircuitOpen
+from . import idempotency
+from . import models
+from . import queues
+from . import retries
+from . import timing
 
 
 class LandingView(TemplateView):
@@ -18,6 +27,21 @@ class DonationFormView(TemplateView):
     confirm_template_name = "armstrong/donations/confirm.html"
     form_validation_failed = False
     confirm = False
+    queue_purchase = False
+
+    # The form built and validated for this request, reused when rendering
+    donation_form = None
+
+    def dispatch(self, request, *args, **kwargs):
+        with timing.timed_request(request) as timings:
+            response = super(DonationFormView, self).dispatch(request,
+                    *args, **kwargs)
+            if timings is not None and hasattr(response, "render"):
+                with timing.stage("render"):
+                    response.render()
+        if timings is not None:
+            timing.report(request, response, timings)
+        return response
 
     @property
     def use_confirm_template(self):
@@ -77,12 +101,15 @@ class DonationFormView(TemplateView):
         return backends.get_backend().get_form_class()
 
     def get_donation_form(self):
-        donation_form_class = self.get_donation_form_class()
-        return donation_form_class(**self.get_donation_form_kwargs())
+        with timing.stage("form"):
+            donation_form_class = self.get_donation_form_class()
+            return donation_form_class(**self.get_donation_form_kwargs())
 
     def get_context_data(self, **kwargs):
         context = super(DonationFormView, self).get_context_data(**kwargs)
-        donation_form = self.get_donation_form()
+        donation_form = self.donation_form
+        if donation_form is None:
+            donation_form = self.get_donation_form()
         context.update({
             "form_action_url": self.form_action_url,
             "donation_form": donation_form,
@@ -91,8 +118,10 @@ class DonationFormView(TemplateView):
         return context
 
     def post(self, request, *args, **kwargs):
-        donation_form = self.get_donation_form()
-        if not donation_form.is_valid():
+        donation_form = self.donation_form = self.get_donation_form()
+        with timing.stage("validate"):
+            is_valid = donation_form.is_valid()
+        if not is_valid:
             return self.form_is_invalid(**kwargs)
         return self.form_is_valid(donation_form=donation_form, **kwargs)
 
@@ -101,15 +130,119 @@ class DonationFormView(TemplateView):
         return self.render_to_response(self.get_context_data(**kwargs))
 
     def form_is_valid(self, donation_form, **kwargs):
+        self.donation_form = donation_form
         if self.requires_confirmation:
             context = self.get_context_data(**kwargs)
             return self.render_to_response(context)
-        donation = donation_form.save()
-        response = backends.get_backend().purchase(donation, donation_form)
+        key = idempotency.get_submission_key(donation_form)
+        if key is None:
+            return self.process_donation(donation_form, **kwargs)
+        cache = idempotency.get_cache()
+        previous = cache.claim(key)
+        if previous is not None:
+            return self.duplicate_submission(previous, **kwargs)
+        response = None
+        try:
+            response = self.process_donation(donation_form, **kwargs)
+        finally:
+            if isinstance(response, HttpResponseRedirect):
+                cache.complete(key, response["Location"])
+            else:
+                cache.release(key)
+        return response
+
+    def process_donation(self, donation_form, **kwargs):
+        if not self.queue_purchase:
+            backend = backends.get_backend()
+            if not retries.is_enabled() and not self.is_available(backend):
+                return self.gateway_unavailable(**kwargs)
+        with timing.stage("save"):
+            donation = donation_form.save()
+        if self.queue_purchase:
+            return self.purchase_queued(donation, donation_form, **kwargs)
+        try:
+            with timing.stage("purchase"):
+                response = backend.purchase(donation, donation_form)
+        except Exception as e:
+            if retries.is_enabled() and backends.is_transient_error(e):
+                return self.purchase_retrying(donation, donation_form,
+                        backend, u"%s" % e, **kwargs)
+            if isinstance(e, CircuitOpen):
+                # The breaker opened after ``is_available`` was checked
+                self.discard_donation(donation)
+                return self.gateway_unavailable(**kwargs)
+            raise
         if not response["status"]:
+            if (retries.is_enabled() and backends.classify_failure(response)
+                    == backends.TRANSIENT):
+                return self.purchase_retrying(donation, donation_form,
+                        backend, response["reason"], **kwargs)
             return self.purchase_failed(response, **kwargs)
         return HttpResponseRedirect(self.success_url)
 
+    def is_available(self, backend):
+        """
+        Returns ``False`` if ``backend`` would refuse a purchase unattempted
+
+        ``is_available`` is optional on backends, so those without it are
+        always tried.
+        """
+        is_available = getattr(backend, "is_available", None)
+        return is_available is None or is_available()
+
+    def discard_donation(self, donation):
+        """
+        Deletes ``donation`` after its purchase was refused unattempted
+
+        Its donor and their addresses go too, unless something else still
+        refers to them.
+        """
+        donor = donation.donor
+        donation.delete()
+        if donor.donation_set.exists():
+            return
+        addresses = set([a for a in (donor.address, donor.mailing_address)
+                if a is not None])
+        donor.delete()
+        for address in addresses:
+            if not (address.addresses.exists()
+                    or address.mailing_addresses.exists()):
+                address.delete()
+
+    def duplicate_submission(self, previous, **kwargs):
+        if previous["location"]:
+            return HttpResponseRedirect(previous["location"])
+        context = self.get_context_data(**kwargs)
+        context.update({
+            "error_msg": "This donation is already being processed",
+        })
+        return self.render_to_response(context)
+
+    def purchase_queued(self, donation, donation_form, **kwargs):
+        job = queues.get_queue().enqueue(donation, donation_form,
+                backend=backends.get_backend())
+        return HttpResponseRedirect(reverse("donations_status",
+                kwargs={"token": job.token}))
+
+    def purchase_retrying(self, donation, donation_form, backend, reason,
+            **kwargs):
+        """Called when a purchase failed in a way that is safe to retry"""
+        job = models.PurchaseJob.objects.create(donation=donation,
+                status=models.PurchaseJob.PROCESSING)
+        retries.get_queue().schedule(job, donation_form, backend=backend,
+                reason=reason)
+        return HttpResponseRedirect(reverse("donations_status",
+                kwargs={"token": job.token}))
+
+    def gateway_unavailable(self, **kwargs):
+        """Called when the backend's circuit breaker refused the purchase"""
+        context = self.get_context_data(**kwargs)
+        context.update({
+            "error_msg": "We are unable to process payments right now. "
+                    "Please try again shortly.",
+        })
+        return self.render_to_response(context, status=503)
+
     def purchase_failed(self, backend_response, **kwargs):
         context = self.get_context_data(**kwargs)
         context.update({
@@ -118,3 +251,40 @@ class DonationFormView(TemplateView):
             "response": backend_response["response"],
         })
         return self.render_to_response(context)
+
+
+class PurchaseStatusView(TemplateView):
+    """
+    Displays the status of a purchase queued by ``DonationFormView``
+
+    AJAX requests receive the status as JSON so the page can poll it.  Once
+    the purchase has succeeded regular requests are sent on to the thanks
+    page.
+    """
+    template_name = "armstrong/donations/status.html"
+
+    _success_url = None
+
+    @property
+    def success_url(self):
+        if not self._success_url:
+            self._success_url = reverse("donations_thanks")
+        return self._success_url
+
+    def get_job(self):
+        return get_object_or_404(models.PurchaseJob,
+                token=self.kwargs["token"])
+
+    def get(self, request, *args, **kwargs):
+        job = self.get_job()
+        if request.is_ajax():
+            return HttpResponse(json.dumps(job.as_dict()),
+                    mimetype="application/json")
+        if job.status == models.PurchaseJob.SUCCEEDED:
+            return HttpResponseRedirect(self.success_url)
+        context = self.get_context_data(**kwargs)
+        context.update({
+            "job": job,
+            "form_url": reverse("donations_form"),
+        })
+        return self.render_to_response(context)
@@ -0,0 +1,77 @@
+"""
+Bounded pools of background threads
+
+Used to move work that the donor doesn't need to wait on (queued purchases,
+deferred recurring subscriptions) out of the request/response cycle.
+"""
+from django.db import connection
+import logging
+import Queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Runs submitted callables on at most ``size`` daemon threads
+
+    Threads are started lazily on the first ``submit``.  A ``size`` of ``0``
+    runs everything inline, which is handy for tests and management
+    commands.
+    """
+    def __init__(self, size, name="donations-worker"):
+        self.size = size
+        self.name = name
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        if not self.size:
+            self.run(func, args, kwargs)
+            return
+        self.start()
+        self.tasks.put((func, args, kwargs))
+
+    def start(self):
+        with self.lock:
+            self.threads = [a for a in self.threads if a.is_alive()]
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work, name=self.name)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            func, args, kwargs = self.tasks.get()
+            try:
+                self.run(func, args, kwargs)
+            finally:
+                # Worker threads get their own database connection, make
+                # sure it doesn't outlive the task.
+                connection.close()
+                self.tasks.task_done()
+
+    def run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Background task %r failed", func)
+
+    def join(self):
+        """Blocks until every submitted task has run"""
+        self.tasks.join()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, size):
+    """Returns the process-wide ``WorkerPool`` called ``name``"""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = WorkerPool(size, name="donations-%s" % name)
+        return _pools[name]